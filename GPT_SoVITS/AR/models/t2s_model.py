@@ -9,10 +9,15 @@ from torch.nn import functional as F
 from torchmetrics.classification import MulticlassAccuracy
 from tqdm import tqdm
 
+from .t2s_prefix_cache import T2SPrefix
 from .utils import make_pad_mask
 from .utils import (
     topk_sampling,
     sample,
+    logits_to_probs,
+    multinomial_sample_one_no_sync,
+    sample_residual,
+    RepetitionPenaltyState,
     dpo_loss,
     make_reject_y,
     get_batch_logps
@@ -64,6 +69,68 @@ def scaled_dot_product_attention(query:torch.Tensor, key:torch.Tensor, value:tor
 
     return attn_weight @ value
 
+@torch.jit.script
+class T2SKVCache:
+    """
+    Per-layer key/value cache for incremental decoding.
+
+    Buffers are allocated once with shape [batch, max_len, hidden] and new keys/values are
+    written in place at ``kv_len``, so a decode step no longer copies the whole history.
+    If a sequence outgrows ``max_len`` the buffers are doubled.
+    """
+    def __init__(self, max_len: int):
+        self.max_len: int = max_len
+        self.kv_len: int = 0
+        self.k_caches: List[torch.Tensor] = []
+        self.v_caches: List[torch.Tensor] = []
+
+    def _allocate(self, x: torch.Tensor, max_len: int) -> torch.Tensor:
+        cache = x.new_empty([x.shape[0], max_len, x.shape[2]])
+        cache.narrow(1, 0, x.shape[1]).copy_(x)
+        return cache
+
+    def prefill(self, k: torch.Tensor, v: torch.Tensor):
+        max_len = max(self.max_len, k.shape[1])
+        self.k_caches.append(self._allocate(k, max_len))
+        self.v_caches.append(self._allocate(v, max_len))
+        self.kv_len = k.shape[1]
+
+    def update(self, layer: int, k: torch.Tensor, v: torch.Tensor):
+        length = k.shape[1]
+        end = self.kv_len + length
+        k_cache = self.k_caches[layer]
+        v_cache = self.v_caches[layer]
+        if end > k_cache.shape[1]:
+            max_len = max(k_cache.shape[1] * 2, end)
+            k_cache = self._allocate(k_cache.narrow(1, 0, self.kv_len), max_len)
+            v_cache = self._allocate(v_cache.narrow(1, 0, self.kv_len), max_len)
+            self.k_caches[layer] = k_cache
+            self.v_caches[layer] = v_cache
+        k_cache.narrow(1, self.kv_len, length).copy_(k)
+        v_cache.narrow(1, self.kv_len, length).copy_(v)
+        return k_cache.narrow(1, 0, end), v_cache.narrow(1, 0, end)
+
+    def advance(self, length: int):
+        self.kv_len += length
+
+    def zero_unused(self):
+        # the buffers are not initialized after kv_len; attention over the whole buffer (the static
+        # decode) hides those columns with its mask, but NaN garbage would still leak through the softmax
+        for i in range(len(self.k_caches)):
+            unused = self.k_caches[i].shape[1] - self.kv_len
+            self.k_caches[i].narrow(1, self.kv_len, unused).zero_()
+            self.v_caches[i].narrow(1, self.kv_len, unused).zero_()
+
+    def truncate(self, length: int):
+        # drop everything after ``length``, e.g. rejected speculative tokens
+        self.kv_len = min(self.kv_len, length)
+
+    def index_select(self, index: torch.Tensor):
+        for i in range(len(self.k_caches)):
+            self.k_caches[i] = torch.index_select(self.k_caches[i], dim=0, index=index)
+            self.v_caches[i] = torch.index_select(self.v_caches[i], dim=0, index=index)
+
+
 @torch.jit.script
 class T2SMLP:
     def __init__(self, w1, b1, w2, b2):
@@ -72,9 +139,15 @@ class T2SMLP:
         self.w2 = w2
         self.b2 = b2
 
+    def linear1(self, x:torch.Tensor):
+        return F.linear(x, self.w1, self.b1)
+
+    def linear2(self, x:torch.Tensor):
+        return F.linear(x, self.w2, self.b2)
+
     def forward(self, x):
-        x = F.relu(F.linear(x, self.w1, self.b1))
-        x = F.linear(x, self.w2, self.b2)
+        x = F.relu(self.linear1(x))
+        x = self.linear2(x)
         return x
 
 
@@ -110,8 +183,6 @@ class T2SBlock:
         self.norm_b2 = norm_b2
         self.norm_eps2 = norm_eps2
 
-        self.false = torch.tensor(False, dtype=torch.bool)
-
     @torch.jit.ignore
     def to_mask(self, x:torch.Tensor, padding_mask:Optional[torch.Tensor]):
         if padding_mask is None:
@@ -121,11 +192,17 @@ class T2SBlock:
             return x.masked_fill(padding_mask, 0)
         else:
             return x * padding_mask
+
+    def qkv_proj(self, x:torch.Tensor):
+        return F.linear(x, self.qkv_w, self.qkv_b)
+
+    def out_proj(self, x:torch.Tensor):
+        return F.linear(x, self.out_w, self.out_b)
         
     def process_prompt(self, x:torch.Tensor, attn_mask : torch.Tensor, padding_mask:Optional[torch.Tensor]=None, torch_sdpa:bool=True):
 
             
-        q, k, v = F.linear(self.to_mask(x, padding_mask), self.qkv_w, self.qkv_b).chunk(3, dim=-1)
+        q, k, v = self.qkv_proj(self.to_mask(x, padding_mask)).chunk(3, dim=-1)
 
         batch_size = q.shape[0]
         q_len = q.shape[1]
@@ -146,50 +223,29 @@ class T2SBlock:
 
         attn = attn.permute(2, 0, 1, 3).reshape(batch_size*q_len, self.hidden_dim)
         attn = attn.view(q_len, batch_size, self.hidden_dim).transpose(1, 0)
-        attn = F.linear(self.to_mask(attn, padding_mask), self.out_w, self.out_b)
-
-        if padding_mask is not None:
-            for i in range(batch_size):
-                # mask = padding_mask[i,:,0]
-                if self.false.device!= padding_mask.device:
-                    self.false = self.false.to(padding_mask.device)
-                idx = torch.where(padding_mask[i,:,0]==self.false)[0]
-                x_item = x[i,idx,:].unsqueeze(0)
-                attn_item = attn[i,idx,:].unsqueeze(0)
-                x_item = x_item + attn_item
-                x_item = F.layer_norm(
-                    x_item, [self.hidden_dim], self.norm_w1, self.norm_b1, self.norm_eps1
-                )
-                x_item = x_item + self.mlp.forward(x_item)
-                x_item = F.layer_norm(
-                    x_item,
-                    [self.hidden_dim],
-                    self.norm_w2,
-                    self.norm_b2,
-                    self.norm_eps2,
-                )
-                x[i,idx,:] = x_item.squeeze(0)
-            x = self.to_mask(x, padding_mask)
-        else:
-            x = x + attn
-            x = F.layer_norm(
-                x, [self.hidden_dim], self.norm_w1, self.norm_b1, self.norm_eps1
-            )
-            x = x + self.mlp.forward(x)
-            x = F.layer_norm(
-                x,
-                [self.hidden_dim],
-                self.norm_w2,
-                self.norm_b2,
-                self.norm_eps2,
-            )
+        attn = self.out_proj(self.to_mask(attn, padding_mask))
+
+        # layer norm and MLP act on each position independently, so the padded rows can be
+        # computed together with the rest of the batch and masked once afterwards
+        x = x + attn
+        x = F.layer_norm(
+            x, [self.hidden_dim], self.norm_w1, self.norm_b1, self.norm_eps1
+        )
+        x = x + self.mlp.forward(x)
+        x = F.layer_norm(
+            x,
+            [self.hidden_dim],
+            self.norm_w2,
+            self.norm_b2,
+            self.norm_eps2,
+        )
+        x = self.to_mask(x, padding_mask)
         return x, k_cache, v_cache
     
-    def decode_next_token(self, x:torch.Tensor, k_cache:torch.Tensor, v_cache:torch.Tensor, attn_mask:Optional[torch.Tensor]=None, torch_sdpa:bool=True):
-        q, k, v = F.linear(x, self.qkv_w, self.qkv_b).chunk(3, dim=-1)
+    def decode_next_token(self, x:torch.Tensor, kv_cache:T2SKVCache, layer:int, attn_mask:Optional[torch.Tensor]=None, torch_sdpa:bool=True):
+        q, k, v = self.qkv_proj(x).chunk(3, dim=-1)
 
-        k_cache = torch.cat([k_cache, k], dim=1)
-        v_cache = torch.cat([v_cache, v], dim=1)
+        k_cache, v_cache = kv_cache.update(layer, k, v)
         
         batch_size = q.shape[0]
         q_len = q.shape[1]
@@ -207,7 +263,7 @@ class T2SBlock:
 
         attn = attn.permute(2, 0, 1, 3).reshape(batch_size*q_len, self.hidden_dim)
         attn = attn.view(q_len, batch_size, self.hidden_dim).transpose(1, 0)
-        attn = F.linear(attn, self.out_w, self.out_b)
+        attn = self.out_proj(attn)
 
         x = x + attn
         x = F.layer_norm(
@@ -221,7 +277,46 @@ class T2SBlock:
             self.norm_b2,
             self.norm_eps2,
         )
-        return x, k_cache, v_cache
+        return x
+
+    def decode_next_token_static(self, x:torch.Tensor, k_cache:torch.Tensor, v_cache:torch.Tensor, pos:torch.Tensor, attn_mask:torch.Tensor, torch_sdpa:bool=True):
+        # fixed-shape variant of decode_next_token: k/v are written at `pos` of the preallocated buffers
+        # and attention runs over the whole buffer, unused positions are hidden by attn_mask
+        q, k, v = self.qkv_proj(x).chunk(3, dim=-1)
+
+        k_cache.index_copy_(1, pos, k)
+        v_cache.index_copy_(1, pos, v)
+
+        batch_size = q.shape[0]
+        q_len = q.shape[1]
+        kv_len = k_cache.shape[1]
+
+        q = q.view(batch_size, q_len, self.num_heads, -1).transpose(1, 2)
+        k = k_cache.view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+        v = v_cache.view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+
+        if torch_sdpa:
+            attn = F.scaled_dot_product_attention(q, k, v, ~attn_mask)
+        else:
+            attn = scaled_dot_product_attention(q, k, v, attn_mask)
+
+        attn = attn.permute(2, 0, 1, 3).reshape(batch_size*q_len, self.hidden_dim)
+        attn = attn.view(q_len, batch_size, self.hidden_dim).transpose(1, 0)
+        attn = self.out_proj(attn)
+
+        x = x + attn
+        x = F.layer_norm(
+            x, [self.hidden_dim], self.norm_w1, self.norm_b1, self.norm_eps1
+        )
+        x = x + self.mlp.forward(x)
+        x = F.layer_norm(
+            x,
+            [self.hidden_dim],
+            self.norm_w2,
+            self.norm_b2,
+            self.norm_eps2,
+        )
+        return x
 
 
 @torch.jit.script
@@ -233,26 +328,40 @@ class T2STransformer:
     def process_prompt(
         self, x:torch.Tensor, attn_mask : torch.Tensor,
         padding_mask : Optional[torch.Tensor]=None, 
-        torch_sdpa:bool=True
+        torch_sdpa:bool=True,
+        max_len:int=0,
         ):
-        k_cache : List[torch.Tensor] = []
-        v_cache : List[torch.Tensor] = []
+        kv_cache = T2SKVCache(max_len)
         for i in range(self.num_blocks):
             x, k_cache_, v_cache_ = self.blocks[i].process_prompt(x, attn_mask, padding_mask, torch_sdpa)
-            k_cache.append(k_cache_)
-            v_cache.append(v_cache_)
-        return x, k_cache, v_cache
+            kv_cache.prefill(k_cache_, v_cache_)
+        return x, kv_cache
 
     def decode_next_token(
         self, x:torch.Tensor, 
-        k_cache: List[torch.Tensor], 
-        v_cache: List[torch.Tensor], 
+        kv_cache: T2SKVCache, 
         attn_mask : Optional[torch.Tensor]=None,
-        torch_sdpa:bool=True
+        torch_sdpa:bool=True,
+        num_blocks:int=-1,
+    ):
+        # num_blocks > 0 only runs the first blocks, the draft model of speculative decoding
+        if num_blocks < 0:
+            num_blocks = self.num_blocks
+        for i in range(num_blocks):
+            x = self.blocks[i].decode_next_token(x, kv_cache, i, attn_mask, torch_sdpa)
+        kv_cache.advance(x.shape[1])
+        return x, kv_cache
+
+    def decode_next_token_static(
+        self, x:torch.Tensor,
+        kv_cache: T2SKVCache,
+        pos:torch.Tensor,
+        attn_mask:torch.Tensor,
+        torch_sdpa:bool=True,
     ):
         for i in range(self.num_blocks):
-            x, k_cache[i], v_cache[i] = self.blocks[i].decode_next_token(x, k_cache[i], v_cache[i], attn_mask, torch_sdpa)
-        return x, k_cache, v_cache
+            x = self.blocks[i].decode_next_token_static(x, kv_cache.k_caches[i], kv_cache.v_caches[i], pos, attn_mask, torch_sdpa)
+        return x
 
 
 class Text2SemanticDecoder(nn.Module):
@@ -339,6 +448,7 @@ class Text2SemanticDecoder(nn.Module):
             blocks.append(block)
         
         self.t2s_transformer = T2STransformer(self.num_layers, blocks)
+        self.compiled_decode_step_static = None
 
     def make_input_data(self, x, x_lens, y, y_lens, bert_feature):
         x = self.ar_text_embedding(x)
@@ -565,6 +675,48 @@ class Text2SemanticDecoder(nn.Module):
             y = torch.concat([y, samples], dim=1)
         return y
 
+    def get_kv_cache_len(self, src_len:int, early_stop_num:int=-1)->int:
+        # 最多解码1500步, early_stop_num 会提前截断
+        max_new_tokens = 1500 if early_stop_num == -1 else min(early_stop_num + 1, 1500)
+        return src_len + max_new_tokens
+
+    def embed_prompt_prefix(self, phones:torch.LongTensor, bert_feature:torch.Tensor, prompt:Optional[torch.LongTensor]=None)->T2SPrefix:
+        '''
+            Embed the reference part of the prefill input, see T2SPrefixCache.
+            Args:
+                phones: LongTensor [ref_len], reference phone ids.
+                bert_feature: Tensor [1024, ref_len].
+                prompt: LongTensor [1, y_len], reference semantic tokens.
+        '''
+        x = self.ar_text_embedding(phones.unsqueeze(0))
+        x = x + self.project_bert(bert_feature.transpose(0, 1).unsqueeze(0))
+        x = self.ar_text_position(x)
+        y_pos = self.ar_audio_position(self.ar_audio_embedding(prompt)) if prompt is not None else None
+        return T2SPrefix(phones.shape[0], x, y_pos)
+
+    def project_bert(self, bert_feature:torch.Tensor)->torch.Tensor:
+        # the BERT features come in the precision of the rest of the pipeline, which differs from
+        # the t2s weights when they are quantized (see t2s_quantization)
+        return self.bert_proj(bert_feature.to(dtype=self.ar_text_embedding.weight.dtype))
+
+    def embed_text(self, x:torch.LongTensor, bert_feature:torch.Tensor, prefix:Optional[T2SPrefix]=None)->torch.Tensor:
+        '''
+            x: LongTensor [B, x_len], bert_feature: Tensor [B, 1024, x_len].
+            With a prefix, only the tokens after the reference phones are embedded.
+        '''
+        if prefix is None:
+            x = self.ar_text_embedding(x)
+            x = x + self.project_bert(bert_feature.transpose(1, 2))
+            return self.ar_text_position(x)
+
+        ref_len = prefix.ref_len
+        x_len = x.shape[1]
+        x_new = self.ar_text_embedding(x[:, ref_len:])
+        x_new = x_new + self.project_bert(bert_feature[:, :, ref_len:].transpose(1, 2))
+        pe = self.ar_text_position.pe[:, ref_len:x_len].to(dtype=x_new.dtype, device=x_new.device)
+        x_new = x_new * self.ar_text_position.x_scale + self.ar_text_position.alpha * pe
+        return torch.concat([prefix.x.expand(x.shape[0], -1, -1), x_new], dim=1)
+
     def pad_y_eos(self, y, y_mask_int, eos_id):
         targets = F.pad(y, (0, 1), value=0) + eos_id * F.pad(
             y_mask_int, (0, 1), value=1
@@ -572,31 +724,25 @@ class Text2SemanticDecoder(nn.Module):
         # 错位
         return targets[:, :-1], targets[:, 1:]
 
-    def infer_panel_batch_infer(
+    def make_batch_infer_input(
         self,
-        x:List[torch.LongTensor],  #####全部文本token
+        x:List[torch.LongTensor],
         x_lens:torch.LongTensor,
-        prompts:torch.LongTensor,  ####参考音频token
+        prompts:torch.LongTensor,
         bert_feature:List[torch.LongTensor],
-        top_k: int = -100,
-        top_p: int = 100,
-        early_stop_num: int = -1,
-        temperature: float = 1.0,
-        repetition_penalty: float = 1.35,
-        **kwargs,
+        max_len:int,
+        prompt_prefix:Optional[T2SPrefix]=None,
     ):
-        if prompts is None:
-            print("Warning: Prompt free is not supported batch_infer! switch to naive_infer")
-            return self.infer_panel_naive_batched(x, x_lens, prompts, bert_feature, top_k=top_k, top_p=top_p, early_stop_num=early_stop_num, temperature=temperature, **kwargs)
-
-
-        max_len = kwargs.get("max_len",x_lens.max())
+        '''
+            Right-pad the text of each row to max_len and build the prefill input of the batch.
+            Returns:
+                xy_pos, xy_attn_mask [B, 1, src_len, src_len], xy_padding_mask [B, src_len, model_dim],
+                y (the prompts), y_len, ref_free
+        '''
         x_list = []
         for x_item, bert_item in zip(x, bert_feature):
             # max_len = max(max_len, x_item.shape[0], bert_item.shape[1])
-            x_item = self.ar_text_embedding(x_item.unsqueeze(0))
-            x_item = x_item + self.bert_proj(bert_item.transpose(0, 1).unsqueeze(0))
-            x_item = self.ar_text_position(x_item).squeeze(0)
+            x_item = self.embed_text(x_item.unsqueeze(0), bert_item.unsqueeze(0), prompt_prefix).squeeze(0)
             x_item = F.pad(x_item,(0,0,0,max_len-x_item.shape[0]),value=0) if x_item.shape[0]<max_len else x_item
             x_list.append(x_item)
         x = torch.stack(x_list, dim=0)
@@ -607,23 +753,20 @@ class Text2SemanticDecoder(nn.Module):
         
         x_len = x.shape[1]
         x_attn_mask = torch.zeros((x_len, x_len), dtype=torch.bool)
-        stop = False
 
-        k_cache = None
-        v_cache = None
-        ###################  first step ##########################
         if y is not None:
             y_emb = self.ar_audio_embedding(y)
             y_len = y_emb.shape[1]
-            prefix_len = y.shape[1]
             y_lens = torch.LongTensor([y_emb.shape[1]]*y_emb.shape[0]).to(x.device)
-            y_pos = self.ar_audio_position(y_emb)
+            if prompt_prefix is not None and prompt_prefix.y_pos is not None:
+                y_pos = prompt_prefix.y_pos.expand(y_emb.shape[0], -1, -1)
+            else:
+                y_pos = self.ar_audio_position(y_emb)
             xy_pos = torch.concat([x, y_pos], dim=1)
             ref_free = False
         else:
             y_emb = None
             y_len = 0
-            prefix_len = 0
             y_lens = torch.LongTensor([y_len]*x.shape[0]).to(x.device)
             y_pos = None
             xy_pos = x
@@ -651,17 +794,47 @@ class Text2SemanticDecoder(nn.Module):
             value=False,
         )
         
-        xy_mask = torch.concat([x_mask, y_mask], dim=0).view(1 , src_len, src_len).repeat(bsz, 1, 1).to(x.device)
-        _xy_padding_mask = xy_padding_mask.view(bsz, 1, src_len).repeat(1, src_len, 1)
-        
-        for i in range(bsz):
-            l = x_lens[i]
-            _xy_padding_mask[i,l:max_len,:]=True
-            
-        xy_attn_mask = xy_mask.logical_or(_xy_padding_mask)
-        xy_attn_mask = xy_attn_mask.unsqueeze(1).expand(-1, self.num_head, -1, -1)
-        xy_attn_mask = xy_attn_mask.bool()
+        xy_mask = torch.concat([x_mask, y_mask], dim=0).to(x.device)
+
+        # broadcast over heads and queries instead of materializing one mask per row and head:
+        # padded text positions are hidden as keys, their (padded) query rows are zeroed by to_mask
+        xy_attn_mask = xy_mask.view(1, 1, src_len, src_len).logical_or(xy_padding_mask.view(bsz, 1, 1, src_len))
         xy_padding_mask = xy_padding_mask.view(bsz, src_len, 1).expand(-1, -1, self.model_dim)
+        return xy_pos, xy_attn_mask, xy_padding_mask, y, y_len, ref_free
+
+    def infer_panel_batch_infer(
+        self,
+        x:List[torch.LongTensor],  #####全部文本token
+        x_lens:torch.LongTensor,
+        prompts:torch.LongTensor,  ####参考音频token
+        bert_feature:List[torch.LongTensor],
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        **kwargs,
+    ):
+        if prompts is None:
+            print("Warning: Prompt free is not supported batch_infer! switch to naive_infer")
+            return self.infer_panel_naive_batched(x, x_lens, prompts, bert_feature, top_k=top_k, top_p=top_p, early_stop_num=early_stop_num, temperature=temperature, **kwargs)
+
+
+        max_len = kwargs.get("max_len",x_lens.max())
+        prompt_prefix:T2SPrefix = kwargs.get("prompt_prefix", None)
+        # returns True when the caller gives up on the request, the rows decoded so far are returned
+        should_stop = kwargs.get("should_stop", None)
+        xy_pos, xy_attn_mask, xy_padding_mask, y, y_len, ref_free = \
+            self.make_batch_infer_input(x, x_lens, prompts, bert_feature, max_len, prompt_prefix)
+        bsz = xy_pos.shape[0]
+        src_len = xy_pos.shape[1]
+        prefix_len = y.shape[1]
+        stop = False
+        kv_cache = None
+        kv_cache_len = self.get_kv_cache_len(src_len, early_stop_num)
+        penalty_state = RepetitionPenaltyState(y, bsz, self.vocab_size, repetition_penalty, y.device)
+        # key padding of the whole KV cache, the decode steps attend to a prefix of it
+        key_padding_mask = F.pad(xy_padding_mask[:, :, 0], (0, kv_cache_len - src_len), value=False)
 
         ###### decode #####
         y_list = [None]*y.shape[0]
@@ -669,22 +842,21 @@ class Text2SemanticDecoder(nn.Module):
         idx_list = [None]*y.shape[0]
         for idx in tqdm(range(1500)):
             if idx == 0:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, xy_padding_mask, False)
+                xy_dec, kv_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, xy_padding_mask, False, kv_cache_len)
             else:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache, xy_attn_mask, False)
+                xy_dec, kv_cache = self.t2s_transformer.decode_next_token(xy_pos, kv_cache, xy_attn_mask, False)
             logits = self.ar_predict_layer(
                 xy_dec[:, -1]
             )
 
             if idx == 0:
-                xy_attn_mask = F.pad(xy_attn_mask[:,:,-1].unsqueeze(-2),(0,1),value=False)
                 logits = logits[:, :-1]
-            else:
-                xy_attn_mask = F.pad(xy_attn_mask,(0,1),value=False)
 
+            penalty_state.apply_(logits)
             samples = sample(
-                    logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
+                    logits, None, top_k=top_k, top_p=top_p, repetition_penalty=1.0, temperature=temperature
                 )[0]
+            penalty_state.update(samples)
 
             y = torch.concat([y, samples], dim=1)
             
@@ -710,14 +882,14 @@ class Text2SemanticDecoder(nn.Module):
             if reserved_idx_of_batch_for_y is not None:
                 # index = torch.LongTensor(batch_idx_map).to(y.device)
                 y = torch.index_select(y, dim=0, index=reserved_idx_of_batch_for_y)
-                xy_attn_mask = torch.index_select(xy_attn_mask, dim=0, index=reserved_idx_of_batch_for_y)
-                if k_cache is not None :
-                    for i in range(len(k_cache)):
-                        k_cache[i] = torch.index_select(k_cache[i], dim=0, index=reserved_idx_of_batch_for_y)
-                        v_cache[i] = torch.index_select(v_cache[i], dim=0, index=reserved_idx_of_batch_for_y)
+                key_padding_mask = torch.index_select(key_padding_mask, dim=0, index=reserved_idx_of_batch_for_y)
+                if kv_cache is not None :
+                    kv_cache.index_select(reserved_idx_of_batch_for_y)
+                penalty_state.index_select(reserved_idx_of_batch_for_y)
                 
                 
-            if (early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num) or idx==1499:
+            if (early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num) or idx==1499 \
+                    or (should_stop is not None and should_stop()):
                 print("use early stop num:", early_stop_num)
                 stop = True
                 for i, batch_index in enumerate(batch_idx_map):
@@ -738,17 +910,153 @@ class Text2SemanticDecoder(nn.Module):
             ####################### update next step ###################################
             y_emb = self.ar_audio_embedding(y[:, -1:])
             xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * self.ar_audio_position.pe[:, y_len + idx].to( dtype= y_emb.dtype,device=y_emb.device)            
+            xy_attn_mask = key_padding_mask[:, None, None, :src_len + idx + 1]
 
         if (None in idx_list):
-            for i in range(x.shape[0]):
+            for i in range(bsz):
                 if idx_list[i] is None:
                     idx_list[i] = 1500-1  ###如果没有生成到EOS，就用最大长度代替
                     
         if ref_free:
-            return y_list, [0]*x.shape[0]
+            return y_list, [0]*bsz
         # print(idx_list)
         return y_list, idx_list
     
+    def decode_step_static(
+        self,
+        y:torch.Tensor,
+        kv_cache:T2SKVCache,
+        pos:torch.Tensor,
+        pe_pos:torch.Tensor,
+        pe:torch.Tensor,
+        attn_mask:torch.Tensor,
+        presence:torch.Tensor,
+        top_k:int,
+        top_p:float,
+        temperature:float,
+        repetition_penalty:float,
+    ):
+        '''
+            One decode step (decode_next_token + ar_predict_layer + sampling) where every tensor has a
+            fixed shape, so it can be compiled once with torch.compile.
+            Args:
+                y: LongTensor [B, 1], the last sampled tokens.
+                pos: LongTensor [1], cache column written in this step.
+                pe_pos: LongTensor [1], position of y in the semantic sequence.
+                pe: Tensor [max_pos, model_dim], positional encodings of ar_audio_position.
+                attn_mask: BoolTensor [B, 1, 1, kv_cache_len], True for columns that are not attended to.
+                presence: BoolTensor [B, vocab_size], tokens that get the repetition penalty.
+            Returns:
+                samples: IntTensor [B, 1], tokens: LongTensor [B] (argmax of the penalized logits)
+        '''
+        y_emb = self.ar_audio_embedding(y)
+        xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * pe.index_select(0, pe_pos).unsqueeze(0)
+        xy_dec = self.t2s_transformer.decode_next_token_static(xy_pos, kv_cache, pos, attn_mask, False)
+        logits = self.ar_predict_layer(xy_dec[:, -1])
+
+        if repetition_penalty != 1.0:
+            penalized = torch.where(logits < 0, logits * repetition_penalty, logits / repetition_penalty)
+            logits = torch.where(presence, penalized, logits)
+        probs = logits_to_probs(logits, None, temperature=temperature, top_k=top_k, top_p=top_p)
+        samples = multinomial_sample_one_no_sync(probs)
+        tokens = torch.argmax(logits, dim=-1)
+        return samples, tokens
+
+    def get_decode_step_static(self, device:torch.device):
+        # torch.compile only pays off with CUDA graphs, on CPU the eager step still avoids reallocations
+        if device.type != "cuda" or not hasattr(torch, "compile"):
+            return self.decode_step_static
+        if self.compiled_decode_step_static is None:
+            self.compiled_decode_step_static = torch.compile(self.decode_step_static, mode="reduce-overhead", dynamic=False)
+        return self.compiled_decode_step_static
+
+    def infer_panel_static(
+        self,
+        x:List[torch.LongTensor],  #####全部文本token
+        x_lens:torch.LongTensor,
+        prompts:torch.LongTensor,  ####参考音频token
+        bert_feature:List[torch.LongTensor],
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        **kwargs,
+    ):
+        '''
+            Same inputs and outputs as infer_panel_batch_infer, but the decode steps only use fixed-shape
+            buffers (KV cache, attention mask, positions, repetition penalty state) indexed by the step,
+            see decode_step_static. Finished rows are not removed from the batch, their tokens are ignored.
+        '''
+        if prompts is None:
+            print("Warning: Prompt free is not supported batch_infer! switch to naive_infer")
+            return self.infer_panel_naive_batched(x, x_lens, prompts, bert_feature, top_k=top_k, top_p=top_p, early_stop_num=early_stop_num, temperature=temperature, **kwargs)
+
+        max_len = kwargs.get("max_len",x_lens.max())
+        xy_pos, xy_attn_mask, xy_padding_mask, y, y_len, ref_free = \
+            self.make_batch_infer_input(x, x_lens, prompts, bert_feature, max_len, kwargs.get("prompt_prefix", None))
+        bsz = xy_pos.shape[0]
+        src_len = xy_pos.shape[1]
+        prefix_len = y.shape[1]
+        device = xy_pos.device
+        kv_cache_len = self.get_kv_cache_len(src_len, early_stop_num)
+
+        ###################  first step ##########################
+        xy_dec, kv_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, xy_padding_mask, False, kv_cache_len)
+        kv_cache.zero_unused()
+        logits = self.ar_predict_layer(xy_dec[:, -1])[:, :-1]
+        samples = sample(
+            logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
+        )[0]
+
+        ###### fixed-shape buffers #####
+        y_buffer = torch.zeros(bsz, prefix_len + 1500, dtype=y.dtype, device=device)
+        y_buffer[:, :prefix_len] = y
+        y_buffer[:, prefix_len] = samples[:, 0].to(y.dtype)
+        attn_mask = torch.ones(bsz, 1, 1, kv_cache_len, dtype=torch.bool, device=device)
+        attn_mask[:, 0, 0, :src_len] = xy_attn_mask[:, 0, -1]
+        presence = torch.zeros(bsz, self.vocab_size, dtype=torch.bool, device=device)
+        presence.scatter_(1, y_buffer[:, :prefix_len + 1].long(), True)
+        pe = self.ar_audio_position.pe[0].to(dtype=xy_pos.dtype, device=device)
+        pos = torch.zeros(1, dtype=torch.long, device=device)
+        pe_pos = torch.zeros(1, dtype=torch.long, device=device)
+        decode_step = self.get_decode_step_static(device)
+
+        ###### decode #####
+        y_list = [None]*bsz
+        idx_list = [None]*bsz
+        y_last = samples.clone()
+        for idx in tqdm(range(1, 1500)):
+            pos.fill_(src_len + idx - 1)
+            pe_pos.fill_(y_len + idx - 1)
+            attn_mask.index_fill_(-1, pos, False)
+            samples, tokens = decode_step(
+                y_last, kv_cache, pos, pe_pos, pe, attn_mask, presence, top_k, top_p, temperature, repetition_penalty
+            )
+            y_buffer[:, prefix_len + idx] = samples[:, 0].to(y_buffer.dtype)
+            y_last.copy_(samples)
+            presence.scatter_(1, samples.long(), True)
+
+            finished = ((samples[:, 0] == self.EOS) | (tokens == self.EOS)).tolist()
+            for i in range(bsz):
+                if finished[i] and idx_list[i] is None:
+                    idx_list[i] = idx - 1
+                    y_list[i] = y_buffer[i, :prefix_len + idx]
+            if (early_stop_num != -1 and idx + 1 > early_stop_num) or idx == 1499:
+                print("use early stop num:", early_stop_num)
+                for i in range(bsz):
+                    if idx_list[i] is None:
+                        idx_list[i] = idx
+                        y_list[i] = y_buffer[i, :prefix_len + idx]
+            if not (None in idx_list):
+                break
+
+        print(f"T2S Decoding EOS [{prefix_len} -> {prefix_len + idx + 1}]")
+
+        if ref_free:
+            return y_list, [0]*bsz
+        return y_list, idx_list
+
     def infer_panel_naive_batched(self,
         x:List[torch.LongTensor],  #####全部文本token
         x_lens:torch.LongTensor,
@@ -792,9 +1100,10 @@ class Text2SemanticDecoder(nn.Module):
         repetition_penalty: float = 1.35,
         **kwargs
     ):
-        x = self.ar_text_embedding(x)
-        x = x + self.bert_proj(bert_feature.transpose(1, 2))
-        x = self.ar_text_position(x)
+        prompt_prefix:T2SPrefix = kwargs.get("prompt_prefix", None)
+        # called with every sampled token [B, 1] that ends up in the output, as soon as it is known
+        on_token = kwargs.get("on_token", None)
+        x = self.embed_text(x, bert_feature, prompt_prefix)
 
         # AR Decoder
         y = prompts
@@ -804,14 +1113,16 @@ class Text2SemanticDecoder(nn.Module):
         stop = False
         # print(1111111,self.num_layers)
 
-        k_cache = None
-        v_cache = None
+        kv_cache = None
         ###################  first step ##########################
         if y is not None:
             y_emb = self.ar_audio_embedding(y)
             y_len = y_emb.shape[1]
             prefix_len = y.shape[1]
-            y_pos = self.ar_audio_position(y_emb)
+            if prompt_prefix is not None and prompt_prefix.y_pos is not None:
+                y_pos = prompt_prefix.y_pos.expand(y_emb.shape[0], -1, -1)
+            else:
+                y_pos = self.ar_audio_position(y_emb)
             xy_pos = torch.concat([x, y_pos], dim=1)
             ref_free = False
         else:
@@ -840,12 +1151,14 @@ class Text2SemanticDecoder(nn.Module):
                                                 .expand(bsz*self.num_head, -1, -1)\
                                                 .view(bsz, self.num_head, src_len, src_len)\
                                                 .to(device=x.device, dtype=torch.bool)
+        kv_cache_len = self.get_kv_cache_len(src_len, early_stop_num)
+        penalty_state = RepetitionPenaltyState(y, bsz, self.vocab_size, repetition_penalty, y.device)
 
         for idx in tqdm(range(1500)):
             if xy_attn_mask is not None:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None)
+                xy_dec, kv_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None, True, kv_cache_len)
             else:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache)
+                xy_dec, kv_cache = self.t2s_transformer.decode_next_token(xy_pos, kv_cache)
 
             logits = self.ar_predict_layer(
                 xy_dec[:, -1]
@@ -856,9 +1169,11 @@ class Text2SemanticDecoder(nn.Module):
             if(idx<11):###至少预测出10个token不然不给停止（0.4s）
                 logits = logits[:, :-1]
 
+            penalty_state.apply_(logits)
             samples = sample(
-                logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
+                logits, None, top_k=top_k, top_p=top_p, repetition_penalty=1.0, temperature=temperature
             )[0]
+            penalty_state.update(samples)
 
             y = torch.concat([y, samples], dim=1)
 
@@ -874,6 +1189,8 @@ class Text2SemanticDecoder(nn.Module):
                     print("bad zero prediction")
                 print(f"T2S Decoding EOS [{prefix_len} -> {y.shape[1]}]")
                 break
+            if on_token is not None:
+                on_token(samples)
 
             ####################### update next step ###################################
             y_emb = self.ar_audio_embedding(y[:, -1:])
@@ -884,6 +1201,206 @@ class Text2SemanticDecoder(nn.Module):
         return y[:, :-1], idx - 1
     
     
+    def infer_panel_speculative(self,
+        x:List[torch.LongTensor],  #####全部文本token
+        x_lens:torch.LongTensor,
+        prompts:torch.LongTensor,  ####参考音频token
+        bert_feature:List[torch.LongTensor],
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        return_acceptance: bool = False,
+        **kwargs
+        ):
+        '''
+            Speculative decoding, same inputs and outputs as infer_panel_naive_batched.
+            The first `draft_layers` blocks (sharing the embeddings and the prediction layer) propose
+            `num_draft_tokens` tokens, which the full model verifies in one forward pass. Draft tokens are
+            accepted with probability min(1, p/q) and a rejected token is resampled from the residual
+            distribution, so the samples follow the same distribution as `sample()`.
+            With `return_acceptance`, (accepted, proposed) draft token counts of this call are returned as a
+            third value. They are not stored on the model, which is shared by concurrent runs.
+        '''
+        y_list = []
+        idx_list = []
+        accepted = 0
+        proposed = 0
+        for i in range(len(x)):
+            y, idx, accepted_item, proposed_item = self.infer_speculative(x[i].unsqueeze(0),
+                                                  prompts[i].unsqueeze(0) if prompts is not None else None,
+                                                  bert_feature[i].unsqueeze(0),
+                                                  top_k,
+                                                  top_p,
+                                                  early_stop_num,
+                                                  temperature,
+                                                  repetition_penalty,
+                                                  **kwargs)
+            y_list.append(y[0])
+            idx_list.append(idx)
+            accepted += accepted_item
+            proposed += proposed_item
+
+        print(f"Speculative decoding acceptance rate: {accepted}/{proposed} ({accepted / max(proposed, 1):.2%})")
+        if return_acceptance:
+            return y_list, idx_list, (accepted, proposed)
+        return y_list, idx_list
+
+    def infer_speculative(
+        self,
+        x:torch.LongTensor,  #####全部文本token
+        prompts:torch.LongTensor,  ####参考音频token
+        bert_feature:torch.LongTensor,
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        draft_layers: int = 0,
+        num_draft_tokens: int = 4,
+        **kwargs
+    ):
+        draft_layers = draft_layers if draft_layers > 0 else max(1, self.num_layers // 4)
+        sampling_kwargs = dict(top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature)
+        prompt_prefix:T2SPrefix = kwargs.get("prompt_prefix", None)
+        # returns True when the caller gives up on the request, the tokens accepted so far are returned
+        should_stop = kwargs.get("should_stop", None)
+        x = self.embed_text(x, bert_feature, prompt_prefix)
+
+        # AR Decoder
+        y = prompts
+        x_len = x.shape[1]
+        if y is not None:
+            y_len = y.shape[1]
+            prefix_len = y.shape[1]
+            if prompt_prefix is not None and prompt_prefix.y_pos is not None:
+                y_pos = prompt_prefix.y_pos
+            else:
+                y_pos = self.ar_audio_position(self.ar_audio_embedding(y))
+            xy_pos = torch.concat([x, y_pos], dim=1)
+            ref_free = False
+        else:
+            y_len = 0
+            prefix_len = 0
+            xy_pos = x
+            y = torch.zeros(x.shape[0], 0, dtype=torch.int, device=x.device)
+            ref_free = True
+
+        src_len = x_len + y_len
+        x_attn_mask_pad = F.pad(
+            torch.zeros((x_len, x_len), dtype=torch.bool),
+            (0, y_len),  ###xx的纯0扩展到xx纯0+xy纯1，(x,x+y)
+            value=True,
+        )
+        y_attn_mask = F.pad(  ###yy的右上1扩展到左边xy的0,(y,x+y)
+            torch.triu(torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1),
+            (x_len, 0),
+            value=False,
+        )
+        xy_attn_mask = torch.concat([x_attn_mask_pad, y_attn_mask], dim=0)\
+                                                .view(1, 1, src_len, src_len)\
+                                                .expand(-1, self.num_head, -1, -1)\
+                                                .to(device=x.device)
+        kv_cache_len = self.get_kv_cache_len(src_len, early_stop_num) + num_draft_tokens + 1
+
+        ###################  first step ##########################
+        xy_dec, kv_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None, True, kv_cache_len)
+        logits = self.ar_predict_layer(xy_dec[:, -1])[:, :-1]
+        samples = sample(logits, y, **sampling_kwargs)[0]
+        y = torch.concat([y, samples], dim=1)
+
+        draft_cache = T2SKVCache(kv_cache_len)
+        for i in range(draft_layers):
+            draft_cache.prefill(kv_cache.k_caches[i].narrow(1, 0, src_len), kv_cache.v_caches[i].narrow(1, 0, src_len))
+
+        # cache position c holds text token c (c < x_len) or semantic token y[:, c - x_len],
+        # so the token at cache position kv_cache.kv_len is always y[:, -1]
+        accepted = 0
+        proposed = 0
+        stop = early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num
+        while not stop and y.shape[1] - prefix_len < 1500:
+            if should_stop is not None and should_stop():
+                break
+            n = y.shape[1] - prefix_len  # 已生成的token数
+            k = min(num_draft_tokens, 1500 - n - 1)
+
+            # draft: catch the draft cache up with the accepted tokens, then propose k tokens
+            while draft_cache.kv_len < kv_cache.kv_len:
+                pos = draft_cache.kv_len - x_len
+                self.t2s_transformer.decode_next_token(self.embed_semantic(y[:, pos:pos + 1], pos), draft_cache, None, True, draft_layers)
+            draft_tokens = []
+            draft_probs = []
+            for j in range(k):
+                pos = y.shape[1] - 1 + j
+                token = y[:, -1:] if j == 0 else draft_tokens[-1]
+                draft_dec, draft_cache = self.t2s_transformer.decode_next_token(self.embed_semantic(token, pos), draft_cache, None, True, draft_layers)
+                logits = self.ar_predict_layer(draft_dec[:, -1])
+                if n + j < 11:  ###至少预测出10个token不然不给停止（0.4s）
+                    logits = logits[:, :-1]
+                probs = logits_to_probs(logits, torch.concat([y] + draft_tokens, dim=1), **sampling_kwargs)
+                draft_tokens.append(multinomial_sample_one_no_sync(probs))
+                draft_probs.append(probs)
+
+            # verify: one forward pass of the full model over the last token and the k draft tokens
+            tokens = torch.concat([y[:, -1:]] + draft_tokens, dim=1)
+            kv_len = kv_cache.kv_len
+            attn_mask = F.pad(
+                torch.triu(torch.ones(k + 1, k + 1, dtype=torch.bool), diagonal=1),
+                (kv_len, 0),
+                value=False,
+            ).view(1, 1, k + 1, kv_len + k + 1).to(device=x.device)
+            xy_dec, kv_cache = self.t2s_transformer.decode_next_token(self.embed_semantic(tokens, y.shape[1] - 1), kv_cache, attn_mask, False)
+            all_logits = self.ar_predict_layer(xy_dec)
+
+            new_tokens = []
+            for j in range(k + 1):
+                logits = all_logits[:, j]
+                if n + j < 11:
+                    logits = logits[:, :-1]
+                probs = logits_to_probs(logits, torch.concat([y] + new_tokens, dim=1), **sampling_kwargs)
+                rejected = False
+                if j < k:
+                    proposed += 1
+                    token = draft_tokens[j]
+                    ratio = probs[0, token[0, 0]] / draft_probs[j][0, token[0, 0]]
+                    if torch.rand(1).item() < ratio.item():
+                        accepted += 1
+                    else:
+                        token = sample_residual(probs, draft_probs[j])
+                        rejected = True
+                else:
+                    token = multinomial_sample_one_no_sync(probs)
+                new_tokens.append(token)
+
+                if early_stop_num != -1 and (y.shape[1] + len(new_tokens) - prefix_len) > early_stop_num:
+                    print("use early stop num:", early_stop_num)
+                    stop = True
+                if torch.argmax(logits, dim=-1)[0] == self.EOS or token[0, 0] == self.EOS:
+                    stop = True
+                if stop or rejected:
+                    break
+
+            y = torch.concat([y] + new_tokens, dim=1)
+            kv_cache.truncate(x_len + y.shape[1] - 1)
+            draft_cache.truncate(x_len + y.shape[1] - 1)
+
+        if y.shape[1] == 0:
+            y = torch.concat([y, torch.zeros_like(samples)], dim=1)
+            print("bad zero prediction")
+        print(f"T2S Decoding EOS [{prefix_len} -> {y.shape[1]}]")
+        idx = y.shape[1] - prefix_len - 1
+        if ref_free:
+            return y[:, :-1], 0, accepted, proposed
+        return y[:, :-1], idx - 1, accepted, proposed
+
+    def embed_semantic(self, y:torch.Tensor, pos:int)->torch.Tensor:
+        # semantic tokens y [B, n] at positions pos .. pos + n - 1 of the audio sequence
+        y_emb = self.ar_audio_embedding(y)
+        pe = self.ar_audio_position.pe[:, pos:pos + y.shape[1]].to(dtype=y_emb.dtype, device=y_emb.device)
+        return y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * pe
+
+    
     def infer_panel(
         self,
         x:torch.LongTensor,  #####全部文本token
@@ -0,0 +1,104 @@
+"""
+Cache of the reference-prompt part of the T2S prefill input.
+
+Every request against the same reference clip starts its prefill with the same reference phones,
+reference BERT features and prompt semantic tokens. `T2SPrefix` holds that part of `xy_pos` after
+embedding, BERT projection and positional encoding, so `Text2SemanticDecoder` only has to embed the
+target text.
+
+The per-layer keys/values of the reference part can not be reused: the text tokens attend to each
+other bidirectionally and the prompt semantic tokens attend to the whole text, so they depend on the
+target text as well.
+
+Entries are keyed on the t2s weights and on an id of the reference the caller already has (the prompt
+cache key in TTS, the reference audio hash and text in the webui). Hashing the tensors instead would
+copy them to the cpu on every request, which costs more than the embedding it saves.
+"""
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+import torch
+
+
+class T2SPrefix:
+    def __init__(self, ref_len: int, x: torch.Tensor, y_pos: Optional[torch.Tensor]):
+        self.ref_len = ref_len  # number of reference phones at the start of x
+        self.x = x              # [1, ref_len, hidden], positioned reference text embeddings
+        self.y_pos = y_pos      # [1, y_len, hidden], positioned prompt semantic embeddings
+
+    @property
+    def nbytes(self) -> int:
+        nbytes = self.x.numel() * self.x.element_size()
+        if self.y_pos is not None:
+            nbytes += self.y_pos.numel() * self.y_pos.element_size()
+        return nbytes
+
+
+class T2SPrefixCache:
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(weights_id: str, reference_id: Hashable) -> tuple:
+        return (weights_id, reference_id)
+
+    def get(self, key: tuple) -> Optional[T2SPrefix]:
+        with self._lock:
+            prefix = self._entries.get(key)
+            if prefix is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return prefix
+
+    def put(self, key: tuple, prefix: T2SPrefix):
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key).nbytes
+            if prefix.nbytes > self.max_bytes:
+                return
+            self._entries[key] = prefix
+            self.nbytes += prefix.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def get_prefix(
+        self,
+        model,
+        weights_id: str,
+        reference_id: Optional[Hashable],
+        phones: torch.LongTensor,
+        bert_feature: torch.Tensor,
+        prompt: Optional[torch.LongTensor],
+    ) -> T2SPrefix:
+        '''
+            Return the cached prefix for this reference, embedding it with `model` on a miss.
+            Args:
+                model: Text2SemanticDecoder.
+                weights_id: str, identifies the loaded t2s weights (e.g. the weights path).
+                reference_id: identifies the phones, BERT features and prompt below, None to embed them without caching.
+                phones: LongTensor [ref_len], reference phone ids.
+                bert_feature: Tensor [1024, ref_len], reference BERT features.
+                prompt: LongTensor [1, y_len], reference semantic tokens, or None for ref-free decoding.
+        '''
+        if reference_id is None:
+            return model.embed_prompt_prefix(phones, bert_feature, prompt)
+        key = self.make_key(weights_id, reference_id)
+        prefix = self.get(key)
+        if prefix is None:
+            prefix = model.embed_prompt_prefix(phones, bert_feature, prompt)
+            self.put(key, prefix)
+        return prefix
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
@@ -0,0 +1,97 @@
+"""
+Opt-in CPU quantization of the T2S decoder.
+
+- "int8": dynamic int8 quantization (`torch.ao.quantization.quantize_dynamic`) of every linear layer used
+  at inference: qkv/out projections and MLP of the T2S blocks, `ar_predict_layer` and `bert_proj`.
+  Weights are stored as int8, activations are quantized on the fly, so the layers take float32 input.
+  The embeddings stay in float32: dynamic quantization has no kernel for lookups, and they are only
+  read once per token.
+- "bf16": all weights, embeddings included, are cast to bfloat16. Only fast on CPUs with native bf16
+  support (AVX512-BF16 / AMX); elsewhere it mostly saves memory.
+
+The blocks of `Text2SemanticDecoder.t2s_transformer` are plain classes holding references to the
+weights of `h`, so the int8 mode swaps them for subclasses that run quantized linear modules instead.
+"""
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from .t2s_model import T2SBlock, T2SMLP, T2STransformer
+
+
+T2S_QUANTIZATION_MODES = ["int8", "bf16"]
+
+
+def int8_linear(weight: torch.Tensor, bias: torch.Tensor) -> nn.Module:
+    linear = nn.Linear(weight.shape[1], weight.shape[0])
+    linear.weight = nn.Parameter(weight.detach().float(), requires_grad=False)
+    linear.bias = nn.Parameter(bias.detach().float(), requires_grad=False)
+    return torch.ao.quantization.quantize_dynamic(nn.Sequential(linear), {nn.Linear}, dtype=torch.qint8)[0]
+
+
+class T2SMLPInt8(T2SMLP):
+    def __init__(self, mlp: T2SMLP):
+        super().__init__(mlp.w1, mlp.b1, mlp.w2, mlp.b2)
+        self.int8_linear1 = int8_linear(mlp.w1, mlp.b1)
+        self.int8_linear2 = int8_linear(mlp.w2, mlp.b2)
+
+    def linear1(self, x: torch.Tensor):
+        return self.int8_linear1(x)
+
+    def linear2(self, x: torch.Tensor):
+        return self.int8_linear2(x)
+
+    def forward(self, x):
+        return self.int8_linear2(F.relu(self.int8_linear1(x)))
+
+
+class T2SBlockInt8(T2SBlock):
+    def __init__(self, block: T2SBlock):
+        super().__init__(
+            block.num_heads,
+            block.hidden_dim,
+            T2SMLPInt8(block.mlp),
+            block.qkv_w,
+            block.qkv_b,
+            block.out_w,
+            block.out_b,
+            block.norm_w1,
+            block.norm_b1,
+            block.norm_eps1,
+            block.norm_w2,
+            block.norm_b2,
+            block.norm_eps2,
+        )
+        self.int8_qkv = int8_linear(block.qkv_w, block.qkv_b)
+        self.int8_out = int8_linear(block.out_w, block.out_b)
+
+    def qkv_proj(self, x: torch.Tensor):
+        return self.int8_qkv(x)
+
+    def out_proj(self, x: torch.Tensor):
+        return self.int8_out(x)
+
+
+def quantize_t2s_model(model, mode: str):
+    '''
+        Quantize a Text2SemanticDecoder in place for CPU inference.
+        Args:
+            model: Text2SemanticDecoder on cpu, in eval mode.
+            mode: "int8" or "bf16".
+    '''
+    if mode == "bf16":
+        # the T2S blocks hold the same Parameter objects as model.h, so they follow the cast
+        return model.to(torch.bfloat16)
+
+    if mode == "int8":
+        model = model.float()
+        torch.ao.quantization.quantize_dynamic(
+            model, {"ar_predict_layer", "bert_proj"}, dtype=torch.qint8, inplace=True
+        )
+        blocks = [T2SBlockInt8(block) for block in model.t2s_transformer.blocks]
+        model.t2s_transformer = T2STransformer(model.num_layers, blocks)
+        # the compiled static decode step captured the float blocks
+        model.compiled_decode_step_static = None
+        return model
+
+    raise ValueError(f"Unsupported t2s quantization mode: {mode}, expected one of {T2S_QUANTIZATION_MODES}")
@@ -0,0 +1,114 @@
+"""
+Batched sampler for the T2S decoder with per-row sampling params.
+
+Produces the same distribution as `utils.sample` (repetition penalty, top_p on the full-vocab
+probabilities, temperature, top_k) with fewer full-vocab passes:
+- the repetition penalty comes from a running token-count tensor (`RepetitionPenaltyState`), updated
+  with the emitted tokens, instead of gathering/scattering the whole history every step;
+- top_k runs first, top_p is then applied to the k survivors only. The probabilities top_p needs are
+  taken relative to the logsumexp over the full vocab, so no full sort is required.
+"""
+from typing import List, Tuple, Union
+
+import torch
+
+from .utils import RepetitionPenaltyState
+
+
+Param = Union[int, float, List[int], List[float], torch.Tensor]
+
+
+class T2SSampler:
+    def __init__(
+        self,
+        batch_size: int,
+        vocab_size: int,
+        device: torch.device,
+        top_k: Param = 15,
+        top_p: Param = 1.0,
+        temperature: Param = 1.0,
+        repetition_penalty: Param = 1.35,
+    ):
+        '''
+            Args:
+                top_k, top_p, temperature, repetition_penalty: a single value for all rows or one value per row.
+                A top_k <= 0 disables top_k, like a top_p >= 1 disables top_p.
+        '''
+        self.batch_size = batch_size
+        self.vocab_size = vocab_size
+        self.device = device
+
+        self.top_k = self._param(top_k, torch.long)
+        self.top_k = torch.where(self.top_k > 0, self.top_k.clamp(max=vocab_size), vocab_size)
+        self.top_p = self._param(top_p, torch.float32)
+        self.temperature = self._param(temperature, torch.float32).clamp(min=1e-5)
+        self.max_top_k = int(self.top_k.max())
+
+        self.penalty = RepetitionPenaltyState(None, batch_size, vocab_size, self._param(repetition_penalty, torch.float32), device)
+        self._rank = torch.arange(self.max_top_k, device=device).unsqueeze(0)
+        self._noise = torch.empty(batch_size, self.max_top_k, dtype=torch.float32, device=device)
+
+    def _param(self, value: Param, dtype: torch.dtype) -> torch.Tensor:
+        if isinstance(value, torch.Tensor):
+            value = value.to(dtype=dtype, device=self.device).view(-1, 1)
+        elif isinstance(value, (list, tuple)):
+            value = torch.tensor(value, dtype=dtype, device=self.device).view(-1, 1)
+        else:
+            value = torch.full((self.batch_size, 1), value, dtype=dtype, device=self.device)
+        assert value.shape[0] == self.batch_size
+        return value
+
+    def update(self, tokens: torch.Tensor):
+        '''
+            Count emitted (or prompt) tokens for the repetition penalty.
+            tokens: [B, n]
+        '''
+        self.penalty.update(tokens)
+
+    def index_select(self, index: torch.Tensor):
+        '''
+            Keep only the rows in index, e.g. after sequences reached EOS.
+        '''
+        self.batch_size = index.shape[0]
+        self.top_k = torch.index_select(self.top_k, 0, index)
+        self.top_p = torch.index_select(self.top_p, 0, index)
+        self.temperature = torch.index_select(self.temperature, 0, index)
+        self.penalty.index_select(index)
+        self._noise = self._noise[:self.batch_size]
+
+    def sample(self, logits: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''
+            Args:
+                logits: [B, V'] with V' <= vocab_size, the repetition penalty is applied in place like in utils.sample.
+            Returns:
+                samples: IntTensor [B, 1], tokens: LongTensor [B], the argmax of the penalized logits.
+        '''
+        logits = self.penalty.apply_(logits.float())
+        k = min(self.max_top_k, logits.shape[1])
+        values, indices = torch.topk(logits, k, dim=-1)
+
+        # top_p is defined on the probabilities over the full vocab (before temperature)
+        cum_probs = torch.cumsum(torch.exp(values - torch.logsumexp(logits, dim=-1, keepdim=True)), dim=-1)
+        remove = (cum_probs > self.top_p) & (self.top_p < 1.0)
+        remove[:, 0] = False  # keep at least one option
+        remove |= self._rank[:, :k] >= self.top_k
+
+        values = (values / self.temperature).masked_fill(remove, -float("Inf"))
+        probs = torch.softmax(values, dim=-1)
+        noise = self._noise[:, :k].exponential_(1)
+        choice = torch.argmax(probs / noise, dim=-1, keepdim=True)
+        samples = torch.gather(indices, 1, choice).to(dtype=torch.int)
+        return samples, indices[:, 0]
+
+    def cat(self, other: "T2SSampler"):
+        '''
+            Append the rows of another sampler, e.g. sequences joining a running batch.
+        '''
+        self.batch_size += other.batch_size
+        self.top_k = torch.concat([self.top_k, other.top_k], dim=0)
+        self.top_p = torch.concat([self.top_p, other.top_p], dim=0)
+        self.temperature = torch.concat([self.temperature, other.temperature], dim=0)
+        self.penalty.cat(other.penalty)
+        self.max_top_k = int(self.top_k.max())
+        self._rank = torch.arange(self.max_top_k, device=self.device).unsqueeze(0)
+        self._noise = torch.empty(self.batch_size, self.max_top_k, dtype=torch.float32, device=self.device)
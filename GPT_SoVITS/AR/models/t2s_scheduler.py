@@ -0,0 +1,360 @@
+"""
+Continuous (in-flight) batching for the Text2Semantic decoder.
+
+`infer_panel_batch_infer` only batches the segments of a single request and keeps decoding until the
+slowest row is done. `T2SScheduler` instead runs one decode loop in a background thread. Sequences
+from any caller are prefilled on their own (`process_prompt`, batch size 1) and join the shared
+batch at the next token boundary; sequences that reach EOS leave the batch immediately and their
+futures are resolved.
+
+Rows in the shared batch have different prompt lengths. Their key/value caches are left-padded to a
+common length and a key padding mask hides the padding, so every row writes its next key/value at
+the same cache column.
+"""
+import threading
+from collections import deque
+from concurrent.futures import Future, InvalidStateError, wait
+from typing import List, Optional
+
+import torch
+from torch.nn import functional as F
+
+from .t2s_model import T2SKVCache, Text2SemanticDecoder
+from .t2s_prefix_cache import T2SPrefix
+from .t2s_sampler import T2SSampler
+
+
+class T2SSequence:
+    def __init__(
+        self,
+        x: torch.LongTensor,
+        prompt: Optional[torch.LongTensor],
+        bert_feature: torch.Tensor,
+        top_k: int,
+        top_p: float,
+        temperature: float,
+        repetition_penalty: float,
+        early_stop_num: int,
+        prompt_prefix: Optional[T2SPrefix] = None,
+    ):
+        self.x = x
+        self.prompt = prompt
+        self.bert_feature = bert_feature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+        self.early_stop_num = early_stop_num
+        self.prompt_prefix = prompt_prefix
+        # like infer_panel_batch_infer, ref-free sequences resolve with idx 0
+        self.ref_free = prompt is None
+        self.future: Future = Future()
+
+        self.y: torch.LongTensor = None
+        self.y_len: int = 0
+        self.prefix_len: int = 0
+        self.idx: int = 0
+        self.cancelled: bool = False
+
+
+class T2SScheduler:
+    def __init__(self, model: Text2SemanticDecoder, max_batch_size: int = 16, cache_chunk: int = 256):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.cache_chunk = cache_chunk
+
+        self.pending: deque = deque()
+        self.active: List[T2SSequence] = []
+        self.kv_cache: T2SKVCache = None
+        self.key_padding_mask: torch.Tensor = None
+        self.xy_pos: torch.Tensor = None
+        self.sampler: T2SSampler = None
+
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._loop, name="T2SScheduler", daemon=True)
+        self.thread.start()
+
+    def submit(
+        self,
+        x: torch.LongTensor,
+        prompt: Optional[torch.LongTensor],
+        bert_feature: torch.Tensor,
+        top_k: int = -100,
+        top_p: float = 100,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        early_stop_num: int = -1,
+        prompt_prefix: Optional[T2SPrefix] = None,
+    ) -> Future:
+        '''
+            Queue one sequence for decoding.
+            Args:
+                x: LongTensor [x_len], phoneme ids (prompt text + target text).
+                prompt: LongTensor [y_len] of reference semantic tokens, or None for ref-free decoding.
+                bert_feature: Tensor [1024, x_len].
+                prompt_prefix: cached reference part of the prefill input, see T2SPrefixCache.
+            Returns:
+                Future resolving to (pred_semantic, idx), matching one row of `infer_panel_batch_infer`.
+        '''
+        seq = T2SSequence(x, prompt, bert_feature, top_k, top_p, temperature, repetition_penalty, early_stop_num, prompt_prefix)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("T2SScheduler is closed")
+            self.pending.append(seq)
+            self.condition.notify()
+        return seq.future
+
+    def infer_panel(
+        self,
+        x: List[torch.LongTensor],
+        x_lens: torch.LongTensor,
+        prompts: torch.LongTensor,
+        bert_feature: List[torch.LongTensor],
+        top_k: int = -100,
+        top_p: int = 100,
+        early_stop_num: int = -1,
+        temperature: float = 1.0,
+        repetition_penalty: float = 1.35,
+        **kwargs
+    ):
+        '''
+            Drop-in replacement for `Text2SemanticDecoder.infer_panel_batch_infer`.
+            Blocks until every row of the batch has been decoded, or until `should_stop()` (kwargs) returns
+            True: the rows are then cancelled and returned as (None, 0).
+        '''
+        should_stop = kwargs.get("should_stop", None)
+        futures = []
+        for i in range(len(x)):
+            futures.append(self.submit(
+                x[i][:x_lens[i]],
+                prompts[i] if prompts is not None else None,
+                bert_feature[i],
+                top_k=top_k,
+                top_p=top_p,
+                temperature=temperature,
+                repetition_penalty=repetition_penalty,
+                early_stop_num=early_stop_num,
+                prompt_prefix=kwargs.get("prompt_prefix", None),
+            ))
+        if should_stop is not None:
+            while len(wait(futures, timeout=0.05).not_done) > 0:
+                if should_stop():
+                    for future in futures:
+                        self.cancel(future)
+                    return [None] * len(futures), [0] * len(futures)
+        y_list = []
+        idx_list = []
+        for future in futures:
+            y, idx = future.result()
+            y_list.append(y)
+            idx_list.append(idx)
+        return y_list, idx_list
+
+    def cancel(self, future: Future):
+        with self.condition:
+            for seq in list(self.pending) + self.active:
+                if seq.future is future:
+                    seq.cancelled = True
+
+    def close(self):
+        '''
+            Stop the decode loop. Sequences that are still queued or decoding fail with RuntimeError, so that
+            callers waiting on their futures do not hang.
+        '''
+        with self.condition:
+            self.closed = True
+            self._fail(list(self.pending) + self.active, RuntimeError("T2SScheduler is closed"))
+            self.condition.notify()
+        self.thread.join()
+
+    @staticmethod
+    def _fail(seqs: List[T2SSequence], exception: BaseException):
+        for seq in seqs:
+            try:
+                seq.future.set_exception(exception)
+            except InvalidStateError:  # resolved or cancelled meanwhile
+                pass
+
+    def _loop(self):
+        with torch.no_grad():
+            while True:
+                with self.condition:
+                    while not self.closed and len(self.pending) == 0 and len(self.active) == 0:
+                        self.condition.wait()
+                    if self.closed:
+                        break
+                    new_seqs = []
+                    while len(self.pending) > 0 and len(self.active) + len(new_seqs) < self.max_batch_size:
+                        new_seqs.append(self.pending.popleft())
+                try:
+                    for seq in new_seqs:
+                        if seq.cancelled or seq.future.done():
+                            seq.future.cancel()
+                            continue
+                        self._prefill(seq)
+                    if len(self.active) > 0:
+                        self._decode_step()
+                except Exception as e:
+                    self._fail(self.active + new_seqs, e)
+                    self._reset()
+
+        self._fail(list(self.pending) + self.active, RuntimeError("T2SScheduler is closed"))
+
+    def _reset(self):
+        self.active = []
+        self.kv_cache = None
+        self.key_padding_mask = None
+        self.xy_pos = None
+        self.sampler = None
+
+    def _prefill(self, seq: T2SSequence):
+        model = self.model
+        x = model.embed_text(seq.x.unsqueeze(0), seq.bert_feature.unsqueeze(0), seq.prompt_prefix)
+        x_len = x.shape[1]
+
+        if seq.prompt is not None:
+            y = seq.prompt.unsqueeze(0)
+            if seq.prompt_prefix is not None and seq.prompt_prefix.y_pos is not None:
+                y_pos = seq.prompt_prefix.y_pos
+            else:
+                y_pos = model.ar_audio_position(model.ar_audio_embedding(y))
+            y_len = y_pos.shape[1]
+            xy_pos = torch.concat([x, y_pos], dim=1)
+        else:
+            y = torch.zeros(1, 0, dtype=torch.int, device=x.device)
+            y_len = 0
+            xy_pos = x
+
+        src_len = x_len + y_len
+        x_attn_mask = F.pad(
+            torch.zeros((x_len, x_len), dtype=torch.bool),
+            (0, y_len),
+            value=True,
+        )
+        y_attn_mask = F.pad(
+            torch.triu(torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1),
+            (x_len, 0),
+            value=False,
+        )
+        xy_attn_mask = torch.concat([x_attn_mask, y_attn_mask], dim=0)\
+                                .view(1, 1, src_len, src_len)\
+                                .expand(-1, model.num_head, -1, -1)\
+                                .to(device=x.device)
+
+        xy_dec, kv_cache = model.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None, True)
+        # the first token is never allowed to be EOS
+        logits = model.ar_predict_layer(xy_dec[:, -1])[:, :-1]
+        sampler = T2SSampler(1, model.vocab_size, x.device, seq.top_k, seq.top_p, seq.temperature, seq.repetition_penalty)
+        sampler.update(y)
+        samples, _ = sampler.sample(logits)
+        sampler.update(samples)
+
+        seq.y = torch.concat([y[0], samples[0].to(y.dtype)])
+        seq.y_len = y_len
+        seq.prefix_len = y_len
+        seq.idx = 0
+        if self._finished(seq, samples[0, 0].item(), -1):
+            return
+
+        y_emb = model.ar_audio_embedding(samples[:, -1:])
+        xy_pos = y_emb * model.ar_audio_position.x_scale \
+                 + model.ar_audio_position.alpha * model.ar_audio_position.pe[:, y_len].to(dtype=y_emb.dtype, device=y_emb.device)
+        self._join(seq, kv_cache, xy_pos, sampler)
+
+    def _join(self, seq: T2SSequence, kv_cache: T2SKVCache, xy_pos: torch.Tensor, sampler: T2SSampler):
+        new_len = kv_cache.kv_len
+        new_k_caches = [k.narrow(1, 0, new_len) for k in kv_cache.k_caches]
+        new_v_caches = [v.narrow(1, 0, new_len) for v in kv_cache.v_caches]
+        new_mask = torch.zeros(1, new_len, dtype=torch.bool, device=xy_pos.device)
+
+        if len(self.active) == 0:
+            kv_len = new_len
+            k_caches, v_caches, key_padding_mask = new_k_caches, new_v_caches, new_mask
+            self.xy_pos = xy_pos
+            self.sampler = sampler
+        else:
+            old_len = self.kv_cache.kv_len
+            kv_len = max(old_len, new_len)
+            k_caches = [
+                torch.concat([F.pad(old.narrow(1, 0, old_len), (0, 0, kv_len - old_len, 0)),
+                              F.pad(new, (0, 0, kv_len - new_len, 0))], dim=0)
+                for old, new in zip(self.kv_cache.k_caches, new_k_caches)
+            ]
+            v_caches = [
+                torch.concat([F.pad(old.narrow(1, 0, old_len), (0, 0, kv_len - old_len, 0)),
+                              F.pad(new, (0, 0, kv_len - new_len, 0))], dim=0)
+                for old, new in zip(self.kv_cache.v_caches, new_v_caches)
+            ]
+            key_padding_mask = torch.concat([
+                F.pad(self.key_padding_mask.narrow(1, 0, old_len), (kv_len - old_len, 0), value=True),
+                F.pad(new_mask, (kv_len - new_len, 0), value=True),
+            ], dim=0)
+            self.xy_pos = torch.concat([self.xy_pos, xy_pos], dim=0)
+            self.sampler.cat(sampler)
+
+        max_len = kv_len + self.cache_chunk
+        self.kv_cache = T2SKVCache(max_len)
+        for k, v in zip(k_caches, v_caches):
+            self.kv_cache.prefill(k, v)
+        self.key_padding_mask = F.pad(key_padding_mask, (0, max_len - kv_len), value=False)
+        self.active.append(seq)
+
+    def _decode_step(self):
+        model = self.model
+        bsz = len(self.active)
+        kv_len = self.kv_cache.kv_len
+        if kv_len + 1 > self.key_padding_mask.shape[1]:
+            self.key_padding_mask = F.pad(self.key_padding_mask, (0, self.cache_chunk), value=False)
+        attn_mask = self.key_padding_mask.narrow(1, 0, kv_len + 1).view(bsz, 1, 1, kv_len + 1)
+
+        xy_dec, self.kv_cache = model.t2s_transformer.decode_next_token(self.xy_pos, self.kv_cache, attn_mask, False)
+        logits = model.ar_predict_layer(xy_dec[:, -1])
+        samples, tokens = self.sampler.sample(logits)
+        self.sampler.update(samples)
+
+        sample_list = samples[:, 0].tolist()
+        token_list = tokens.tolist()
+        keep = []
+        for i, seq in enumerate(self.active):
+            seq.idx += 1
+            seq.y = torch.concat([seq.y, samples[i].to(seq.y.dtype)])
+            if not self._finished(seq, sample_list[i], token_list[i]):
+                keep.append(i)
+
+        if len(keep) == 0:
+            self._reset()
+            return
+        if len(keep) < bsz:
+            index = torch.LongTensor(keep).to(samples.device)
+            samples = torch.index_select(samples, dim=0, index=index)
+            self.kv_cache.index_select(index)
+            self.key_padding_mask = torch.index_select(self.key_padding_mask, dim=0, index=index)
+            self.sampler.index_select(index)
+            self.active = [self.active[i] for i in keep]
+
+        y_emb = model.ar_audio_embedding(samples)
+        positions = torch.LongTensor([seq.y_len + seq.idx for seq in self.active]).to(y_emb.device)
+        pe = model.ar_audio_position.pe[0].to(dtype=y_emb.dtype, device=y_emb.device)
+        self.xy_pos = y_emb * model.ar_audio_position.x_scale \
+                      + model.ar_audio_position.alpha * torch.index_select(pe, dim=0, index=positions).unsqueeze(1)
+
+    def _finished(self, seq: T2SSequence, sample: int, token: int) -> bool:
+        if seq.cancelled or seq.future.done():  # done: failed by close()
+            seq.future.cancel()
+            return True
+        if sample == self.model.EOS or token == self.model.EOS:
+            self._resolve(seq, (seq.y[:-1], 0 if seq.ref_free else seq.idx - 1))
+            return True
+        if (seq.early_stop_num != -1 and (seq.y.shape[0] - seq.prefix_len) > seq.early_stop_num) or seq.idx == 1499:
+            print("use early stop num:", seq.early_stop_num)
+            self._resolve(seq, (seq.y[:-1], 0 if seq.ref_free else seq.idx))
+            return True
+        return False
+
+    @staticmethod
+    def _resolve(seq: T2SSequence, result):
+        try:
+            seq.future.set_result(result)
+        except InvalidStateError:  # failed by close() during the decode step
+            pass
@@ -96,7 +96,7 @@ def topk_sampling(logits, top_k=10, top_p=1.0, temperature=1.0):
     return token
 
 
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Union
 
 
 def multinomial_sample_one_no_sync(
@@ -149,6 +149,70 @@ def logits_to_probs(
     return probs
 
 
+class RepetitionPenaltyState:
+    """
+    Per-row token counts over the semantic vocab for the repetition penalty.
+
+    `logits_to_probs` gathers and scatters over the whole history `y` every step. Here the emitted tokens
+    are counted once with `update` and `apply_` penalizes every seen token with one vectorized multiply.
+    """
+    def __init__(
+        self,
+        tokens: Optional[torch.Tensor],
+        batch_size: int,
+        vocab_size: int,
+        penalty: Union[float, torch.Tensor],
+        device: torch.device,
+    ):
+        # penalty: float, or Tensor [B, 1] for per-row penalties
+        self.counts = torch.zeros(batch_size, vocab_size, dtype=torch.int32, device=device)
+        self.penalty = penalty
+        if tokens is not None:
+            self.update(tokens)
+
+    def update(self, tokens: torch.Tensor):
+        # tokens: [B, n]
+        tokens = tokens.long()
+        self.counts.scatter_add_(1, tokens, torch.ones_like(tokens, dtype=self.counts.dtype))
+
+    def index_select(self, index: torch.Tensor):
+        self.counts = torch.index_select(self.counts, 0, index)
+        if isinstance(self.penalty, torch.Tensor):
+            self.penalty = torch.index_select(self.penalty, 0, index)
+
+    def cat(self, other: "RepetitionPenaltyState"):
+        self.counts = torch.concat([self.counts, other.counts], dim=0)
+        if isinstance(self.penalty, torch.Tensor) or isinstance(other.penalty, torch.Tensor):
+            self.penalty = torch.concat([
+                state.penalty if isinstance(state.penalty, torch.Tensor)
+                else torch.full((state.counts.shape[0], 1), state.penalty, device=state.counts.device)
+                for state in (self, other)
+            ], dim=0)
+
+    def apply_(self, logits: torch.Tensor) -> torch.Tensor:
+        # in place, like the scatter_ in logits_to_probs. logits may exclude EOS: [B, V'] with V' <= vocab_size
+        if not isinstance(self.penalty, torch.Tensor) and self.penalty == 1.0:
+            return logits
+        presence = self.counts[:, :logits.shape[1]] > 0
+        penalty = self.penalty if isinstance(self.penalty, torch.Tensor) else torch.tensor(self.penalty, device=logits.device)
+        penalty = penalty.to(logits.dtype)
+        factor = torch.where(logits < 0, penalty, 1.0 / penalty)
+        return logits.mul_(torch.where(presence, factor, torch.ones_like(factor)))
+
+
+def sample_residual(
+    probs: torch.Tensor,
+    draft_probs: torch.Tensor,
+) -> torch.Tensor:
+    # speculative decoding: a rejected draft token is replaced by a sample from norm(max(p - q, 0)),
+    # which keeps the overall distribution equal to sampling from p
+    residual = torch.clamp(probs - draft_probs, min=0)
+    residual_sum = residual.sum(dim=-1, keepdim=True)
+    if residual_sum.min() <= 0:
+        return multinomial_sample_one_no_sync(probs)
+    return multinomial_sample_one_no_sync(residual / residual_sum)
+
+
 def sample(
     logits,
     previous_tokens: Optional[torch.Tensor] = None,
@@ -1,8 +1,9 @@
 import gc
-import math
+import itertools
 import os
 import random
 import sys
+import threading
 import traceback
 from copy import deepcopy
 from time import time as ttime
@@ -19,11 +20,20 @@ from transformers import AutoModelForMaskedLM, AutoTokenizer
 from GPT_SoVITS.tools.i18n.i18n import I18nAuto, scan_language_list
 from GPT_SoVITS.tools.my_utils import load_audio
 from ..AR.models.t2s_lightning_module import Text2SemanticLightningModule
+from ..AR.models.t2s_prefix_cache import T2SPrefixCache
+from ..AR.models.t2s_quantization import quantize_t2s_model
+from ..AR.models.t2s_scheduler import T2SScheduler
 from ..TTS_infer_pack.TextPreprocessor import TextPreprocessor
+from ..TTS_infer_pack.model_pool import ModelPool
+from ..TTS_infer_pack.prompt_cache import PromptCache, PromptEntry
+from ..TTS_infer_pack.token_streaming import stream_tokens, vocode_token_stream
 from ..TTS_infer_pack.text_segmentation_method import splits
 from ..feature_extractor.cnhubert import CNHubert
 from ..module.mel_processing import spectrogram_torch
 from ..module.models import SynthesizerTrn
+from ..module.prompt_store import PromptSemanticStore
+from ..module.ref_cache import RefCache
+from ..weights_io import load_weights
 
 language=os.environ.get("language","Auto")
 language=sys.argv[-1] if sys.argv[-1] in scan_language_list() else language
@@ -36,6 +46,13 @@ custom:
   cnhuhbert_base_path: GPT_SoVITS/pretrained_models/chinese-hubert-base
   device: cpu
   is_half: false
+  t2s_quantization: null  # cpu only, optional: int8 | bf16
+  ref_cache_dir: null  # optional, directory for the on-disk reference spec/ge cache
+  prompt_store_dir: null  # optional, directory for the persistent reference prompt semantic store
+  characters: {}  # optional, name -> {t2s_weights_path, vits_weights_path}, see TTS.use_character
+  model_pool_size: 4  # number of characters kept resident
+  model_pool_max_bytes: null  # optional, memory budget of the resident characters
+  pinned_characters: []  # characters that are never evicted
   t2s_weights_path: GPT_SoVITS/pretrained_models/gsv-v2final-pretrained/s1bert25hz-5kh-longer-epoch=12-step=369668.ckpt
   vits_weights_path: GPT_SoVITS/pretrained_models/gsv-v2final-pretrained/s2G2333k.pth
   version: v2
@@ -145,6 +162,13 @@ class TTS_Config:
         
         self.device = self.configs.get("device", torch.device("cpu"))
         self.is_half = self.configs.get("is_half", False)
+        self.t2s_quantization = self.configs.get("t2s_quantization", None)
+        self.ref_cache_dir = self.configs.get("ref_cache_dir", None)
+        self.prompt_store_dir = self.configs.get("prompt_store_dir", None)
+        self.characters = self.configs.get("characters", None) or {}
+        self.model_pool_size = self.configs.get("model_pool_size", 4)
+        self.model_pool_max_bytes = self.configs.get("model_pool_max_bytes", None)
+        self.pinned_characters = self.configs.get("pinned_characters", None) or []
         self.version = version
         self.t2s_weights_path = self.configs.get("t2s_weights_path", None)
         self.vits_weights_path = self.configs.get("vits_weights_path", None)
@@ -205,6 +229,13 @@ class TTS_Config:
         self.config = {
             "device"             : str(self.device),
             "is_half"            : self.is_half,
+            "t2s_quantization"   : self.t2s_quantization,
+            "ref_cache_dir"      : self.ref_cache_dir,
+            "prompt_store_dir"   : self.prompt_store_dir,
+            "characters"         : self.characters,
+            "model_pool_size"    : self.model_pool_size,
+            "model_pool_max_bytes": self.model_pool_max_bytes,
+            "pinned_characters"  : self.pinned_characters,
             "version"            : self.version,
             "t2s_weights_path"   : self.t2s_weights_path,
             "vits_weights_path"  : self.vits_weights_path,
@@ -244,9 +275,21 @@ class TTS:
         
         self.t2s_model:Text2SemanticLightningModule = None
         self.vits_model:SynthesizerTrn = None
+        self.models:dict = {}  # the default models and their settings, see get_models
         self.bert_tokenizer:AutoTokenizer = None
         self.bert_model:AutoModelForMaskedLM = None
         self.cnhuhbert_model:CNHubert = None
+        self.t2s_scheduler:T2SScheduler = None
+        self.t2s_prefix_cache:T2SPrefixCache = T2SPrefixCache()
+        self.ref_cache:RefCache = RefCache(disk_dir=self.configs.ref_cache_dir)
+        self.prompt_store:PromptSemanticStore = PromptSemanticStore(self.configs.prompt_store_dir)
+        self.prompt_cache:PromptCache = PromptCache()
+        self.default_ref_audio_path:str = None
+        self.model_pool:ModelPool = ModelPool(self._load_character,
+                                              self.configs.model_pool_size,
+                                              self.configs.model_pool_max_bytes)
+        for character in self.configs.pinned_characters:
+            self.model_pool.pin(character)
         
         self._init_models()
         
@@ -256,20 +299,10 @@ class TTS:
                                             self.configs.device)
         
         
-        self.prompt_cache:dict = {
-            "ref_audio_path" : None,
-            "prompt_semantic": None,
-            "refer_spec"     : [],
-            "prompt_text"    : None,
-            "prompt_lang"    : None,
-            "phones"         : None,
-            "bert_features"  : None,
-            "norm_text"      : None,
-            "aux_ref_audio_paths": [],
-        }
-        
-        
-        self.stop_flag:bool = False
+        # run key -> request_id of the runs in progress, and the keys of those asked to stop
+        self.running_requests:dict = {}
+        self.stopped_runs:set = set()
+        self.runs_lock = threading.Lock()
         self.precision:torch.dtype = torch.float16 if self.configs.is_half else torch.float32
 
     def _init_models(self,):
@@ -288,6 +321,7 @@ class TTS:
         self.cnhuhbert_model = self.cnhuhbert_model.to(self.configs.device)
         if self.configs.is_half and str(self.configs.device)!="cpu":
             self.cnhuhbert_model = self.cnhuhbert_model.half()
+        self.prompt_cache.clear()
         
         
         
@@ -299,31 +333,27 @@ class TTS:
         self.bert_model = self.bert_model.to(self.configs.device)
         if self.configs.is_half and str(self.configs.device)!="cpu":
             self.bert_model = self.bert_model.half()
+        self.prompt_cache.clear()
         
     def init_vits_weights(self, weights_path: str):
         print(f"Loading VITS weights from {weights_path}")
-        self.configs.vits_weights_path = weights_path
-        dict_s2 = torch.load(weights_path, map_location=self.configs.device)
+        self._use_vits_weights(self._load_vits_weights(weights_path))
+        self.prompt_cache.clear()
+
+    def _load_vits_weights(self, weights_path: str)->dict:
+        dict_s2 = load_weights(weights_path, map_location=self.configs.device)
         hps = dict_s2["config"]
         if dict_s2['weight']['enc_p.text_embedding.weight'].shape[0] == 322:
-            self.configs.update_version("v1")
+            version = "v1"
         else:
-            self.configs.update_version("v2")
-        self.configs.save_configs()
+            version = "v2"
         
-        hps["model"]["version"] = self.configs.version
-        self.configs.filter_length = hps["data"]["filter_length"]
-        self.configs.segment_size = hps["train"]["segment_size"]
-        self.configs.sampling_rate = hps["data"]["sampling_rate"]       
-        self.configs.hop_length = hps["data"]["hop_length"]
-        self.configs.win_length = hps["data"]["win_length"]
-        self.configs.n_speakers = hps["data"]["n_speakers"]
-        self.configs.semantic_frame_rate = "25hz"
+        hps["model"]["version"] = version
         kwargs = hps["model"]
         vits_model = SynthesizerTrn(
-            self.configs.filter_length // 2 + 1,
-            self.configs.segment_size // self.configs.hop_length,
-            n_speakers=self.configs.n_speakers,
+            hps["data"]["filter_length"] // 2 + 1,
+            hps["train"]["segment_size"] // hps["data"]["hop_length"],
+            n_speakers=hps["data"]["n_speakers"],
             **kwargs
         )
 
@@ -333,27 +363,117 @@ class TTS:
         vits_model = vits_model.to(self.configs.device)
         vits_model = vits_model.eval()
         vits_model.load_state_dict(dict_s2["weight"], strict=False)
-        self.vits_model = vits_model
         if self.configs.is_half and str(self.configs.device)!="cpu":
-            self.vits_model = self.vits_model.half()
+            vits_model = vits_model.half()
+        return {"vits_model": vits_model, "vits_weights_path": weights_path, "vits_hps": hps, "version": version}
+
+    def _use_vits_weights(self, models:dict, save:bool=True):
+        hps = models["vits_hps"]
+        self.configs.vits_weights_path = models["vits_weights_path"]
+        self.configs.update_version(models["version"])
+        if save:
+            self.configs.save_configs()
+        self.configs.filter_length = hps["data"]["filter_length"]
+        self.configs.segment_size = hps["train"]["segment_size"]
+        self.configs.sampling_rate = hps["data"]["sampling_rate"]       
+        self.configs.hop_length = hps["data"]["hop_length"]
+        self.configs.win_length = hps["data"]["win_length"]
+        self.configs.n_speakers = hps["data"]["n_speakers"]
+        self.configs.semantic_frame_rate = "25hz"
+        self.vits_model = models["vits_model"]
+        self.models.update({key: models[key] for key in ("vits_model", "vits_weights_path", "vits_hps", "version")})
 
         
     def init_t2s_weights(self, weights_path: str):
         print(f"Loading Text2Semantic weights from {weights_path}")
-        self.configs.t2s_weights_path = weights_path
-        self.configs.save_configs()
-        self.configs.hz = 50
-        dict_s1 = torch.load(weights_path, map_location=self.configs.device)
+        self._use_t2s_weights(self._load_t2s_weights(weights_path))
+        self.t2s_prefix_cache.clear()
+
+    def _load_t2s_weights(self, weights_path: str)->dict:
+        dict_s1 = load_weights(weights_path, map_location=self.configs.device)
         config = dict_s1["config"]
-        self.configs.max_sec = config["data"]["max_sec"]
         t2s_model = Text2SemanticLightningModule(config, "****", is_train=False)
         t2s_model.load_state_dict(dict_s1["weight"])
         t2s_model = t2s_model.to(self.configs.device)
         t2s_model = t2s_model.eval()
-        self.t2s_model = t2s_model
         if self.configs.is_half and str(self.configs.device)!="cpu":
-            self.t2s_model = self.t2s_model.half()
-        
+            t2s_model = t2s_model.half()
+        if self.configs.t2s_quantization and str(self.configs.device)=="cpu":
+            print(f"Quantizing Text2Semantic model: {self.configs.t2s_quantization}")
+            quantize_t2s_model(t2s_model.model, self.configs.t2s_quantization)
+        return {"t2s_model": t2s_model, "t2s_weights_path": weights_path, "max_sec": config["data"]["max_sec"]}
+
+    def _use_t2s_weights(self, models:dict, save:bool=True):
+        self.configs.t2s_weights_path = models["t2s_weights_path"]
+        if save:
+            self.configs.save_configs()
+        self.configs.hz = 50
+        self.configs.max_sec = models["max_sec"]
+        self.t2s_model = models["t2s_model"]
+        self.models.update({key: models[key] for key in ("t2s_model", "t2s_weights_path", "max_sec")})
+        if self.t2s_scheduler is not None:
+            self.enable_continuous_batching(True, self.t2s_scheduler.max_batch_size)
+
+    def _load_character(self, character:str)->dict:
+        paths = self.configs.characters[character]
+        print(f"Loading models of {character}")
+        models = self._load_t2s_weights(paths["t2s_weights_path"])
+        models.update(self._load_vits_weights(paths["vits_weights_path"]))
+        return models
+
+    def use_character(self, character:str):
+        '''
+            To make the GPT/SoVITS weights of a character (see `characters` in tts_infer.yaml) the default ones.
+                Recently used characters stay resident in the model pool, so switching back does not reload them.
+                The config file is not rewritten. Requests choose a character with the "character" input instead.
+            Args:
+                character: str, the name of the character.
+        '''
+        models = self.get_models(character)
+        if models["t2s_model"] is not self.t2s_model:
+            self._use_t2s_weights(models, save=False)
+        if models["vits_model"] is not self.vits_model:
+            self._use_vits_weights(models, save=False)
+
+    def get_models(self, character:str=None)->dict:
+        '''
+            The models a run uses and their settings: those of a character from the model pool, or the default ones.
+                Nothing shared is changed, so concurrent runs of different characters do not affect each other.
+            Args:
+                character: str, the name of the character, None for the default models.
+        '''
+        if character in [None, ""]:
+            return dict(self.models)
+        if character not in self.configs.characters:
+            raise ValueError(f"unknown character: {character}")
+        return self.model_pool.get(character)
+
+    def prefetch_character(self, character:str):
+        '''
+            To load the weights of a character into the model pool in the background, e.g. the next character
+                of a dialog while the current one is being synthesized.
+            Args:
+                character: str, the name of the character.
+        '''
+        if character not in self.configs.characters:
+            raise ValueError(f"unknown character: {character}")
+        return self.model_pool.prefetch(character)
+
+    def enable_continuous_batching(self, enable: bool = True, max_batch_size: int = 16):
+        '''
+            To decode the segments of concurrent requests in one shared batch.
+            Sequences join the batch as soon as they are prefilled and leave it when they reach EOS,
+            instead of waiting for the slowest segment of their own request.
+            Args:
+                enable: bool, whether to enable continuous batching.
+                max_batch_size: int, the maximum number of sequences decoded together.
+        '''
+        if self.t2s_scheduler is not None:
+            self.t2s_scheduler.close()
+            self.t2s_scheduler = None
+        if enable:
+            self.t2s_scheduler = T2SScheduler(self.t2s_model.model, max_batch_size)
+
     def enable_half_precision(self, enable: bool = True, save: bool = True):
         '''
             To enable half precision for the TTS model.
@@ -367,6 +487,9 @@ class TTS:
         
         self.configs.is_half = enable
         self.precision = torch.float16 if enable else torch.float32
+        self.model_pool.clear()
+        # cached prefixes are in the old precision
+        self.t2s_prefix_cache.clear()
         if save:
             self.configs.save_configs()
         if enable:
@@ -395,6 +518,9 @@ class TTS:
                 device: torch.device, the device to use for all models.
         '''
         self.configs.device = device
+        self.model_pool.clear()
+        # cached prefixes are on the old device
+        self.t2s_prefix_cache.clear()
         if save:
             self.configs.save_configs()
         if self.t2s_model is not None:
@@ -408,27 +534,69 @@ class TTS:
         
     def set_ref_audio(self, ref_audio_path:str):
         '''
-            To set the reference audio for the TTS model, 
-                including the prompt_semantic and refer_spepc.
+            To set the default reference audio, used by requests without ref_audio_path.
+                The prompt_semantic and refer_spepc of the audio are computed in advance.
             Args:
                 ref_audio_path: str, the path of the reference audio.
         '''
-        self._set_prompt_semantic(ref_audio_path)
-        self._set_ref_spec(ref_audio_path)
-        self._set_ref_audio_path(ref_audio_path)
-        
-    def _set_ref_audio_path(self, ref_audio_path):
-        self.prompt_cache["ref_audio_path"] = ref_audio_path 
+        self._get_prompt_semantic(ref_audio_path)
+        self._get_ref(ref_audio_path)
+        self.default_ref_audio_path = ref_audio_path
 
-    def _set_ref_spec(self, ref_audio_path):
-        spec = self._get_ref_spec(ref_audio_path)
-        if self.prompt_cache["refer_spec"] in [[],None]:
-            self.prompt_cache["refer_spec"]=[spec]
-        else:
-            self.prompt_cache["refer_spec"][0] = spec
+    def get_prompt_entry(self, ref_audio_path:str, aux_ref_audio_paths:list, prompt_text:str=None, prompt_lang:str=None, models:dict=None)->PromptEntry:
+        '''
+            Return the preprocessed reference of a request, from the prompt cache if it was used recently.
+            Args:
+                ref_audio_path: str, the path of the reference audio.
+                aux_ref_audio_paths: list, auxiliary reference audio paths for multi-speaker tone fusion.
+                prompt_text: str, the normalized prompt text, None for requests without prompt text.
+                prompt_lang: str, language of the prompt text.
+                models: dict, the models of the run (see get_models), None for the default models.
+        '''
+        models = self.models if models is None else models
+        _aux_ref_audio_paths = []
+        for path in aux_ref_audio_paths:
+            if path in [None, ""]:
+                continue
+            if not os.path.exists(path):
+                print(i18n("音频文件不存在，跳过：{}").format(path))
+                continue
+            _aux_ref_audio_paths.append(path)
+
+        key = self.prompt_cache.make_key(models["vits_weights_path"], ref_audio_path, _aux_ref_audio_paths, prompt_text, prompt_lang)
+        entry = self.prompt_cache.get(key)
+        if entry is not None:
+            return entry
+
+        ges = [self._get_ref(path, models).ge for path in [ref_audio_path] + _aux_ref_audio_paths]
+        entry = PromptEntry(
+            ref_audio_path,
+            _aux_ref_audio_paths,
+            self._get_prompt_semantic(ref_audio_path, models),
+            torch.stack(ges, 0).mean(0),  # same as SynthesizerTrn.get_ge of all the refer specs
+            key=key,
+        )
+        if prompt_text is not None:
+            phones, bert_features, norm_text = \
+                self.text_preprocessor.segment_and_extract_feature_for_text(
+                                                                    prompt_text, 
+                                                                    prompt_lang,
+                                                                    models["version"])
+            entry.prompt_text = prompt_text
+            entry.prompt_lang = prompt_lang
+            entry.phones = phones
+            entry.bert_features = bert_features
+            entry.norm_text = norm_text
+        self.prompt_cache.put(key, entry)
+        return entry
+
+    def _get_ref(self, ref_audio_path, models:dict=None):
+        models = self.models if models is None else models
+        hps = models["vits_hps"]
+        return self.ref_cache.get_entry(models["vits_model"], ref_audio_path, lambda path: self._load_ref_spec(path, hps))
 
-    def _get_ref_spec(self, ref_audio_path):
-        audio = load_audio(ref_audio_path, int(self.configs.sampling_rate))
+    def _load_ref_spec(self, ref_audio_path, hps:dict):
+        audio = load_audio(ref_audio_path, int(hps["data"]["sampling_rate"]))
         audio = torch.FloatTensor(audio)
         maxx=audio.abs().max()
         if(maxx>1):audio/=min(2,maxx)
@@ -436,26 +604,36 @@ class TTS:
         audio_norm = audio_norm.unsqueeze(0)
         spec = spectrogram_torch(
             audio_norm,
-            self.configs.filter_length,
-            self.configs.sampling_rate,
-            self.configs.hop_length,
-            self.configs.win_length,
+            hps["data"]["filter_length"],
+            hps["data"]["sampling_rate"],
+            hps["data"]["hop_length"],
+            hps["data"]["win_length"],
             center=False,
         )
-        spec = spec.to(self.configs.device)
-        if self.configs.is_half:
-            spec = spec.half()
         return spec
 
-    def _set_prompt_semantic(self, ref_wav_path:str):
+    def _get_prompt_semantic(self, ref_wav_path:str, models:dict=None):
+        models = self.models if models is None else models
+        vits_model = models["vits_model"]
+        sampling_rate = models["vits_hps"]["data"]["sampling_rate"]
+        entry = self.prompt_store.get_entry(
+            ref_wav_path, self.configs.cnhuhbert_base_path, vits_model,
+            lambda path: self._compute_prompt_semantic(path, vits_model, sampling_rate)
+        )
+        if (entry.num_samples > 160000 or entry.num_samples < 48000):
+            raise OSError(i18n("参考音频在3~10秒范围外，请更换！"))
+        return entry.prompt_semantic.to(self.configs.device)
+
+    def _compute_prompt_semantic(self, ref_wav_path:str, vits_model:SynthesizerTrn, sampling_rate:int):
         zero_wav = np.zeros(
-            int(self.configs.sampling_rate * 0.3),
+            int(sampling_rate * 0.3),
             dtype=np.float16 if self.configs.is_half else np.float32,
         )
         with torch.no_grad():
             wav16k, sr = librosa.load(ref_wav_path, sr=16000)
             if (wav16k.shape[0] > 160000 or wav16k.shape[0] < 48000):
                 raise OSError(i18n("参考音频在3~10秒范围外，请更换！"))
+            num_samples = wav16k.shape[0]
             wav16k = torch.from_numpy(wav16k)
             zero_wav_torch = torch.from_numpy(zero_wav)
             wav16k = wav16k.to(self.configs.device)
@@ -470,10 +648,8 @@ class TTS:
             ].transpose(
                 1, 2
             )  # .float()
-            codes = self.vits_model.extract_latent(hubert_feature)
-    
-            prompt_semantic = codes[0, 0].to(self.configs.device)
-            self.prompt_cache["prompt_semantic"] = prompt_semantic
+            codes = vits_model.extract_latent(hubert_feature)
+            return codes[0, 0], num_samples
     
     def batch_sequences(self, sequences: List[torch.Tensor], axis: int = 0, pad_value: int = 0, max_length:int=None):
         seq = sequences[0]
@@ -497,7 +673,7 @@ class TTS:
         return batch
     
     def to_batch(self, data:list, 
-                 prompt_data:dict=None, 
+                 prompt_data:PromptEntry=None, 
                  batch_size:int=5, 
                  threshold:float=0.75, 
                  split_bucket:bool=True, 
@@ -553,9 +729,9 @@ class TTS:
             all_phones_max_len = 0
             for item in item_list:
                 if prompt_data is not None:
-                    all_bert_features = torch.cat([prompt_data["bert_features"], item["bert_features"]], 1)\
+                    all_bert_features = torch.cat([prompt_data.bert_features, item["bert_features"]], 1)\
                                                 .to(dtype=precision, device=device)
-                    all_phones = torch.LongTensor(prompt_data["phones"]+item["phones"]).to(device)
+                    all_phones = torch.LongTensor(prompt_data.phones+item["phones"]).to(device)
                     phones = torch.LongTensor(item["phones"]).to(device)
                     # norm_text = prompt_data["norm_text"]+item["norm_text"]
                 else:
@@ -629,13 +805,18 @@ class TTS:
                 _data[index] = data[i][j]
         return _data
 
-    def stop(self,):
+    def stop(self, request_id:str=None):
         '''
         Stop the inference process.
+            Args:
+                request_id: str, only stop the runs with this "request_id" input, None stops every run.
+            Only the runs in progress are stopped, later runs are not affected.
         '''
-        self.stop_flag = True
-    
-    @torch.no_grad()
+        with self.runs_lock:
+            for run_key, run_request_id in self.running_requests.items():
+                if request_id is None or run_request_id == request_id:
+                    self.stopped_runs.add(run_key)
+
     def run(self, inputs:dict):
         """
         Text to speech inference.
@@ -661,13 +842,32 @@ class TTS:
                     "fragment_interval":0.3,      # float. to control the interval of the audio fragment.
                     "seed": -1,                   # int. random seed for reproducibility.
                     "parallel_infer": True,       # bool. whether to use parallel inference.
-                    "repetition_penalty": 1.35    # float. repetition penalty for T2S model.
+                    "repetition_penalty": 1.35,   # float. repetition penalty for T2S model.
+                    "speculative_decoding": False,# bool. whether to use speculative decoding (draft model = first T2S layers).
+                    "draft_layers": 0,            # int. number of T2S layers used as draft model, 0 for a quarter of the layers.
+                    "num_draft_tokens": 4,        # int. number of tokens proposed by the draft model per step.
+                    "static_decode": False,       # bool. whether to use fixed-shape decode steps (compiled with torch.compile on cuda).
+                    "streaming_chunk_size": 0,    # int. with return_fragment, vocode in chunks of this many latent frames (50 per second) and return each chunk when ready, 0 returns whole sentences.
+                    "token_streaming_size": 0,    # int. with return_fragment, vocode every this many semantic tokens (25 per second) while T2S is still decoding, 0 to disable.
+                    "character": None,            # str.(optional) name of a character in the `characters` config, switches to its GPT/SoVITS weights.
+                    "request_id": None,           # str.(optional) identifies the run for stop(request_id).
                 }
         returns:
             Tuple[int, np.ndarray]: sampling rate and audio data.
         """
+        run_key = object()
+        with self.runs_lock:
+            self.running_requests[run_key] = inputs.get("request_id", None)
+        try:
+            yield from self._run(inputs, lambda: run_key in self.stopped_runs)
+        finally:
+            with self.runs_lock:
+                self.running_requests.pop(run_key, None)
+                self.stopped_runs.discard(run_key)
+
+    @torch.no_grad()
+    def _run(self, inputs:dict, should_stop):
         ########## variables initialization ###########
-        self.stop_flag:bool = False
         text:str = inputs.get("text", "")
         text_lang:str = inputs.get("text_lang", "")
         ref_audio_path:str = inputs.get("ref_audio_path", "")
@@ -689,13 +889,38 @@ class TTS:
         actual_seed = set_seed(seed)
         parallel_infer = inputs.get("parallel_infer", True)
         repetition_penalty = inputs.get("repetition_penalty", 1.35)
+        speculative_decoding = inputs.get("speculative_decoding", False)
+        draft_layers = inputs.get("draft_layers", 0)
+        num_draft_tokens = inputs.get("num_draft_tokens", 4)
+        static_decode = inputs.get("static_decode", False)
+        streaming_chunk_size = inputs.get("streaming_chunk_size", 0)
+        token_streaming_size = inputs.get("token_streaming_size", 0)
+        character = inputs.get("character", None)
+
 
-        if parallel_infer:
+        # the models of this run stay in locals, other runs may use other characters at the same time
+        models = self.get_models(character)
+        t2s_model:Text2SemanticLightningModule = models["t2s_model"]
+        vits_model:SynthesizerTrn = models["vits_model"]
+        version:str = models["version"]
+        sampling_rate:int = models["vits_hps"]["data"]["sampling_rate"]
+        early_stop_num:int = self.configs.hz * models["max_sec"]
+
+        if self.t2s_scheduler is not None and self.t2s_scheduler.model is t2s_model.model:
+            print(i18n("连续批处理模式已开启"))
+            infer_panel = self.t2s_scheduler.infer_panel
+        elif speculative_decoding:
+            print(i18n("投机解码模式已开启"))
+            infer_panel = t2s_model.model.infer_panel_speculative
+        elif static_decode:
+            print(i18n("静态形状解码模式已开启"))
+            infer_panel = t2s_model.model.infer_panel_static
+        elif parallel_infer:
             print(i18n("并行推理模式已开启"))
-            self.t2s_model.model.infer_panel = self.t2s_model.model.infer_panel_batch_infer
+            infer_panel = t2s_model.model.infer_panel_batch_infer
         else:
             print(i18n("并行推理模式已关闭"))
-            self.t2s_model.model.infer_panel = self.t2s_model.model.infer_panel_naive_batched
+            infer_panel = t2s_model.model.infer_panel_naive_batched
 
         if return_fragment:
             print(i18n("分段返回模式已开启"))
@@ -711,6 +936,11 @@ class TTS:
         else:
             print(i18n("分桶处理模式已关闭"))
 
+        if return_fragment and token_streaming_size > 0:
+            print(i18n("T2S与声码流水线模式已开启"))
+        elif return_fragment and streaming_chunk_size > 0:
+            print(i18n("流式声码模式已开启"))
+
         if fragment_interval<0.01:
             fragment_interval = 0.01
             print(i18n("分段间隔过小，已自动设置为0.01"))
@@ -723,46 +953,26 @@ class TTS:
         if not no_prompt_text:
             assert prompt_lang in self.configs.languages
 
-        if ref_audio_path in [None, ""] and \
-            ((self.prompt_cache["prompt_semantic"] is None) or (self.prompt_cache["refer_spec"] in [None, []])):
-            raise ValueError("ref_audio_path cannot be empty, when the reference audio is not set using set_ref_audio()")
+        if ref_audio_path in [None, ""]:
+            if self.default_ref_audio_path is None:
+                raise ValueError("ref_audio_path cannot be empty, when the reference audio is not set using set_ref_audio()")
+            ref_audio_path = self.default_ref_audio_path
+        elif not os.path.exists(ref_audio_path):
+            raise ValueError(f"{ref_audio_path} not exists")
 
         ###### setting reference audio and prompt text preprocessing ########
         t0 = ttime()
-        if (ref_audio_path is not None) and (ref_audio_path != self.prompt_cache["ref_audio_path"]):
-            if not os.path.exists(ref_audio_path):
-                raise ValueError(f"{ref_audio_path} not exists")
-            self.set_ref_audio(ref_audio_path)
-            
-        aux_ref_audio_paths = aux_ref_audio_paths if aux_ref_audio_paths is not None else []
-        paths = set(aux_ref_audio_paths)&set(self.prompt_cache["aux_ref_audio_paths"])
-        if not (len(list(paths)) == len(aux_ref_audio_paths) == len(self.prompt_cache["aux_ref_audio_paths"])):
-            self.prompt_cache["aux_ref_audio_paths"] = aux_ref_audio_paths
-            self.prompt_cache["refer_spec"] = [self.prompt_cache["refer_spec"][0]]
-            for path in aux_ref_audio_paths:
-                if path in [None, ""]:
-                    continue
-                if not os.path.exists(path):
-                    print(i18n("音频文件不存在，跳过：{}").format(path))
-                    continue
-                self.prompt_cache["refer_spec"].append(self._get_ref_spec(path))
-                
         if not no_prompt_text:
             prompt_text = prompt_text.strip("\n")
             if (prompt_text[-1] not in splits): prompt_text += "。" if prompt_lang != "en" else "."
             print(i18n("实际输入的参考文本:"), prompt_text)
-            if self.prompt_cache["prompt_text"] != prompt_text:
-                self.prompt_cache["prompt_text"] = prompt_text
-                self.prompt_cache["prompt_lang"] = prompt_lang
-                phones, bert_features, norm_text = \
-                    self.text_preprocessor.segment_and_extract_feature_for_text(
-                                                                        prompt_text, 
-                                                                        prompt_lang,
-                                                                        self.configs.version)
-                self.prompt_cache["phones"] = phones
-                self.prompt_cache["bert_features"] = bert_features
-                self.prompt_cache["norm_text"] = norm_text
-
+        prompt_entry = self.get_prompt_entry(
+            ref_audio_path,
+            aux_ref_audio_paths if aux_ref_audio_paths is not None else [],
+            None if no_prompt_text else prompt_text,
+            prompt_lang,
+            models,
+        )
 
 
 
@@ -770,15 +980,15 @@ class TTS:
         t1 = ttime()
         data:list = None
         if not return_fragment:
-            data = self.text_preprocessor.preprocess(text, text_lang, text_split_method, self.configs.version)
+            data = self.text_preprocessor.preprocess(text, text_lang, text_split_method, version)
             if len(data) == 0:
-                yield self.configs.sampling_rate, np.zeros(int(self.configs.sampling_rate),
+                yield sampling_rate, np.zeros(int(sampling_rate),
                                                             dtype=np.int16)
                 return
 
             batch_index_list:list = None
             data, batch_index_list = self.to_batch(data, 
-                                prompt_data=self.prompt_cache if not no_prompt_text else None, 
+                                prompt_data=prompt_entry if not no_prompt_text else None, 
                                 batch_size=batch_size, 
                                 threshold=batch_threshold,
                                 split_bucket=split_bucket,
@@ -798,7 +1008,7 @@ class TTS:
                 batch_data = []
                 print(i18n("############ 提取文本Bert特征 ############"))
                 for text in tqdm(batch_texts):
-                    phones, bert_features, norm_text = self.text_preprocessor.segment_and_extract_feature_for_text(text, text_lang, self.configs.version)
+                    phones, bert_features, norm_text = self.text_preprocessor.segment_and_extract_feature_for_text(text, text_lang, version)
                     if phones is None:
                         continue
                     res={
@@ -810,7 +1020,7 @@ class TTS:
                 if len(batch_data) == 0:
                     return None
                 batch, _ = self.to_batch(batch_data, 
-                            prompt_data=self.prompt_cache if not no_prompt_text else None, 
+                            prompt_data=prompt_entry if not no_prompt_text else None, 
                             batch_size=batch_size, 
                             threshold=batch_threshold,
                             split_bucket=False,
@@ -820,12 +1030,24 @@ class TTS:
                 return batch[0]
 
 
+        prompt_prefix = None
+        if not no_prompt_text:
+            prompt_prefix = self.t2s_prefix_cache.get_prefix(
+                t2s_model.model,
+                models["t2s_weights_path"],
+                prompt_entry.key,
+                torch.LongTensor(prompt_entry.phones).to(self.configs.device),
+                prompt_entry.bert_features.to(dtype=self.precision, device=self.configs.device),
+                prompt_entry.prompt_semantic.unsqueeze(0).to(self.configs.device),
+            )
+
         t2 = ttime()
         try:
             print("############ 推理 ############")
             ###### inference ######
             t_34 = 0.0
             t_45 = 0.0
+            first_chunk_time = None
             audio = []
             for item in data:
                 t3 = ttime()
@@ -847,10 +1069,54 @@ class TTS:
                 if no_prompt_text :
                     prompt = None
                 else:
-                    prompt = self.prompt_cache["prompt_semantic"].expand(len(all_phoneme_ids), -1).to(self.configs.device)
+                    prompt = prompt_entry.prompt_semantic.expand(len(all_phoneme_ids), -1).to(self.configs.device)
 
+                if return_fragment and token_streaming_size > 0:
+                    # ## T2S 与 vits 流水线: T2S 在后台线程逐个生成语义token, 每 token_streaming_size 个token解码一次音频
+                    ge = prompt_entry.ge.to(dtype=self.precision, device=self.configs.device)
+                    zero_wav = np.zeros(int(sampling_rate * fragment_interval), dtype=np.int16)
+                    for i in range(len(all_phoneme_ids)):
+                        tokens = stream_tokens(
+                            t2s_model.model.infer_panel_naive,
+                            all_phoneme_ids[i].unsqueeze(0),
+                            all_phoneme_lens[i:i+1],
+                            prompt[i:i+1] if prompt is not None else None,
+                            all_bert_features[i].unsqueeze(0),
+                            top_k=top_k,
+                            top_p=top_p,
+                            temperature=temperature,
+                            early_stop_num=early_stop_num,
+                            repetition_penalty=repetition_penalty,
+                            prompt_prefix=prompt_prefix,
+                        )
+                        # the first sampled token is dropped like in the non-streaming path (pred_semantic[-idx:])
+                        segment_tokens = itertools.islice(tokens, 1, None) if prompt is not None else tokens
+                        phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
+                        try:
+                            for audio_chunk in vocode_token_stream(
+                                    vits_model, segment_tokens, phones, ge, token_streaming_size, speed=speed_factor
+                                ):
+                                if first_chunk_time is None:
+                                    first_chunk_time = ttime() - t0
+                                    print(f"time to first audio chunk: {first_chunk_time:.3f}s")
+                                yield sampling_rate, self.audio_chunk_postprocess(audio_chunk)
+                                if should_stop():
+                                    break
+                        finally:
+                            # also when vocoding fails or the client goes away (GeneratorExit at the yield)
+                            tokens.close()
+                        if should_stop():
+                            break
+                        yield sampling_rate, zero_wav
+                    t_34 += ttime() - t3
 
-                pred_semantic_list, idx_list = self.t2s_model.model.infer_panel(
+                    if should_stop():
+                        yield sampling_rate, np.zeros(int(sampling_rate),
+                                                                dtype=np.int16)
+                        return
+                    continue
+
+                pred_semantic_list, idx_list = infer_panel(
                     all_phoneme_ids,
                     all_phoneme_lens,
                     prompt,
@@ -859,83 +1125,84 @@ class TTS:
                     top_k=top_k,
                     top_p=top_p,
                     temperature=temperature,
-                    early_stop_num=self.configs.hz * self.configs.max_sec,
+                    early_stop_num=early_stop_num,
                     max_len=max_len,
                     repetition_penalty=repetition_penalty,
+                    prompt_prefix=prompt_prefix,
+                    draft_layers=draft_layers,
+                    num_draft_tokens=num_draft_tokens,
+                    should_stop=should_stop,
                 )
                 t4 = ttime()
                 t_34 += t4 - t3
+                if should_stop():
+                    yield sampling_rate, np.zeros(int(sampling_rate),
+                                                            dtype=np.int16)
+                    return
 
-                refer_audio_spec:torch.Tensor = [item.to(dtype=self.precision, device=self.configs.device) for item in self.prompt_cache["refer_spec"]]
-                                                    
+                ge = prompt_entry.ge.to(dtype=self.precision, device=self.configs.device)
 
-                batch_audio_fragment = []
-            
-                # ## vits并行推理 method 1
-                # pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
-                # pred_semantic_len = torch.LongTensor([item.shape[0] for item in pred_semantic_list]).to(self.configs.device)
-                # pred_semantic = self.batch_sequences(pred_semantic_list, axis=0, pad_value=0).unsqueeze(0)
-                # max_len = 0
-                # for i in range(0, len(batch_phones)):
-                #     max_len = max(max_len, batch_phones[i].shape[-1])
-                # batch_phones = self.batch_sequences(batch_phones, axis=0, pad_value=0, max_length=max_len)
-                # batch_phones = batch_phones.to(self.configs.device)
-                # batch_audio_fragment = (self.vits_model.batched_decode(
-                #         pred_semantic, pred_semantic_len, batch_phones, batch_phones_len,refer_audio_spec
-                #     ))
-
-                if speed_factor == 1.0:
-                    # ## vits并行推理 method 2
-                    pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
-                    upsample_rate = math.prod(self.vits_model.upsample_rates)
-                    audio_frag_idx = [pred_semantic_list[i].shape[0]*2*upsample_rate for i in range(0, len(pred_semantic_list))]
-                    audio_frag_end_idx = [ sum(audio_frag_idx[:i+1]) for i in range(0, len(audio_frag_idx))]
-                    all_pred_semantic = torch.cat(pred_semantic_list).unsqueeze(0).unsqueeze(0).to(self.configs.device)
-                    _batch_phones = torch.cat(batch_phones).unsqueeze(0).to(self.configs.device)
-                    _batch_audio_fragment = (self.vits_model.decode(
-                            all_pred_semantic, _batch_phones, refer_audio_spec, speed=speed_factor
-                        ).detach()[0, 0, :])
-                    audio_frag_end_idx.insert(0, 0)
-                    batch_audio_fragment= [_batch_audio_fragment[audio_frag_end_idx[i-1]:audio_frag_end_idx[i]] for i in range(1, len(audio_frag_end_idx))]
-                else:
-                # ## vits串行推理
+                if return_fragment and streaming_chunk_size > 0:
+                    # ## vits流式推理: 按潜变量帧分块声码, 每块就绪即返回
+                    zero_wav = np.zeros(int(sampling_rate * fragment_interval), dtype=np.int16)
                     for i, idx in enumerate(idx_list):
                         phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
-                        _pred_semantic = (pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0))   # .unsqueeze(0)#mq要多unsqueeze一次
-                        audio_fragment =(self.vits_model.decode(
-                                _pred_semantic, phones, refer_audio_spec, speed=speed_factor
-                            ).detach()[0, 0, :])
-                        batch_audio_fragment.append(
-                            audio_fragment
-                        )  ###试试重建不带上prompt部分
-
-                t5 = ttime()
-                t_45 += t5 - t4
-                if return_fragment:
-                    print("%.3f\t%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, t4 - t3, t5 - t4))
-                    yield self.audio_postprocess([batch_audio_fragment], 
-                                                    self.configs.sampling_rate, 
-                                                    None, 
-                                                    speed_factor, 
-                                                    False,
-                                                    fragment_interval
-                                                    )
+                        _pred_semantic = (pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0))
+                        for audio_chunk in vits_model.decode_streaming(
+                                _pred_semantic, phones, ge, speed=speed_factor, chunk_size=streaming_chunk_size
+                            ):
+                            if first_chunk_time is None:
+                                first_chunk_time = ttime() - t0
+                                print(f"time to first audio chunk: {first_chunk_time:.3f}s")
+                            yield sampling_rate, self.audio_chunk_postprocess(audio_chunk)
+                            if should_stop():
+                                break
+                        if should_stop():
+                            break
+                        yield sampling_rate, zero_wav
+                    t5 = ttime()
+                    t_45 += t5 - t4
                 else:
-                    audio.append(batch_audio_fragment)
+                    # ## vits并行推理: 补齐到同一长度后按 mask 批量解码, 各段互不影响
+                    pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
+                    pred_semantic_len = torch.LongTensor([item.shape[0] for item in pred_semantic_list]).to(self.configs.device)
+                    pred_semantic = self.batch_sequences(pred_semantic_list, axis=0, pad_value=0).unsqueeze(0).to(self.configs.device)
+                    _batch_phones_len = torch.LongTensor([item.shape[-1] for item in batch_phones]).to(self.configs.device)
+                    _batch_phones = self.batch_sequences(batch_phones, axis=0, pad_value=0).to(self.configs.device)
+                    batch_audio_fragment = [
+                        item.detach() for item in vits_model.batched_decode(
+                            pred_semantic, pred_semantic_len, _batch_phones, _batch_phones_len,
+                            ge, speed=speed_factor
+                        )
+                    ]
 
-                if self.stop_flag:
-                    yield self.configs.sampling_rate, np.zeros(int(self.configs.sampling_rate),
+                    t5 = ttime()
+                    t_45 += t5 - t4
+                    if return_fragment:
+                        print("%.3f\t%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, t4 - t3, t5 - t4))
+                        yield self.audio_postprocess([batch_audio_fragment], 
+                                                        sampling_rate, 
+                                                        None, 
+                                                        speed_factor, 
+                                                        False,
+                                                        fragment_interval
+                                                        )
+                    else:
+                        audio.append(batch_audio_fragment)
+
+                if should_stop():
+                    yield sampling_rate, np.zeros(int(sampling_rate),
                                                             dtype=np.int16)
                     return
 
             if not return_fragment:
                 print("%.3f\t%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, t_34, t_45))
                 if len(audio) == 0:
-                    yield self.configs.sampling_rate, np.zeros(int(self.configs.sampling_rate),
+                    yield sampling_rate, np.zeros(int(sampling_rate),
                                                                 dtype=np.int16)
                     return
                 yield self.audio_postprocess(audio, 
-                                                self.configs.sampling_rate, 
+                                                sampling_rate, 
                                                 batch_index_list, 
                                                 speed_factor, 
                                                 split_bucket,
@@ -945,15 +1212,9 @@ class TTS:
         except Exception as e:
             traceback.print_exc()
             # 必须返回一个空音频, 否则会导致显存不释放。
-            yield self.configs.sampling_rate, np.zeros(int(self.configs.sampling_rate),
+            yield sampling_rate, np.zeros(int(sampling_rate),
                                                             dtype=np.int16)
-            # 重置模型, 否则会导致显存释放不完全。
-            del self.t2s_model
-            del self.vits_model
-            self.t2s_model = None
-            self.vits_model = None
-            self.init_t2s_weights(self.configs.t2s_weights_path)
-            self.init_vits_weights(self.configs.vits_weights_path)
+            # 模型由多个请求共享 (见 get_models), 出错时不重新加载, 由 finally 中的 empty_cache 释放显存。
             raise e
         finally:
             self.empty_cache()
@@ -977,7 +1238,7 @@ class TTS:
                           fragment_interval:float=0.3
                           )->Tuple[int, np.ndarray]:
         zero_wav = torch.zeros(
-                        int(self.configs.sampling_rate * fragment_interval),
+                        int(sr * fragment_interval),
                         dtype=self.precision,
                         device=self.configs.device
                     )
@@ -1010,6 +1271,11 @@ class TTS:
             
         
         
+    def audio_chunk_postprocess(self, audio_chunk:torch.Tensor)->np.ndarray:
+        # the peak of the whole sentence is unknown while streaming, so clip instead of normalizing
+        audio_chunk = torch.clamp(audio_chunk.float(), -1, 1)
+        return (audio_chunk.cpu().numpy() * 32767).astype(np.int16)
+
        
 def speed_change(input_audio:np.ndarray, speed:float, sr:int):
     # 将 NumPy 数组转换为原始 PCM 流
@@ -13,6 +13,7 @@ from GPT_SoVITS.tools.i18n.i18n import I18nAuto, scan_language_list
 from ..TTS_infer_pack.text_segmentation_method import split_big_text, splits, get_method as get_seg_method
 from ..text import chinese
 from ..text import cleaned_text_to_sequence
+from ..text.bert_feature import get_bert_features
 from ..text.cleaner import clean_text
 
 language=os.environ.get("language","Auto")
@@ -59,8 +60,9 @@ class TextPreprocessor:
         texts = self.pre_seg_text(text, lang, text_split_method)
         result = []
         print(i18n("############ 提取文本Bert特征 ############"))
-        for text in tqdm(texts):
-            phones, bert_features, norm_text = self.segment_and_extract_feature_for_text(text, lang, version)
+        # the zh fragments of all segments go through bert together
+        fragments_list = [self.clean_text_fragments(text, lang, version) for text in tqdm(texts)]
+        for phones, bert_features, norm_text in self.extract_bert_features(fragments_list):
             if phones is None or norm_text=="":
                 continue
             res={
@@ -115,6 +117,13 @@ class TextPreprocessor:
         return self.get_phones_and_bert(text, language, version)
         
     def get_phones_and_bert(self, text:str, language:str, version:str, final:bool=False):
+        return self.extract_bert_features([self.clean_text_fragments(text, language, version, final)])[0]
+
+    def clean_text_fragments(self, text:str, language:str, version:str, final:bool=False)->List[Tuple[list, list, str, str]]:
+        '''
+            Split `text` into single language fragments and clean them.
+            Returns (phones, word2ph, norm_text, language) per fragment, the bert features are extracted later.
+        '''
         if language in {"en", "all_zh", "all_ja", "all_ko", "all_yue"}:
             language = language.replace("all_","")
             if language == "en":
@@ -129,20 +138,13 @@ class TextPreprocessor:
                 if re.search(r'[A-Za-z]', formattext):
                     formattext = re.sub(r'[a-z]', lambda x: x.group(0).upper(), formattext)
                     formattext = chinese.mix_text_normalize(formattext)
-                    return self.get_phones_and_bert(formattext,"zh",version)
-                else:
-                    phones, word2ph, norm_text = self.clean_text_inf(formattext, language, version)
-                    bert = self.get_bert_feature(norm_text, word2ph).to(self.device)
+                    return self.clean_text_fragments(formattext,"zh",version)
             elif language == "yue" and re.search(r'[A-Za-z]', formattext):
                     formattext = re.sub(r'[a-z]', lambda x: x.group(0).upper(), formattext)
                     formattext = chinese.mix_text_normalize(formattext)
-                    return self.get_phones_and_bert(formattext,"yue",version)
-            else:
-                phones, word2ph, norm_text = self.clean_text_inf(formattext, language, version)
-                bert = torch.zeros(
-                    (1024, len(phones)),
-                    dtype=torch.float32,
-                ).to(self.device)
+                    return self.clean_text_fragments(formattext,"yue",version)
+            phones, word2ph, norm_text = self.clean_text_inf(formattext, language, version)
+            fragments = [(phones, word2ph, norm_text, language)]
         elif language in {"zh", "ja", "ko", "yue", "auto", "auto_yue"}:
             textlist=[]
             langlist=[]
@@ -167,40 +169,52 @@ class TextPreprocessor:
                     textlist.append(tmp["text"])
             # print(textlist)
             # print(langlist)
-            phones_list = []
-            bert_list = []
-            norm_text_list = []
+            fragments = []
             for i in range(len(textlist)):
                 lang = langlist[i]
                 phones, word2ph, norm_text = self.clean_text_inf(textlist[i], lang, version)
-                bert = self.get_bert_inf(phones, word2ph, norm_text, lang)
+                fragments.append((phones, word2ph, norm_text, lang))
+
+        if not final and sum(len(fragment[0]) for fragment in fragments) < 6:
+            return self.clean_text_fragments("." + text,language,version,final=True)
+
+        return fragments
+
+    def extract_bert_features(self, fragments_list:List[List[Tuple[list, list, str, str]]])->List[Tuple[list, torch.Tensor, str]]:
+        '''
+            (phones, bert_features, norm_text) of each fragment list returned by `clean_text_fragments`.
+            The bert features of all zh fragments are computed in one batch.
+        '''
+        zh_fragments = [fragment for fragments in fragments_list for fragment in fragments if fragment[3].replace("all_","") == "zh"]
+        zh_features = iter(get_bert_features(
+            self.bert_model, self.tokenizer, self.device,
+            [fragment[2] for fragment in zh_fragments], [fragment[1] for fragment in zh_fragments],
+        ))
+        result = []
+        for fragments in fragments_list:
+            phones_list = []
+            bert_list = []
+            norm_text_list = []
+            for phones, word2ph, norm_text, lang in fragments:
+                if lang.replace("all_","") == "zh":
+                    bert = next(zh_features)
+                else:
+                    bert = torch.zeros(
+                        (1024, len(phones)),
+                        dtype=torch.float32,
+                    ).to(self.device)
                 phones_list.append(phones)
                 norm_text_list.append(norm_text)
                 bert_list.append(bert)
             bert = torch.cat(bert_list, dim=1)
             phones = sum(phones_list, [])
             norm_text = ''.join(norm_text_list)
-
-        if not final and len(phones) < 6:
-            return self.get_phones_and_bert("." + text,language,version,final=True)
-
-        return phones, bert, norm_text
+            result.append((phones, bert, norm_text))
+        return result
 
 
     def get_bert_feature(self, text:str, word2ph:list)->torch.Tensor:
-        with torch.no_grad():
-            inputs = self.tokenizer(text, return_tensors="pt")
-            for i in inputs:
-                inputs[i] = inputs[i].to(self.device)
-            res = self.bert_model(**inputs, output_hidden_states=True)
-            res = torch.cat(res["hidden_states"][-3:-2], -1)[0].cpu()[1:-1]
-        assert len(word2ph) == len(text)
-        phone_level_feature = []
-        for i in range(len(word2ph)):
-            repeat_feature = res[i].repeat(word2ph[i], 1)
-            phone_level_feature.append(repeat_feature)
-        phone_level_feature = torch.cat(phone_level_feature, dim=0)
-        return phone_level_feature.T
+        return get_bert_features(self.bert_model, self.tokenizer, self.device, [text], [word2ph])[0]
     
     def clean_text_inf(self, text:str, language:str, version:str="v2"):
         phones, word2ph, norm_text = clean_text(text, language, version)
@@ -0,0 +1,126 @@
+"""
+Serve a FastAPI app from several forked processes that share the model weights.
+
+The parent process loads the models, moves their tensors to shared memory with `share_modules` and forks
+the workers, which map the same pages instead of each holding a copy. All workers accept connections on
+one listening socket, so the kernel spreads the requests over them. The workers only read the shared
+weights; a worker that loads other weights gets a private copy, which the other workers do not see.
+
+CUDA cannot be used in forked processes and Windows has no fork, so this is for CPU inference on POSIX.
+"""
+import itertools
+import os
+import signal
+import socket
+import time
+import traceback
+from typing import Callable, Iterable, Optional
+
+import torch
+import uvicorn
+
+_worker_index: Optional[int] = None
+
+
+def worker_index() -> Optional[int]:
+    '''
+        Index of this worker, None in a process that was not forked by serve_forked.
+    '''
+    return _worker_index
+
+
+def share_modules(modules: Iterable[torch.nn.Module]) -> int:
+    '''
+        Move the parameters and buffers of `modules` to shared memory. Returns their size in bytes.
+    '''
+    nbytes = 0
+    for module in modules:
+        if module is None:
+            continue
+        module.share_memory()
+        for tensor in itertools.chain(module.parameters(), module.buffers()):
+            nbytes += tensor.numel() * tensor.element_size()
+    return nbytes
+
+
+def _listen(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(app, sock: socket.socket, index: int, num_threads: int):
+    global _worker_index
+    _worker_index = index
+    for signum in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
+        signal.signal(signum, signal.SIG_DFL)
+    torch.set_num_threads(num_threads)
+    code = 0
+    try:
+        uvicorn.Server(uvicorn.Config(app)).run(sockets=[sock])
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def serve_forked(
+    app,
+    host: str,
+    port: int,
+    workers: int,
+    num_threads: Optional[int] = None,
+    on_restart: Optional[Callable[[], None]] = None,
+):
+    '''
+        Fork `workers` processes serving `app` on host:port and keep them running until SIGINT/SIGTERM.
+            A worker that dies is forked again. On SIGHUP all workers are stopped and `on_restart` is called.
+        Args:
+            num_threads: torch threads per worker, by default the cores divided among the workers.
+    '''
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1) // workers)
+    sock = _listen(host, port)
+    children = {}  # pid -> worker index
+    state = {"stopping": False, "restart": False}
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(app, sock, index, num_threads)
+        children[pid] = index
+
+    def stop(signum, frame):
+        state["stopping"] = True
+        state["restart"] = signum == signal.SIGHUP
+
+    for signum in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
+        signal.signal(signum, stop)
+    for index in range(workers):
+        spawn(index)
+    print(f"Serving on {host}:{port} with {workers} workers, {num_threads} threads each")
+
+    while not state["stopping"]:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            time.sleep(0.5)
+            continue
+        index = children.pop(pid)
+        print(f"worker {index} (pid {pid}) exited with status {status}, restarting it")
+        time.sleep(1)
+        spawn(index)
+
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in children:
+        os.waitpid(pid, 0)
+    sock.close()
+    if state["restart"] and on_restart is not None:
+        on_restart()
@@ -0,0 +1,247 @@
+"""
+Bounded job queue that runs blocking inference off the asyncio event loop.
+
+`TTS.run` and api.py's `get_tts_wav` are synchronous generators that take seconds per request. Called
+from an `async def` endpoint they block the event loop, so health checks, /control and every other
+request stall until they finish. `InferenceExecutor` runs them on `concurrency` worker threads and hands
+each item they produce (a whole wav, or a chunk in streaming mode) back to the event loop.
+
+At most `max_queue` jobs wait for a worker; beyond that `submit` raises `QueueFull` with a Retry-After
+estimated from recent job durations. A job can be cancelled (client gone, timeout): a queued job is
+dropped, a running job is told through its `on_cancel` callback (e.g. `TTS.stop`) and its generator is
+closed at the next item.
+
+Jobs of different characters run side by side: `TTS.run` resolves the models of its character per run
+and never switches shared state, so the queue is plain FIFO.
+"""
+import asyncio
+import itertools
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Iterator, Optional
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"the inference queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class ExecutorClosed(Exception):
+    pass
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class _Failure:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+_END = object()
+
+
+class Job:
+    def __init__(self, executor, id: int, fn: Callable[[], Iterator],
+                 deadline: Optional[float], on_cancel: Optional[Callable[[], None]], loop: asyncio.AbstractEventLoop):
+        self.id = id
+        self.fn = fn
+        self.deadline = deadline                       # time.monotonic() after which the job times out
+        self.on_cancel = on_cancel
+        self.submitted = time.monotonic()
+        self.started: Optional[float] = None
+        self.finished = False
+        self.cancelled = False
+        self._executor = executor
+        self._loop = loop
+        self._items: asyncio.Queue = asyncio.Queue()
+        self._exhausted = False
+
+    def _put(self, item: Any):
+        try:
+            self._loop.call_soon_threadsafe(self._items.put_nowait, item)
+        except RuntimeError:  # the event loop is closed, nobody is waiting for the items
+            self.cancelled = True
+
+    async def next(self) -> Any:
+        '''
+            The next item produced by the job. Raises StopAsyncIteration after the last item, JobTimeout
+            when the deadline passes (the job is cancelled), or the exception the job failed with.
+        '''
+        if self._exhausted:
+            raise StopAsyncIteration
+        timeout = None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+        try:
+            item = await asyncio.wait_for(self._items.get(), timeout)
+        except asyncio.TimeoutError:
+            self._exhausted = True
+            self._executor._cancel(self, timed_out=True)
+            raise JobTimeout(f"job {self.id} timed out")
+        if item is _END:
+            self._exhausted = True
+            raise StopAsyncIteration
+        if isinstance(item, _Failure):
+            self._exhausted = True
+            raise item.exception
+        return item
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Any:
+        return await self.next()
+
+    def cancel(self):
+        '''
+            Drop the job if it is queued, stop it if it is running. Does nothing once it has finished.
+        '''
+        self._executor._cancel(self)
+
+
+class InferenceExecutor:
+    def __init__(self, concurrency: int = 1, max_queue: int = 16):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self._avg_duration: Optional[float] = None
+        self._pending: deque = deque()
+        self._running: list = []
+        self._ids = itertools.count()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"inference_{i}", daemon=True) for i in range(concurrency)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn: Callable[[], Iterator], timeout: Optional[float] = None,
+               on_cancel: Optional[Callable[[], None]] = None) -> Job:
+        '''
+            Queue `fn`, which returns an iterator (usually a generator) run on a worker thread.
+            Must be called from the event loop that consumes the job.
+            Args:
+                timeout: seconds from now after which the job is cancelled and `Job.next` raises JobTimeout.
+                on_cancel: called when a running job is cancelled, to interrupt `fn` between items.
+        '''
+        loop = asyncio.get_running_loop()
+        deadline = None if not timeout else time.monotonic() + timeout
+        with self._cond:
+            if self._closed:
+                raise ExecutorClosed("the inference executor is closed")
+            if len(self._pending) >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(self._retry_after())
+            job = Job(self, next(self._ids), fn, deadline, on_cancel, loop)
+            self._pending.append(job)
+            self._cond.notify()
+        return job
+
+    def _retry_after(self) -> int:
+        avg_duration = self._avg_duration if self._avg_duration is not None else 1.0
+        waiting = len(self._pending) + len(self._running)
+        return min(3600, max(1, math.ceil(avg_duration * waiting / self.concurrency)))
+
+    def retry_after(self) -> int:
+        '''
+            Seconds until a queue slot is likely to be free.
+        '''
+        with self._cond:
+            return self._retry_after()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queued": len(self._pending),
+                "running": len(self._running),
+                "concurrency": self.concurrency,
+                "max_queue": self.max_queue,
+                "completed": self.completed,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+                "timed_out": self.timed_out,
+                "rejected": self.rejected,
+                "avg_duration": self._avg_duration,
+            }
+
+    def _cancel(self, job: Job, timed_out: bool = False):
+        with self._cond:
+            if job.finished or job.cancelled:
+                return
+            job.cancelled = True
+            if timed_out:
+                self.timed_out += 1
+            else:
+                self.cancelled += 1
+            if job.started is None:
+                self._pending.remove(job)
+                job.finished = True
+                job._put(_END)
+                self._cond.notify_all()
+                return
+        if job.on_cancel is not None:
+            job.on_cancel()
+
+    def _runnable(self) -> bool:
+        return len(self._pending) > 0 and len(self._running) < self.concurrency
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._runnable():
+                    self._cond.wait()
+                if self._closed:
+                    return
+                job = self._pending.popleft()
+                job.started = time.monotonic()
+                self._running.append(job)
+            failed = self._run(job)
+            with self._cond:
+                self._running.remove(job)
+                job.finished = True
+                duration = time.monotonic() - job.started
+                if failed:
+                    self.failed += 1
+                elif not job.cancelled:
+                    self.completed += 1
+                    self._avg_duration = duration if self._avg_duration is None else 0.8 * self._avg_duration + 0.2 * duration
+                self._cond.notify_all()
+
+    def _run(self, job: Job) -> bool:
+        try:
+            iterator = job.fn()
+            try:
+                for item in iterator:
+                    job._put(item)
+                    if job.cancelled:
+                        break
+            finally:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()
+            job._put(_END)
+            return False
+        except BaseException as e:
+            job._put(_Failure(e))
+            return True
+
+    def close(self):
+        '''
+            Stop accepting jobs and drop the queued ones. Running jobs finish first.
+        '''
+        with self._cond:
+            self._closed = True
+            for job in self._pending:
+                job.cancelled = True
+                job.finished = True
+                job._put(_Failure(ExecutorClosed("the inference executor is closed")))
+            self._pending.clear()
+            self._cond.notify_all()
@@ -0,0 +1,156 @@
+"""
+Pool of resident models, for deployments that switch between many fine-tuned GPT/SoVITS weights.
+
+`ModelPool` loads a model on first use with the `load` callable it was given and keeps it resident
+until it has to be evicted to stay under `max_models` / `max_bytes`, least recently used first.
+Pinned keys are never evicted. `prefetch` loads a key in a background thread, so the next character
+can be read from disk while the current one is serving; `get` waits for a load already in progress
+instead of starting a second one.
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Hashable, Optional
+
+import torch
+
+
+def model_nbytes(value: Any) -> int:
+    '''
+        Bytes of the parameters and buffers of the torch modules in `value`
+        (a module or a list/tuple/dict of them).
+    '''
+    if isinstance(value, torch.nn.Module):
+        tensors = list(value.parameters()) + list(value.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+    if isinstance(value, dict):
+        return sum(model_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(model_nbytes(v) for v in value)
+    return 0
+
+
+class ModelPool:
+    def __init__(
+        self,
+        load: Callable[[Hashable], Any],
+        max_models: int = 4,
+        max_bytes: Optional[int] = None,
+        nbytes: Callable[[Any], int] = model_nbytes,
+    ):
+        self.load = load
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.nbytes = nbytes
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()  # key -> (value, nbytes)
+        self._loading = {}                          # key -> Future
+        self._pinned = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model_pool")
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(self._entries.keys())
+
+    def _evict(self, keep: Hashable):
+        def over_budget():
+            return len(self._entries) > self.max_models or \
+                (self.max_bytes is not None and self.resident_bytes > self.max_bytes)
+
+        for key in list(self._entries.keys()):
+            if not over_budget():
+                break
+            if key == keep or key in self._pinned:
+                continue
+            _, nbytes = self._entries.pop(key)
+            self.resident_bytes -= nbytes
+            print(f"model pool: evicted {key}")
+        if over_budget():
+            print(f"model pool: over budget with {len(self._entries)} models ({self.resident_bytes / 1024 ** 2:.0f} MB)")
+
+    def _load(self, key: Hashable, future: Future):
+        try:
+            value = self.load(key)
+            nbytes = self.nbytes(value)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            return
+        with self._lock:
+            del self._loading[key]
+            self._entries[key] = (value, nbytes)
+            self.resident_bytes += nbytes
+            self._evict(keep=key)
+        future.set_result(value)
+
+    def _start(self, key: Hashable, count: bool = True):
+        '''
+            Returns (value, None, False) for a resident key, else (None, future, whether the caller has to load it).
+        '''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return self._entries[key][0], None, False
+            if count:
+                self.misses += 1
+            if key in self._loading:
+                return None, self._loading[key], False
+            future = Future()
+            self._loading[key] = future
+            return None, future, True
+
+    def get(self, key: Hashable) -> Any:
+        '''
+            Return the models of `key`, loading them in this thread if they are not resident or being prefetched.
+        '''
+        value, future, owner = self._start(key)
+        if future is None:
+            return value
+        if owner:
+            self._load(key, future)
+        return future.result()
+
+    def prefetch(self, key: Hashable) -> Future:
+        '''
+            Load the models of `key` in the background thread. Returns a Future of the models.
+        '''
+        value, future, owner = self._start(key, count=False)
+        if future is None:
+            future = Future()
+            future.set_result(value)
+        elif owner:
+            self._executor.submit(self._load, key, future)
+        return future
+
+    def pin(self, key: Hashable):
+        with self._lock:
+            self._pinned.add(key)
+
+    def unpin(self, key: Hashable):
+        with self._lock:
+            self._pinned.discard(key)
+            self._evict(keep=None)
+
+    def evict(self, key: Hashable):
+        with self._lock:
+            if key in self._entries:
+                _, nbytes = self._entries.pop(key)
+                self.resident_bytes -= nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.resident_bytes = 0
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,133 @@
+"""
+Cache of preprocessed references for TTS.run.
+
+A `PromptEntry` holds everything `TTS.run` needs from a reference: the prompt semantic tokens of the
+reference audio, the speaker embedding of the reference and aux reference audios, and the phones and
+BERT features of the prompt text. `PromptCache` keeps the recently used entries, keyed on the sovits
+weights, the content of the audio files and the prompt text, so requests alternating between voices do
+not recompute them and concurrent requests never share a mutable reference.
+
+Tensors are counted against a GPU and a CPU byte budget separately. When one is exceeded, the least
+recently used entries holding that kind of memory are evicted.
+"""
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import torch
+
+from ..module.ref_cache import hash_file
+
+
+class PromptEntry:
+    def __init__(
+        self,
+        ref_audio_path: str,
+        aux_ref_audio_paths: List[str],
+        prompt_semantic: torch.LongTensor,
+        ge: torch.Tensor,
+        prompt_text: Optional[str] = None,
+        prompt_lang: Optional[str] = None,
+        phones: Optional[List[int]] = None,
+        bert_features: Optional[torch.Tensor] = None,
+        norm_text: Optional[str] = None,
+        key: Optional[tuple] = None,
+    ):
+        self.ref_audio_path = ref_audio_path
+        self.aux_ref_audio_paths = aux_ref_audio_paths  # the aux reference audios ge was computed from
+        self.prompt_semantic = prompt_semantic          # [T], semantic tokens of the reference audio
+        self.ge = ge                                    # [1, gin_channels, 1], see SynthesizerTrn.get_ge
+        self.prompt_text = prompt_text                  # None for requests without prompt text
+        self.prompt_lang = prompt_lang
+        self.phones = phones
+        self.bert_features = bert_features              # [1024, len(phones)]
+        self.norm_text = norm_text
+        self.key = key                                  # see PromptCache.make_key, identifies the reference
+
+    def tensors(self) -> List[torch.Tensor]:
+        return [t for t in [self.prompt_semantic, self.ge, self.bert_features] if t is not None]
+
+    @property
+    def nbytes(self) -> Tuple[int, int]:
+        '''
+            (bytes on the gpu, bytes on the cpu)
+        '''
+        gpu_bytes, cpu_bytes = 0, 0
+        for tensor in self.tensors():
+            nbytes = tensor.numel() * tensor.element_size()
+            if tensor.device.type == "cpu":
+                cpu_bytes += nbytes
+            else:
+                gpu_bytes += nbytes
+        return gpu_bytes, cpu_bytes
+
+
+class PromptCache:
+    def __init__(self, max_entries: int = 64, max_gpu_bytes: int = 256 * 1024 * 1024, max_cpu_bytes: int = 512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_gpu_bytes = max_gpu_bytes
+        self.max_cpu_bytes = max_cpu_bytes
+        self.gpu_bytes = 0
+        self.cpu_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(weights_id: str, ref_audio_path: str, aux_ref_audio_paths: List[str], prompt_text: Optional[str], prompt_lang: Optional[str]) -> tuple:
+        return (
+            weights_id,
+            hash_file(ref_audio_path),
+            tuple(sorted(hash_file(path) for path in aux_ref_audio_paths)),
+            prompt_text,
+            prompt_lang if prompt_text is not None else None,
+        )
+
+    def get(self, key: tuple) -> Optional[PromptEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def _remove(self, key: tuple):
+        gpu_bytes, cpu_bytes = self._entries.pop(key).nbytes
+        self.gpu_bytes -= gpu_bytes
+        self.cpu_bytes -= cpu_bytes
+
+    def _victim(self) -> tuple:
+        # the least recently used entry that frees memory where the budget is exceeded
+        if len(self._entries) > self.max_entries:
+            return next(iter(self._entries))
+        gpu_over = self.gpu_bytes > self.max_gpu_bytes
+        for key, entry in self._entries.items():
+            gpu_bytes, cpu_bytes = entry.nbytes
+            if (gpu_over and gpu_bytes > 0) or (not gpu_over and cpu_bytes > 0):
+                return key
+
+    def put(self, key: tuple, entry: PromptEntry):
+        gpu_bytes, cpu_bytes = entry.nbytes
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if gpu_bytes > self.max_gpu_bytes or cpu_bytes > self.max_cpu_bytes:
+                return
+            self._entries[key] = entry
+            self.gpu_bytes += gpu_bytes
+            self.cpu_bytes += cpu_bytes
+            while len(self._entries) > self.max_entries \
+                    or self.gpu_bytes > self.max_gpu_bytes or self.cpu_bytes > self.max_cpu_bytes:
+                self._remove(self._victim())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.gpu_bytes = 0
+            self.cpu_bytes = 0
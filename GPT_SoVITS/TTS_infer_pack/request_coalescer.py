@@ -0,0 +1,155 @@
+"""
+Coalescing of identical TTS requests, for bursty traffic where the same line is requested several times.
+
+`RequestCoalescer.subscribe(key, start)` returns a `Subscription` to the chunks of the job for `key`:
+- if a job for `key` is in flight, the subscription attaches to it and replays the chunks produced so far,
+  so concurrent identical requests share one synthesis and receive the same bytes;
+- if a job for `key` finished less than `ttl` seconds ago, its chunks are served from the result cache;
+- otherwise `start()` submits a new job (see inference_executor.py).
+
+The job is cancelled only when every subscriber has gone. Callers build the key from everything that
+determines the output (see the api scripts); a key of None never coalesces. All methods must be called
+from the event loop thread.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Optional
+
+from .inference_executor import Job
+
+
+class _Flight:
+    def __init__(self, key: Optional[Hashable], job: Optional[Job]):
+        self.key = key
+        self.job = job
+        self.chunks: List[bytes] = []
+        self.nbytes = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class Subscription:
+    def __init__(self, coalescer: "RequestCoalescer", flight: _Flight):
+        self._coalescer = coalescer
+        self._flight = flight
+        self._index = 0
+        self._closed = False
+        flight.subscribers += 1
+
+    async def next(self) -> bytes:
+        '''
+            The next chunk. Raises StopAsyncIteration after the last one, or the exception the job failed with.
+        '''
+        flight = self._flight
+        while True:
+            if self._index < len(flight.chunks):
+                self._index += 1
+                return flight.chunks[self._index - 1]
+            if flight.error is not None:
+                raise flight.error
+            if flight.done:
+                raise StopAsyncIteration
+            await flight.changed.wait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        return await self.next()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._coalescer._unsubscribe(self._flight)
+
+
+class RequestCoalescer:
+    def __init__(self, ttl: float = 30.0, max_bytes: int = 64 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.cache_bytes = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self._in_flight = {}
+        self._cache: OrderedDict = OrderedDict()  # key -> (finished _Flight, expiry time)
+
+    def subscribe(self, key: Optional[Hashable], start: Callable[[], Job]) -> Subscription:
+        '''
+            Subscribe to the job for `key`, calling `start` to submit one if it is neither in flight nor cached.
+            Exceptions of `start` (e.g. QueueFull) are raised here.
+        '''
+        if key is not None:
+            self._expire()
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return Subscription(self, self._cache[key][0])
+            flight = self._in_flight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return Subscription(self, flight)
+        self.misses += 1
+        flight = _Flight(key, start())
+        if key is not None:
+            self._in_flight[key] = flight
+        subscription = Subscription(self, flight)
+        asyncio.get_running_loop().create_task(self._pump(flight))
+        return subscription
+
+    async def _pump(self, flight: _Flight):
+        try:
+            async for chunk in flight.job:
+                flight.chunks.append(chunk)
+                flight.nbytes += len(chunk)
+                flight.notify()
+            flight.done = True
+        except Exception as e:
+            flight.error = e
+        finally:
+            if self._in_flight.get(flight.key) is flight:
+                del self._in_flight[flight.key]
+            if flight.key is not None and flight.done and not flight.job.cancelled:
+                self._put(flight)
+            flight.notify()
+
+    def _unsubscribe(self, flight: _Flight):
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and flight.job is not None and not flight.done and flight.error is None:
+            # nobody is listening anymore, a later identical request starts over
+            if self._in_flight.get(flight.key) is flight:
+                del self._in_flight[flight.key]
+            flight.job.cancel()
+
+    def _put(self, flight: _Flight):
+        if self.ttl <= 0 or flight.nbytes > self.max_bytes:
+            return
+        flight.job = None
+        self._cache[flight.key] = (flight, time.monotonic() + self.ttl)
+        self.cache_bytes += flight.nbytes
+        while self.cache_bytes > self.max_bytes:
+            _, (evicted, _) = self._cache.popitem(last=False)
+            self.cache_bytes -= evicted.nbytes
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in [key for key, (_, expiry) in self._cache.items() if expiry <= now]:
+            flight, _ = self._cache.pop(key)
+            self.cache_bytes -= flight.nbytes
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "in_flight": len(self._in_flight),
+            "cached": len(self._cache),
+            "cache_bytes": self.cache_bytes,
+        }
@@ -0,0 +1,126 @@
+"""
+Pipelined T2S -> VITS decoding for low latency.
+
+`stream_tokens` runs the AR decoder in a background thread and yields the semantic tokens as they are
+sampled. `vocode_token_stream` consumes them and vocodes a block every `block_size` tokens, so VITS
+works on the start of a sentence while T2S is still generating the rest of it.
+
+`SynthesizerTrn.decode` is not causal (its encoders attend over the whole token sequence), so each
+block is decoded together with up to `lookback` already vocoded tokens as left context, and only the
+audio of the new tokens is kept. The last `fade_len` samples of every block are held back and
+crossfaded with the next block, which sees them with more right context.
+"""
+import queue
+import threading
+from typing import Callable, Iterable, Iterator
+
+import torch
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def stream_tokens(infer: Callable, *args, **kwargs) -> Iterator[torch.Tensor]:
+    '''
+        Run `infer(*args, on_token=..., **kwargs)` (e.g. Text2SemanticDecoder.infer_panel_naive) in a
+        thread and yield every token [1, 1] it samples. Closing the iterator stops the decoder at its
+        next token.
+    '''
+    tokens: queue.Queue = queue.Queue()
+    cancelled = threading.Event()
+    errors = []
+
+    def on_token(samples: torch.Tensor):
+        if cancelled.is_set():
+            raise _Cancelled()
+        tokens.put(samples)
+
+    def target():
+        try:
+            with torch.no_grad():
+                infer(*args, on_token=on_token, **kwargs)
+        except _Cancelled:
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            tokens.put(None)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    try:
+        while True:
+            samples = tokens.get()
+            if samples is None:
+                break
+            yield samples
+    finally:
+        cancelled.set()
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+@torch.no_grad()
+def vocode_token_stream(
+    vits_model,
+    tokens: Iterable[torch.Tensor],
+    phones: torch.LongTensor,
+    ge: torch.Tensor,
+    block_size: int = 25,
+    lookback: int = 50,
+    fade_len: int = 1280,
+    speed: float = 1.0,
+) -> Iterator[torch.Tensor]:
+    '''
+        Args:
+            vits_model: SynthesizerTrn.
+            tokens: semantic tokens of one segment, each [1, 1].
+            phones: LongTensor [1, T_text], phones of the segment.
+            ge: Tensor [1, gin_channels, 1], see SynthesizerTrn.get_ge.
+            block_size: number of new tokens vocoded at once.
+            lookback: number of already vocoded tokens decoded again as left context.
+            fade_len: crossfade length in samples between blocks.
+        Yields:
+            Tensor [T_chunk], waveform chunks.
+    '''
+    codes = []
+    state = {"start": 0, "tail": None}
+
+    def flush(final: bool):
+        start, end = state["start"], len(codes)
+        if end == start:
+            if final and state["tail"] is not None:
+                yield state["tail"]
+            return
+        context_start = max(0, start - lookback)
+        block = torch.cat(codes[context_start:end], dim=-1).view(1, 1, -1)
+        audio = vits_model.decode(block, phones, ge, speed=speed)[0, 0]
+
+        # the decoded length is proportional to the number of tokens (up to rounding with speed != 1)
+        keep_from = round(audio.shape[0] * (start - context_start) / (end - context_start))
+        tail = state["tail"]
+        if tail is not None:
+            n = min(tail.shape[0], keep_from)
+            if n < tail.shape[0]:
+                yield tail[:tail.shape[0] - n]
+            audio = audio[keep_from - n:].clone()
+            fade_in = torch.linspace(0, 1, n, dtype=audio.dtype, device=audio.device)
+            audio[:n] = tail[tail.shape[0] - n:] * (1 - fade_in) + audio[:n] * fade_in
+        else:
+            audio = audio[keep_from:]
+
+        state["start"] = end
+        if final or audio.shape[0] <= fade_len:
+            state["tail"] = None
+            yield audio
+        else:
+            state["tail"] = audio[-fade_len:]
+            yield audio[:-fade_len]
+
+    for samples in tokens:
+        codes.append(samples.view(1, 1))
+        if len(codes) - state["start"] >= block_size:
+            yield from flush(final=False)
+    yield from flush(final=True)
@@ -0,0 +1,115 @@
+"""
+Load test of api_v2.py (or api.py): concurrent synthesis requests while a probe polls a cheap endpoint.
+
+Start the server, then run from the project root (GPT-SoVITS):
+    python -m GPT_SoVITS.benchmarks.api_load_test --ref_audio_path ref.wav --prompt_text "..." -n 32 -c 8
+
+`-c` clients send `-n` /tts requests in total. Meanwhile the probe requests `--probe` (/queue by default)
+every 100 ms and records its latency. While inference blocked the event loop, the probe waited for the
+running synthesis to finish; with the executor its latency stays in the milliseconds whatever the load.
+The report gives the status codes of the synthesis requests (200, 429 when the queue is full, 504 on
+timeout), their latency, and the probe latency percentiles. Use `--api v1` for api.py.
+
+Only the standard library is used, so it can run on a machine without the inference dependencies.
+"""
+import argparse
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def request(url, body=None, timeout=600):
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    except (urllib.error.URLError, TimeoutError, ConnectionError):
+        status = -1
+    return status, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GPT-SoVITS api load test")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:9880")
+    parser.add_argument("--api", type=str, default="v2", choices=["v1", "v2"])
+    parser.add_argument("--ref_audio_path", type=str, required=True)
+    parser.add_argument("--prompt_text", type=str, default="")
+    parser.add_argument("--prompt_lang", type=str, default="zh")
+    parser.add_argument("--text", type=str, default="先帝创业未半而中道崩殂，今天下三分，益州疲弊，此诚危急存亡之秋也。")
+    parser.add_argument("--text_lang", type=str, default="zh")
+    parser.add_argument("-n", "--requests", type=int, default=32)
+    parser.add_argument("-c", "--clients", type=int, default=8)
+    parser.add_argument("--probe", type=str, default="/queue")
+    parser.add_argument("--probe_interval", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.api == "v2":
+        tts_url = f"{args.url}/tts"
+        body = {"text": args.text, "text_lang": args.text_lang, "ref_audio_path": args.ref_audio_path,
+                "prompt_text": args.prompt_text, "prompt_lang": args.prompt_lang}
+    else:
+        tts_url = f"{args.url}/"
+        body = {"refer_wav_path": args.ref_audio_path, "prompt_text": args.prompt_text,
+                "prompt_language": args.prompt_lang, "text": args.text, "text_language": args.text_lang}
+
+    results = []
+    probes = []
+    lock = threading.Lock()
+    remaining = [args.requests]
+    done = threading.Event()
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            status, latency = request(tts_url, body)
+            with lock:
+                results.append((status, latency))
+
+    def probe():
+        while not done.is_set():
+            status, latency = request(args.url + args.probe, timeout=60)
+            probes.append(latency)
+            done.wait(args.probe_interval)
+
+    probe_thread = threading.Thread(target=probe, daemon=True)
+    probe_thread.start()
+    t0 = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(args.clients)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - t0
+    done.set()
+    probe_thread.join()
+
+    statuses = Counter(status for status, _ in results)
+    ok = [latency for status, latency in results if status == 200]
+    print(f"{len(results)} requests from {args.clients} clients in {elapsed:.1f}s, status codes: {dict(statuses)}")
+    print(f"synthesis latency (200): p50 {percentile(ok, 0.5):.2f}s, p95 {percentile(ok, 0.95):.2f}s, "
+          f"{len(ok) / elapsed:.2f} requests/s")
+    print(f"{args.probe} latency over {len(probes)} probes: p50 {percentile(probes, 0.5) * 1000:.0f}ms, "
+          f"p95 {percentile(probes, 0.95) * 1000:.0f}ms, max {max(probes, default=float('nan')) * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
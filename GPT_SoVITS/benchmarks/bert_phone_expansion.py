@@ -0,0 +1,70 @@
+"""
+Micro-benchmark for the expansion of character level BERT features to phone level.
+
+Run from the project root (GPT-SoVITS):
+    python -m GPT_SoVITS.benchmarks.bert_phone_expansion --chars 100 500 2000 -d cuda
+
+For random characters x 1024 hidden states and word2ph values, times the old expansion (copy to the cpu,
+one `repeat` per character, `torch.cat`, copy back to the device) against `expand_to_phones`, which does
+a single `repeat_interleave` on the device. No BERT model is needed. The old loop allocates one tensor
+per character, so its cost grows with the input, while the vectorized version stays in the
+microseconds for long paragraphs.
+"""
+import argparse
+from time import perf_counter
+
+import torch
+
+from ..text.bert_feature import expand_to_phones
+
+
+def sync(device):
+    if "cuda" in str(device):
+        torch.cuda.synchronize()
+
+
+def expand_loop(res, word2ph, device):
+    # the implementation that get_bert_feature used to have
+    res = res.cpu()
+    phone_level_feature = []
+    for i in range(len(word2ph)):
+        repeat_feature = res[i].repeat(word2ph[i], 1)
+        phone_level_feature.append(repeat_feature)
+    phone_level_feature = torch.cat(phone_level_feature, dim=0)
+    return phone_level_feature.T.to(device)
+
+
+def bench(name, fn, repeats, device):
+    fn()  # warm up
+    timings = []
+    for _ in range(repeats):
+        sync(device)
+        t0 = perf_counter()
+        fn()
+        sync(device)
+        timings.append(perf_counter() - t0)
+    timings.sort()
+    print(f"  {name:<18} median {timings[len(timings) // 2] * 1000:8.3f} ms, min {timings[0] * 1000:8.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BERT phone level expansion benchmark")
+    parser.add_argument("-d", "--device", type=str, default="cpu")
+    parser.add_argument("--chars", type=int, nargs="+", default=[50, 200, 1000, 4000])
+    parser.add_argument("--half", action="store_true", help="fp16 hidden states, as with is_half")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    dtype = torch.float16 if args.half else torch.float32
+    for chars in args.chars:
+        res = torch.randn(chars, 1024, dtype=dtype, device=args.device)
+        word2ph = torch.randint(1, 4, (chars,)).tolist()
+        text = "字" * chars
+        assert torch.equal(expand_loop(res, word2ph, args.device), expand_to_phones(res, word2ph, text))
+        print(f"{chars} characters, {sum(word2ph)} phones:")
+        bench("loop + torch.cat", lambda: expand_loop(res, word2ph, args.device), args.repeats, args.device)
+        bench("repeat_interleave", lambda: expand_to_phones(res, word2ph, text), args.repeats, args.device)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Micro-benchmark for the T2S decoder KV cache.
+
+Run from the project root (GPT-SoVITS):
+    python -m GPT_SoVITS.benchmarks.t2s_kv_cache --steps 1500
+
+Prints the mean per-token latency of `T2STransformer.decode_next_token` for windows of the
+generated sequence. With the preallocated `T2SKVCache` the latency should stay roughly flat as the
+sequence grows, whereas the old `torch.cat` cache (measured in isolation below) grows linearly.
+"""
+import argparse
+from time import perf_counter
+
+import torch
+import yaml
+
+from ..AR.models.t2s_model import Text2SemanticDecoder
+
+
+def sync(device):
+    if "cuda" in str(device):
+        torch.cuda.synchronize()
+
+
+def bench_decoder(model, prompt_len, steps, window, device):
+    x = torch.randn(1, prompt_len, model.model_dim, device=device)
+    attn_mask = torch.zeros(1, model.num_head, prompt_len, prompt_len, dtype=torch.bool, device=device)
+    _, kv_cache = model.t2s_transformer.process_prompt(x, attn_mask, None, True, prompt_len + steps)
+    xy_pos = torch.randn(1, 1, model.model_dim, device=device)
+
+    timings = []
+    for _ in range(steps):
+        sync(device)
+        t0 = perf_counter()
+        _, kv_cache = model.t2s_transformer.decode_next_token(xy_pos, kv_cache)
+        sync(device)
+        timings.append(perf_counter() - t0)
+    report("T2SKVCache decode_next_token", prompt_len, timings, window)
+
+
+def bench_cache_ops(model, prompt_len, steps, window, device):
+    # Only the cache update, without attention/MLP: torch.cat vs in-place writes.
+    k = torch.randn(1, prompt_len, model.model_dim, device=device)
+    new_k = torch.randn(1, 1, model.model_dim, device=device)
+
+    k_caches = [k.clone() for _ in range(model.num_layers)]
+    timings = []
+    for _ in range(steps):
+        sync(device)
+        t0 = perf_counter()
+        for i in range(model.num_layers):
+            k_caches[i] = torch.cat([k_caches[i], new_k], dim=1)
+        sync(device)
+        timings.append(perf_counter() - t0)
+    report("torch.cat cache update", prompt_len, timings, window)
+
+    _, kv_cache = model.t2s_transformer.process_prompt(
+        k, torch.zeros(1, model.num_head, prompt_len, prompt_len, dtype=torch.bool, device=device), None, True, prompt_len + steps
+    )
+    timings = []
+    for _ in range(steps):
+        sync(device)
+        t0 = perf_counter()
+        for i in range(model.num_layers):
+            kv_cache.update(i, new_k, new_k)
+        kv_cache.advance(1)
+        sync(device)
+        timings.append(perf_counter() - t0)
+    report("T2SKVCache cache update", prompt_len, timings, window)
+
+
+def report(name, prompt_len, timings, window):
+    print(name.center(60, "-"))
+    for start in range(0, len(timings), window):
+        chunk = timings[start:start + window]
+        print(f"kv_len {prompt_len + start:>5} - {prompt_len + start + len(chunk):>5}: "
+              f"{sum(chunk) / len(chunk) * 1000:.3f} ms/token")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="T2S KV cache benchmark")
+    parser.add_argument("-c", "--config", type=str, default="GPT_SoVITS/configs/s1longer-v2.yaml")
+    parser.add_argument("-d", "--device", type=str, default="cpu")
+    parser.add_argument("--prompt_len", type=int, default=200)
+    parser.add_argument("--steps", type=int, default=1500)
+    parser.add_argument("--window", type=int, default=250)
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    model = Text2SemanticDecoder(config).to(args.device).eval()
+
+    with torch.no_grad():
+        bench_cache_ops(model, args.prompt_len, args.steps, args.window, args.device)
+        bench_decoder(model, args.prompt_len, args.steps, args.window, args.device)
+
+
+if __name__ == "__main__":
+    main()
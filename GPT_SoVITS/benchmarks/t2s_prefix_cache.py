@@ -0,0 +1,92 @@
+"""
+What the T2S prefix cache saves per request.
+
+Run from the project root (GPT-SoVITS):
+    python -m GPT_SoVITS.benchmarks.t2s_prefix_cache --device cuda --batch_size 4
+
+Measures the part of the prefill input that `T2SPrefixCache` skips: the embedding, BERT projection
+and positional encoding of the reference phones and of the prompt semantic tokens. "uncached" is
+`embed_text` of every row plus the prompt embedding, as without a prefix; "cached" is the lookup
+(`make_key` on the ids the caller already has, then `get`) followed by `embed_text` of the target
+text only. The prefill of the transformer is printed for scale: the saving only matters if it is not
+lost in the noise of that.
+"""
+import argparse
+from time import perf_counter
+
+import torch
+import yaml
+
+from ..AR.models.t2s_model import Text2SemanticDecoder
+from ..AR.models.t2s_prefix_cache import T2SPrefixCache
+
+
+def sync(device):
+    if "cuda" in str(device):
+        torch.cuda.synchronize()
+
+
+def timeit(fn, repeat, device):
+    fn()
+    sync(device)
+    t0 = perf_counter()
+    for _ in range(repeat):
+        fn()
+    sync(device)
+    return (perf_counter() - t0) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="T2S prefix cache benchmark")
+    parser.add_argument("-c", "--config", type=str, default="GPT_SoVITS/configs/s1longer-v2.yaml")
+    parser.add_argument("-d", "--device", type=str, default="cpu")
+    parser.add_argument("-b", "--batch_size", type=int, default=1)
+    parser.add_argument("--ref_len", type=int, default=60, help="reference phones")
+    parser.add_argument("--text_len", type=int, default=60, help="target text phones")
+    parser.add_argument("--prompt_len", type=int, default=150, help="prompt semantic tokens")
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    device = args.device
+    model = Text2SemanticDecoder(config).to(device).eval()
+    phone_vocab_size = config["model"]["phoneme_vocab_size"]
+
+    ref_phones = torch.randint(0, phone_vocab_size, (args.ref_len,), device=device)
+    ref_bert = torch.randn(1024, args.ref_len, device=device)
+    prompt = torch.randint(0, model.EOS, (1, args.prompt_len), device=device)
+    x_len = args.ref_len + args.text_len
+    x = torch.cat([ref_phones, torch.randint(0, phone_vocab_size, (args.text_len,), device=device)]).expand(args.batch_size, -1)
+    bert_feature = torch.cat([ref_bert, torch.randn(1024, args.text_len, device=device)], dim=1).expand(args.batch_size, -1, -1)
+
+    cache = T2SPrefixCache()
+    reference_id = ("sovits.pth", "0123456789abcdef0123456789abcdef01234567", (), "reference text.", "zh")
+    cache.get_prefix(model, "gpt.ckpt", reference_id, ref_phones, ref_bert, prompt)
+
+    def uncached():
+        model.embed_text(x, bert_feature)
+        model.ar_audio_position(model.ar_audio_embedding(prompt))
+
+    def cached():
+        prefix = cache.get_prefix(model, "gpt.ckpt", reference_id, ref_phones, ref_bert, prompt)
+        model.embed_text(x, bert_feature, prefix)
+
+    xy_pos = torch.randn(args.batch_size, x_len + args.prompt_len, model.model_dim, device=device)
+    attn_mask = torch.zeros(args.batch_size, model.num_head, xy_pos.shape[1], xy_pos.shape[1], dtype=torch.bool, device=device)
+
+    def prefill():
+        model.t2s_transformer.process_prompt(xy_pos, attn_mask, None, False, xy_pos.shape[1] + 1)
+
+    with torch.no_grad():
+        uncached_ms = timeit(uncached, args.repeat, device)
+        cached_ms = timeit(cached, args.repeat, device)
+        prefill_ms = timeit(prefill, max(1, args.repeat // 10), device)
+    print(f"prefix input uncached: {uncached_ms:.3f} ms")
+    print(f"prefix input cached:   {cached_ms:.3f} ms (saves {uncached_ms - cached_ms:.3f} ms, "
+          f"{(uncached_ms - cached_ms) / prefill_ms * 100:.1f}% of the prefill)")
+    print(f"transformer prefill:   {prefill_ms:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Token agreement of a quantized T2S model with the float32 model on CPU.
+
+Run from the project root (GPT-SoVITS):
+    python -m GPT_SoVITS.benchmarks.t2s_quantization_quality --mode int8 -g <t2s ckpt>
+
+For random phone sequences (BERT features set to zero, as for non-Chinese text) and random prompt
+semantic tokens, both models decode greedily (top_k=1) and the report gives:
+- teacher-forced agreement: how often the quantized model predicts the same next token as the float32
+  model along the float32 output, and the mean KL divergence of the two next-token distributions;
+- free-running agreement: the fraction of positions where both greedy outputs match, and the length
+  of their common prefix.
+Teacher-forced agreement is the meaningful number: once the free-running outputs diverge they
+compare different sequences.
+"""
+import argparse
+from copy import deepcopy
+
+import torch
+import torch.nn.functional as F
+
+from ..AR.models.t2s_lightning_module import Text2SemanticLightningModule
+from ..AR.models.t2s_quantization import T2S_QUANTIZATION_MODES, quantize_t2s_model
+
+
+def load_model(weights_path):
+    dict_s1 = torch.load(weights_path, map_location="cpu")
+    t2s_model = Text2SemanticLightningModule(dict_s1["config"], "****", is_train=False)
+    t2s_model.load_state_dict(dict_s1["weight"])
+    return t2s_model.model.eval()
+
+
+def greedy_decode(model, phones, bert_feature, prompt, max_tokens):
+    y, _ = model.infer_panel_naive(
+        phones, torch.LongTensor([phones.shape[1]]), prompt, bert_feature,
+        top_k=1, top_p=1.0, early_stop_num=max_tokens, temperature=1.0, repetition_penalty=1.35,
+    )
+    return y[0, prompt.shape[1]:]
+
+
+def teacher_forced_logits(model, phones, bert_feature, y, prefix_len):
+    # one causal pass over text + prompt + generated tokens, same masks as the prefill of infer_panel_naive
+    x = model.embed_text(phones, bert_feature)
+    xy_pos = torch.concat([x, model.ar_audio_position(model.ar_audio_embedding(y))], dim=1)
+    x_len, y_len = x.shape[1], y.shape[1]
+    x_attn_mask = F.pad(torch.zeros(x_len, x_len, dtype=torch.bool), (0, y_len), value=True)
+    y_attn_mask = F.pad(torch.triu(torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1), (x_len, 0), value=False)
+    attn_mask = torch.concat([x_attn_mask, y_attn_mask], dim=0).view(1, 1, x_len + y_len, x_len + y_len)
+    xy_dec, _ = model.t2s_transformer.process_prompt(xy_pos, attn_mask.expand(-1, model.num_head, -1, -1), None, True, x_len + y_len)
+    # the output at position i predicts token i + 1
+    return model.ar_predict_layer(xy_dec[0, x_len + prefix_len - 1:-1]).float()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="T2S quantization quality check")
+    parser.add_argument("-g", "--gpt_path", type=str, default="GPT_SoVITS/pretrained_models/gsv-v2final-pretrained/s1bert25hz-5kh-longer-epoch=12-step=369668.ckpt")
+    parser.add_argument("-m", "--mode", type=str, default="int8", choices=T2S_QUANTIZATION_MODES)
+    parser.add_argument("-n", "--num_samples", type=int, default=8)
+    parser.add_argument("--text_len", type=int, default=60)
+    parser.add_argument("--prompt_len", type=int, default=150)
+    parser.add_argument("--max_tokens", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    model = load_model(args.gpt_path)
+    quantized = quantize_t2s_model(deepcopy(model), args.mode)
+
+    matches = total = 0
+    kl_sum = 0.0
+    free_matches = free_total = common_prefix = 0
+    with torch.no_grad():
+        for _ in range(args.num_samples):
+            phones = torch.randint(0, model.phoneme_vocab_size, (1, args.text_len))
+            bert_feature = torch.zeros(1, 1024, args.text_len)
+            prompt = torch.randint(0, model.EOS, (1, args.prompt_len))
+
+            reference = greedy_decode(model, phones, bert_feature, prompt, args.max_tokens)
+            candidate = greedy_decode(quantized, phones, bert_feature, prompt, args.max_tokens)
+
+            y = torch.concat([prompt, reference.unsqueeze(0).long()], dim=1)
+            ref_logits = teacher_forced_logits(model, phones, bert_feature, y, args.prompt_len)
+            q_logits = teacher_forced_logits(quantized, phones, bert_feature, y, args.prompt_len)
+            matches += (ref_logits.argmax(dim=-1) == q_logits.argmax(dim=-1)).sum().item()
+            total += ref_logits.shape[0]
+            kl_sum += F.kl_div(
+                F.log_softmax(q_logits, dim=-1), F.log_softmax(ref_logits, dim=-1), log_target=True, reduction="sum"
+            ).item()
+
+            n = min(reference.shape[0], candidate.shape[0])
+            same = reference[:n] == candidate[:n]
+            free_matches += same.sum().item()
+            free_total += max(reference.shape[0], candidate.shape[0])
+            common_prefix += n if bool(same.all()) else int(torch.nonzero(~same)[0, 0])
+
+    print(f"mode: {args.mode}, samples: {args.num_samples}")
+    print(f"teacher-forced agreement: {matches / max(total, 1):.4f} ({matches}/{total}), mean KL: {kl_sum / max(total, 1):.5f}")
+    print(f"free-running agreement:   {free_matches / max(free_total, 1):.4f}, mean common prefix: {common_prefix / args.num_samples:.1f} tokens")
+
+
+if __name__ == "__main__":
+    main()
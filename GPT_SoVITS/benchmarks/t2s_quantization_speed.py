@@ -0,0 +1,78 @@
+"""
+CPU throughput of the T2S decoder, float32 vs int8 / bf16 quantization.
+
+Run from the project root (GPT-SoVITS):
+    python -m GPT_SoVITS.benchmarks.t2s_quantization_speed --steps 300 --threads 4
+
+Measures the prefill time and the decode tokens/s (transformer step + prediction layer) of the same
+weights in each mode. Without -g the weights are randomly initialized from the config, which is
+enough for speed. See t2s_quantization_quality for the effect on the generated tokens.
+"""
+import argparse
+from copy import deepcopy
+from time import perf_counter
+
+import torch
+import yaml
+
+from ..AR.models.t2s_model import Text2SemanticDecoder
+from ..AR.models.t2s_quantization import T2S_QUANTIZATION_MODES, quantize_t2s_model
+from .t2s_quantization_quality import load_model
+
+
+def bench(model, dtype, batch_size, prompt_len, steps):
+    x = torch.randn(batch_size, prompt_len, model.model_dim, dtype=dtype)
+    attn_mask = torch.zeros(batch_size, model.num_head, prompt_len, prompt_len, dtype=torch.bool)
+
+    t0 = perf_counter()
+    xy_dec, kv_cache = model.t2s_transformer.process_prompt(x, attn_mask, None, True, prompt_len + steps)
+    model.ar_predict_layer(xy_dec[:, -1])
+    prefill = perf_counter() - t0
+
+    y = torch.randint(0, model.EOS, (batch_size, 1))
+    t0 = perf_counter()
+    for idx in range(steps):
+        y_emb = model.ar_audio_embedding(y)
+        xy_pos = y_emb * model.ar_audio_position.x_scale + model.ar_audio_position.alpha \
+                 * model.ar_audio_position.pe[:, idx].to(dtype=y_emb.dtype)
+        xy_dec, kv_cache = model.t2s_transformer.decode_next_token(xy_pos, kv_cache)
+        logits = model.ar_predict_layer(xy_dec[:, -1])
+        y = torch.argmax(logits[:, :-1], dim=-1, keepdim=True)
+    return prefill, steps * batch_size / (perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="T2S CPU quantization throughput benchmark")
+    parser.add_argument("-c", "--config", type=str, default="GPT_SoVITS/configs/s1longer-v2.yaml")
+    parser.add_argument("-g", "--gpt_path", type=str, default=None)
+    parser.add_argument("-b", "--batch_size", type=int, default=1)
+    parser.add_argument("--prompt_len", type=int, default=200)
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads, 0 keeps the default")
+    parser.add_argument("--modes", type=str, nargs="+", default=T2S_QUANTIZATION_MODES, choices=T2S_QUANTIZATION_MODES)
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    if args.gpt_path is not None:
+        model = load_model(args.gpt_path)
+    else:
+        with open(args.config, "r") as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)
+        model = Text2SemanticDecoder(config).eval()
+
+    results = {}
+    with torch.no_grad():
+        results["fp32"] = bench(model, torch.float32, args.batch_size, args.prompt_len, args.steps)
+        for mode in args.modes:
+            quantized = quantize_t2s_model(deepcopy(model), mode)
+            dtype = torch.bfloat16 if mode == "bf16" else torch.float32
+            results[mode] = bench(quantized, dtype, args.batch_size, args.prompt_len, args.steps)
+
+    base = results["fp32"][1]
+    for mode, (prefill, tokens_per_s) in results.items():
+        print(f"{mode:>5}: prefill {prefill * 1000:.1f} ms, decode {tokens_per_s:.1f} tokens/s ({tokens_per_s / base:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Tokens/s of the T2S decode step, dynamic shapes vs fixed-shape buffers.
+
+Run from the project root (GPT-SoVITS):
+    python -m GPT_SoVITS.benchmarks.t2s_static_decode --steps 500
+
+"dynamic" is the decode step of `infer_panel_batch_infer`: the attention mask is grown with F.pad,
+the positional encoding is sliced by the step and the repetition penalty gathers the whole history.
+"static" is `Text2SemanticDecoder.decode_step_static`, where all of those are fixed-size buffers.
+On cuda the static step is compiled with torch.compile(mode="reduce-overhead").
+"""
+import argparse
+from time import perf_counter
+
+import torch
+import torch.nn.functional as F
+import yaml
+
+from ..AR.models.t2s_model import Text2SemanticDecoder
+from ..AR.models.utils import sample
+
+
+def sync(device):
+    if "cuda" in str(device):
+        torch.cuda.synchronize()
+
+
+def prefill(model, batch_size, prompt_len, steps, device):
+    x = torch.randn(batch_size, prompt_len, model.model_dim, device=device)
+    attn_mask = torch.zeros(batch_size, model.num_head, prompt_len, prompt_len, dtype=torch.bool, device=device)
+    _, kv_cache = model.t2s_transformer.process_prompt(x, attn_mask, None, False, prompt_len + steps)
+    y = torch.randint(0, model.EOS, (batch_size, prompt_len), dtype=torch.int, device=device)
+    return kv_cache, y
+
+
+def bench_dynamic(model, batch_size, prompt_len, steps, sampling_kwargs, device):
+    kv_cache, y = prefill(model, batch_size, prompt_len, steps, device)
+    attn_mask = torch.zeros(batch_size, model.num_head, 1, prompt_len, dtype=torch.bool, device=device)
+
+    sync(device)
+    t0 = perf_counter()
+    for idx in range(steps):
+        attn_mask = F.pad(attn_mask, (0, 1), value=False)
+        y_emb = model.ar_audio_embedding(y[:, -1:])
+        xy_pos = y_emb * model.ar_audio_position.x_scale + model.ar_audio_position.alpha \
+                 * model.ar_audio_position.pe[:, idx].to(dtype=y_emb.dtype, device=device)
+        xy_dec, kv_cache = model.t2s_transformer.decode_next_token(xy_pos, kv_cache, attn_mask, False)
+        logits = model.ar_predict_layer(xy_dec[:, -1])
+        samples = sample(logits, y, **sampling_kwargs)[0]
+        y = torch.concat([y, samples], dim=1)
+    sync(device)
+    return steps * batch_size / (perf_counter() - t0)
+
+
+def bench_static(model, batch_size, prompt_len, steps, sampling_kwargs, device, warmup):
+    kv_cache, y = prefill(model, batch_size, prompt_len, steps + warmup, device)
+    kv_cache.zero_unused()
+    attn_mask = torch.ones(batch_size, 1, 1, prompt_len + steps + warmup, dtype=torch.bool, device=device)
+    attn_mask[..., :prompt_len] = False
+    presence = torch.zeros(batch_size, model.vocab_size, dtype=torch.bool, device=device)
+    presence.scatter_(1, y.long(), True)
+    pe = model.ar_audio_position.pe[0].to(device=device)
+    pos = torch.zeros(1, dtype=torch.long, device=device)
+    pe_pos = torch.zeros(1, dtype=torch.long, device=device)
+    y_last = y[:, -1:].clone()
+    decode_step = model.get_decode_step_static(torch.device(device))
+
+    def step(idx):
+        pos.fill_(prompt_len + idx)
+        pe_pos.fill_(idx)
+        attn_mask.index_fill_(-1, pos, False)
+        samples, _ = decode_step(
+            y_last, kv_cache, pos, pe_pos, pe, attn_mask, presence,
+            sampling_kwargs["top_k"], sampling_kwargs["top_p"], sampling_kwargs["temperature"], sampling_kwargs["repetition_penalty"]
+        )
+        y_last.copy_(samples)
+        presence.scatter_(1, samples.long(), True)
+
+    # the first calls compile the step on cuda
+    for idx in range(warmup):
+        step(idx)
+
+    sync(device)
+    t0 = perf_counter()
+    for idx in range(warmup, warmup + steps):
+        step(idx)
+    sync(device)
+    return steps * batch_size / (perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="T2S static-shape decode benchmark")
+    parser.add_argument("-c", "--config", type=str, default="GPT_SoVITS/configs/s1longer-v2.yaml")
+    parser.add_argument("-d", "--device", type=str, default="cpu")
+    parser.add_argument("-b", "--batch_size", type=int, default=1)
+    parser.add_argument("--prompt_len", type=int, default=200)
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=3)
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    model = Text2SemanticDecoder(config).to(args.device).eval()
+    sampling_kwargs = dict(top_k=15, top_p=1.0, temperature=1.0, repetition_penalty=1.35)
+
+    with torch.no_grad():
+        dynamic = bench_dynamic(model, args.batch_size, args.prompt_len, args.steps, sampling_kwargs, args.device)
+        static = bench_static(model, args.batch_size, args.prompt_len, args.steps, sampling_kwargs, args.device, args.warmup)
+    print(f"dynamic decode step: {dynamic:.1f} tokens/s")
+    print(f"static decode step:  {static:.1f} tokens/s ({static / dynamic:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Time to first audio of the VITS decode, whole sentence vs chunked streaming.
+
+Run from the project root (GPT-SoVITS):
+    python -m GPT_SoVITS.benchmarks.vits_streaming_ttfb --seconds 20 -d cuda
+
+Decodes random semantic tokens for a line of `--seconds` seconds with `SynthesizerTrn.decode` and
+with `SynthesizerTrn.decode_streaming`, and reports the time until the first samples are available
+and the total time. Without -s the weights are randomly initialized from configs/s2.json, which is
+enough for timing. The T2S time before the first sentence is not included.
+"""
+import argparse
+import json
+from time import perf_counter
+
+import torch
+
+from ..module.models import SynthesizerTrn
+
+
+def sync(device):
+    if "cuda" in str(device):
+        torch.cuda.synchronize()
+
+
+def load_model(config_path, weights_path, device):
+    if weights_path is not None:
+        dict_s2 = torch.load(weights_path, map_location="cpu")
+        hps = dict_s2["config"]
+    else:
+        with open(config_path, "r") as f:
+            hps = json.load(f)
+    model = SynthesizerTrn(
+        hps["data"]["filter_length"] // 2 + 1,
+        hps["train"]["segment_size"] // hps["data"]["hop_length"],
+        n_speakers=hps["data"]["n_speakers"],
+        **hps["model"]
+    )
+    if hasattr(model, "enc_q"):
+        del model.enc_q
+    if weights_path is not None:
+        model.load_state_dict(dict_s2["weight"], strict=False)
+    return model.to(device).eval(), hps["data"]["sampling_rate"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VITS streaming decode time-to-first-byte benchmark")
+    parser.add_argument("-c", "--config", type=str, default="GPT_SoVITS/configs/s2.json")
+    parser.add_argument("-s", "--sovits_path", type=str, default=None)
+    parser.add_argument("-d", "--device", type=str, default="cpu")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--chunk_size", type=int, default=25)
+    parser.add_argument("--overlap", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model, sampling_rate = load_model(args.config, args.sovits_path, args.device)
+    num_codes = int(args.seconds * 25)
+    codes = torch.randint(0, 1024, (1, 1, num_codes), device=args.device)
+    # roughly 10 phones per second of speech
+    text = torch.randint(1, 300, (1, int(args.seconds * 10)), device=args.device)
+    ge = torch.randn(1, model.gin_channels, 1, device=args.device)
+
+    full_times, first_times, stream_times = [], [], []
+    with torch.no_grad():
+        for _ in range(args.repeat + 1):  # the first round is warmup
+            sync(args.device)
+            t0 = perf_counter()
+            audio = model.decode(codes, text, ge)
+            sync(args.device)
+            full_times.append(perf_counter() - t0)
+
+            t0 = perf_counter()
+            first = None
+            num_samples = 0
+            for chunk in model.decode_streaming(codes, text, ge, chunk_size=args.chunk_size, overlap=args.overlap):
+                sync(args.device)
+                if first is None:
+                    first = perf_counter() - t0
+                num_samples += chunk.shape[0]
+            stream_times.append(perf_counter() - t0)
+            first_times.append(first)
+            assert num_samples == audio.shape[-1]
+
+    mean = lambda values: sum(values[1:]) / len(values[1:])
+    print(f"{num_samples / sampling_rate:.1f}s of audio, chunk_size={args.chunk_size}, overlap={args.overlap}")
+    print(f"decode:           first audio after {mean(full_times):.3f}s (total {mean(full_times):.3f}s)")
+    print(f"decode_streaming: first audio after {mean(first_times):.3f}s (total {mean(stream_times):.3f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Cold load time of GPT/SoVITS weights, original checkpoints vs safetensors.
+
+Run from the project root (GPT-SoVITS), after converting the weights with GPT_SoVITS/convert_weights.py:
+    python -m GPT_SoVITS.benchmarks.weights_load_time GPT_weights_v2 SoVITS_weights_v2 -d cuda
+
+For every .ckpt/.pth file that has a .safetensors file next to it, times `load_weights` (reading the file)
+and the whole load (building the model, load_state_dict and moving it to the device) for both formats,
+then prints the totals. Before each load the file is dropped from the page cache with posix_fadvise where
+the platform supports it, so the times are those of a cold start rather than of a second read.
+"""
+import argparse
+import os
+import sys
+from time import perf_counter
+
+import torch
+
+from ..AR.models.t2s_lightning_module import Text2SemanticLightningModule
+from ..module.models import SynthesizerTrn
+from ..weights_io import load_weights
+
+# needed to unpickle the utils.HParams in SoVITS .pth files
+sys.path.insert(0, os.path.join(os.getcwd(), 'GPT_SoVITS'))
+
+
+def sync(device):
+    if "cuda" in str(device):
+        torch.cuda.synchronize()
+
+
+def drop_from_page_cache(path):
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def build_model(checkpoint, device):
+    config = checkpoint["config"]
+    if "model" in config and "inter_channels" in config["model"]:
+        model = SynthesizerTrn(
+            config["data"]["filter_length"] // 2 + 1,
+            config["train"]["segment_size"] // config["data"]["hop_length"],
+            n_speakers=config["data"]["n_speakers"],
+            **config["model"]
+        )
+        if hasattr(model, "enc_q"):
+            del model.enc_q
+        model.load_state_dict(checkpoint["weight"], strict=False)
+    else:
+        model = Text2SemanticLightningModule(config, "****", is_train=False)
+        model.load_state_dict(checkpoint["weight"])
+    return model.to(device).eval()
+
+
+def time_load(path, device):
+    drop_from_page_cache(path)
+    sync(device)
+    t0 = perf_counter()
+    checkpoint = load_weights(path)
+    t1 = perf_counter()
+    build_model(checkpoint, device)
+    sync(device)
+    return t1 - t0, perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GPT/SoVITS weights cold load time benchmark")
+    parser.add_argument("paths", nargs="+", help="folders of converted weights")
+    parser.add_argument("-d", "--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    totals = {"checkpoint": [0.0, 0.0], "safetensors": [0.0, 0.0]}
+    count = 0
+    for folder in args.paths:
+        for name in sorted(os.listdir(folder)):
+            if not (name.endswith(".ckpt") or name.endswith(".pth")):
+                continue
+            path = os.path.join(folder, name)
+            converted = os.path.splitext(path)[0] + ".safetensors"
+            if not os.path.exists(converted):
+                print(f"skipping {path}, it has not been converted")
+                continue
+            with torch.no_grad():
+                read_ckpt, total_ckpt = time_load(path, args.device)
+                read_st, total_st = time_load(converted, args.device)
+            totals["checkpoint"][0] += read_ckpt
+            totals["checkpoint"][1] += total_ckpt
+            totals["safetensors"][0] += read_st
+            totals["safetensors"][1] += total_st
+            count += 1
+            print(f"{name}: read {read_ckpt:.2f}s -> {read_st:.2f}s, total {total_ckpt:.2f}s -> {total_st:.2f}s")
+
+    if count == 0:
+        print("no converted weights found")
+        return
+    for fmt, (read, total) in totals.items():
+        print(f"{fmt:12s} {count} files: read {read:.2f}s, total {total:.2f}s ({total / count:.2f}s per file)")
+
+
+if __name__ == "__main__":
+    main()
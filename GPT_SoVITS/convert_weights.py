@@ -0,0 +1,46 @@
+import argparse
+import os
+import sys
+from time import perf_counter
+
+from .weights_io import convert_weights
+
+# Invoke this script from the project root (GPT-SoVITS) using a terminal/command prompt as follows:
+# python -m GPT_SoVITS.convert_weights GPT_weights_v2 SoVITS_weights_v2 [more files or folders]
+#
+# Every .ckpt (GPT) and .pth (SoVITS) file is rewritten as a .safetensors file next to it, with the same name.
+# The inference webui, api.py and api_v2.py load either format; the .safetensors files load faster and do not
+# need GPT_SoVITS on sys.path.
+
+# The SoVITS .pth files contain pickled utils.HParams objects, which only resolve with GPT_SoVITS on sys.path.
+sys.path.insert(0, os.path.join(os.getcwd(), 'GPT_SoVITS'))
+
+
+def find_checkpoints(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(".ckpt") or name.endswith(".pth"):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert GPT/SoVITS weights to safetensors")
+    parser.add_argument("paths", nargs="+", help="weight files, or folders of weight files")
+    parser.add_argument("--overwrite", action="store_true", help="convert again if the .safetensors file exists")
+    args = parser.parse_args()
+
+    for path in find_checkpoints(args.paths):
+        output_path = os.path.splitext(path)[0] + ".safetensors"
+        if os.path.exists(output_path) and not args.overwrite:
+            print(f"skipping {path}, {output_path} exists")
+            continue
+        t0 = perf_counter()
+        convert_weights(path, output_path)
+        print(f"{path} -> {output_path} ({perf_counter() - t0:.1f} s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -517,11 +517,8 @@ cnhubert.cnhubert_base_path = cnhubert_base_path
 
 @torch.jit.script
 def build_phone_level_feature(res:Tensor, word2ph:IntTensor):
-    phone_level_feature = []
-    for i in range(word2ph.shape[0]):
-        repeat_feature = res[i].repeat(word2ph[i].item(), 1)
-        phone_level_feature.append(repeat_feature)
-    phone_level_feature = torch.cat(phone_level_feature, dim=0)
+    # same as text/bert_feature.py expand_to_phones, without the transpose
+    phone_level_feature = res[:word2ph.shape[0]].repeat_interleave(word2ph.to(device=res.device, dtype=torch.long), dim=0)
     # [sum(word2ph), 1024]
     return phone_level_feature
 
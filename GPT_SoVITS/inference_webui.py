@@ -78,6 +78,10 @@ is_share = eval(is_share)
 if "_CUDA_VISIBLE_DEVICES" in os.environ:
     os.environ["CUDA_VISIBLE_DEVICES"] = os.environ["_CUDA_VISIBLE_DEVICES"]
 is_half = eval(os.environ.get("is_half", "True")) and torch.cuda.is_available()
+t2s_quantization = os.environ.get("t2s_quantization", "")  # cpu only: int8 | bf16
+ref_cache_dir = os.environ.get("ref_cache_dir", "") or None  # optional on-disk cache of reference specs/ge
+prompt_store_dir = os.environ.get("prompt_store_dir", "") or None  # optional persistent store of reference prompt semantics
+model_pool_size = int(os.environ.get("model_pool_size", "1"))  # number of GPT and of SoVITS weights kept loaded
 punctuation = set(['!', '?', '…', ',', '.', '-'," "])
 import gradio as gr
 from transformers import AutoModelForMaskedLM, AutoTokenizer
@@ -88,13 +92,20 @@ from .feature_extractor import cnhubert
 cnhubert.cnhubert_base_path = cnhubert_base_path
 
 from .module.models import SynthesizerTrn
+from .module.prompt_store import PromptSemanticStore
+from .TTS_infer_pack.model_pool import ModelPool
+from .module.ref_cache import RefCache, hash_file
 from .AR.models.t2s_lightning_module import Text2SemanticLightningModule
+from .AR.models.t2s_prefix_cache import T2SPrefixCache
+from .AR.models.t2s_quantization import quantize_t2s_model
 from .text import cleaned_text_to_sequence
+from .text.bert_feature import get_bert_features
 from .text.cleaner import clean_text
 from time import time as ttime
 from .module.mel_processing import spectrogram_torch
 from .tools.my_utils import load_audio
 from .tools.i18n.i18n import I18nAuto, scan_language_list
+from .weights_io import load_weights
 
 vq_model: SynthesizerTrn = None
 
@@ -141,19 +152,7 @@ else:
 
 
 def get_bert_feature(text, word2ph):
-    with torch.no_grad():
-        inputs = tokenizer(text, return_tensors="pt")
-        for i in inputs:
-            inputs[i] = inputs[i].to(device)
-        res = bert_model(**inputs, output_hidden_states=True)
-        res = torch.cat(res["hidden_states"][-3:-2], -1)[0].cpu()[1:-1]
-    assert len(word2ph) == len(text)
-    phone_level_feature = []
-    for i in range(len(word2ph)):
-        repeat_feature = res[i].repeat(word2ph[i], 1)
-        phone_level_feature.append(repeat_feature)
-    phone_level_feature = torch.cat(phone_level_feature, dim=0)
-    return phone_level_feature.T
+    return get_bert_features(bert_model, tokenizer, device, [text], [word2ph])[0]
 
 
 class DictToAttrRecursive(dict):
@@ -191,9 +190,8 @@ else:
     ssl_model = ssl_model.to(device)
 
 
-def change_sovits_weights(sovits_path,prompt_language=None,text_language=None):
-    global vq_model, hps, version, dict_language
-    dict_s2 = torch.load(sovits_path, map_location="cpu")
+def load_sovits_weights(sovits_path):
+    dict_s2 = load_weights(sovits_path)
     hps = dict_s2["config"]
     hps = DictToAttrRecursive(hps)
     hps.model.semantic_frame_rate = "25hz"
@@ -201,7 +199,6 @@ def change_sovits_weights(sovits_path,prompt_language=None,text_language=None):
         hps.model.version = "v1"
     else:
         hps.model.version = "v2"
-    version = hps.model.version
     # print("sovits版本:",hps.model.version)
     vq_model = SynthesizerTrn(
         hps.data.filter_length // 2 + 1,
@@ -217,6 +214,14 @@ def change_sovits_weights(sovits_path,prompt_language=None,text_language=None):
         vq_model = vq_model.to(device)
     vq_model.eval()
     print(vq_model.load_state_dict(dict_s2["weight"], strict=False))
+    return vq_model, hps
+
+
+def change_sovits_weights(sovits_path,prompt_language=None,text_language=None):
+    global vq_model, hps, version, dict_language, vits_weights_path
+    vq_model, hps = sovits_pool.get(weights_key(sovits_path))
+    version = hps.model.version
+    vits_weights_path = sovits_path
     dict_language = dict_language_v1 if version =='v1' else dict_language_v2
     with open("./weight.json")as f:
         data=f.read()
@@ -240,25 +245,60 @@ def change_sovits_weights(sovits_path,prompt_language=None,text_language=None):
 # The GPT-SoVITS project was originally structured in a hacky (imao) way where modifications to sys.path were abundant.
 # Unfortunately, this means that the pretrained SoVITS (.pth) files contain serialized classes that depend on that
 # structure. The following modification to the system path is required in order to load existing .pth files.
+# Weights converted with GPT_SoVITS/convert_weights.py (.safetensors) do not need it.
 now_dir = os.path.join(os.getcwd(), 'GPT_SoVITS')
 sys.path.insert(0, now_dir)
-change_sovits_weights(sovits_path)
 
 
-def change_gpt_weights(gpt_path):
-    global hz, max_sec, t2s_model, config
-    hz = 50
-    dict_s1 = torch.load(gpt_path, map_location="cpu")
+t2s_prefix_cache = T2SPrefixCache()
+ref_cache = RefCache(disk_dir=ref_cache_dir)
+prompt_store = PromptSemanticStore(prompt_store_dir)
+
+
+def load_gpt_weights(gpt_path):
+    dict_s1 = load_weights(gpt_path)
     config = dict_s1["config"]
-    max_sec = config["data"]["max_sec"]
     t2s_model = Text2SemanticLightningModule(config, "****", is_train=False)
     t2s_model.load_state_dict(dict_s1["weight"])
     if is_half == True:
         t2s_model = t2s_model.half()
     t2s_model = t2s_model.to(device)
     t2s_model.eval()
+    if t2s_quantization and device == "cpu":
+        quantize_t2s_model(t2s_model.model, t2s_quantization)
+    # gpt_path is loaded again when the file changed (see weights_key), its cached prefixes are stale then
+    t2s_prefix_cache.clear()
     total = sum([param.nelement() for param in t2s_model.parameters()])
     # print("Number of parameter: %.2fM" % (total / 1e6))
+    return t2s_model, config
+
+
+# Recently used weights stay loaded, so switching characters back and forth does not reload them from disk.
+# Both pools are keyed by the weights path and the mtime and size of the file, so weights retrained or
+# replaced under the same path are loaded again instead of serving the old ones.
+def weights_key(path):
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+sovits_pool = ModelPool(lambda key: load_sovits_weights(key[0]), model_pool_size)
+gpt_pool = ModelPool(lambda key: load_gpt_weights(key[0]), model_pool_size)
+
+
+def prefetch_weights(gpt_path=None, sovits_path=None):
+    # load the weights of the next character in the background while the current one is synthesizing
+    if gpt_path is not None:
+        gpt_pool.prefetch(weights_key(gpt_path))
+    if sovits_path is not None:
+        sovits_pool.prefetch(weights_key(sovits_path))
+
+
+def change_gpt_weights(gpt_path):
+    global hz, max_sec, t2s_model, config, t2s_weights_path
+    hz = 50
+    t2s_model, config = gpt_pool.get(weights_key(gpt_path))
+    max_sec = config["data"]["max_sec"]
+    t2s_weights_path = gpt_path
     with open("./weight.json")as f:
         data=f.read()
         data=json.loads(data)
@@ -266,6 +306,7 @@ def change_gpt_weights(gpt_path):
     with open("./weight.json","w")as f:f.write(json.dumps(data))
 
 
+change_sovits_weights(sovits_path)
 change_gpt_weights(gpt_path)
 
 
@@ -286,6 +327,11 @@ def get_spepc(hps, filename):
     )
     return spec
 
+
+def get_ref(filename):
+    # spec and ge of a reference clip, cached by file content
+    return ref_cache.get_entry(vq_model, filename, lambda path: get_spepc(hps, path))
+
 def clean_text_inf(text, language, version):
     phones, word2ph, norm_text = clean_text(text, language, version)
     phones = cleaned_text_to_sequence(phones, version)
@@ -449,6 +495,12 @@ def validate_inputs(ref_wav_path, ref_text, ref_language, text, text_language, r
 
 
 def compute_prompt(ref_wav_path, zero_wav):
+    entry = prompt_store.get_entry(ref_wav_path, cnhubert_base_path, vq_model,
+                                   lambda path: compute_prompt_semantic(path, zero_wav))
+    return entry.prompt_semantic.unsqueeze(0).to(device)
+
+
+def compute_prompt_semantic(ref_wav_path, zero_wav):
     with torch.no_grad():
         wav16k, sr = librosa.load(ref_wav_path, sr=16000)
         # if wav16k.shape[0] > 160000 or wav16k.shape[0] < 48000:
@@ -469,9 +521,7 @@ def compute_prompt(ref_wav_path, zero_wav):
             1, 2
         )  # .float()
         codes = vq_model.extract_latent(ssl_content)
-        prompt_semantic = codes[0, 0]
-        prompt = prompt_semantic.unsqueeze(0).to(device)
-    return prompt
+    return codes[0, 0], wav16k.shape[0] - zero_wav_torch.shape[0]
 
 
 def preprocess_reference_text(ref_text, ref_language, ref_free, precomputed_phones1, precomputed_bert1):
@@ -508,15 +558,14 @@ def preprocess_reference_audios(ref_wav_path, ref_free, inp_refs, precomputed_pr
     if precomputed_ge is not None:
         ge = precomputed_ge
     else:
-        refers = [get_spepc(hps, ref_wav_path).to(dtype).to(device)]
+        ges = [get_ref(ref_wav_path).ge]
         if(inp_refs):
             for path in inp_refs:
                 try:
-                    refer = get_spepc(hps, path.name).to(dtype).to(device)
-                    refers.append(refer)
+                    ges.append(get_ref(path.name).ge)
                 except:
                     traceback.print_exc()
-        ge = vq_model.get_ge(refers)
+        ge = torch.stack(ges, 0).mean(0)  # same as vq_model.get_ge(refers)
     return prompt, ge
 
 
@@ -567,6 +616,15 @@ def get_tts_wav(ref_wav_path, ref_text, ref_language, prompt_text, prompt_langua
     prompt, ge = preprocess_reference_audios(ref_wav_path, ref_free, inp_refs, precomputed_prompt, precomputed_ge)
     prompt_texts, prompt_language = preprocess_and_slice_prompt(prompt_text, prompt_language, how_to_cut)
 
+    prompt_prefix = None
+    if phones1 is not None and prompt is not None:
+        # the reference is identified by the audio content and the text it was computed from, precomputed inputs are not cached
+        reference_id = None
+        if precomputed_prompt is None and precomputed_phones1 is None and precomputed_bert1 is None:
+            reference_id = (vits_weights_path, hash_file(ref_wav_path), ref_text, ref_language, version)
+        with torch.no_grad():
+            prompt_prefix = t2s_prefix_cache.get_prefix(t2s_model.model, t2s_weights_path, reference_id, phones1.to(device), bert1.to(device), prompt)
+
     t1 = ttime()
     t.append(t1-t0)
 
@@ -607,6 +665,7 @@ def get_tts_wav(ref_wav_path, ref_text, ref_language, prompt_text, prompt_langua
                     top_p=top_p,
                     early_stop_num=hz * max_sec,
                     temperature=temperature,
+                    prompt_prefix=prompt_prefix,
                 )
                 pred_semantic = pred_semantic[:, -idx:].unsqueeze(0)
                 cache[i_text] = pred_semantic
@@ -761,11 +820,11 @@ def get_weights_names(GPT_weight_root, SoVITS_weight_root):
     SoVITS_names = [i for i in pretrained_sovits_name]
     for path in SoVITS_weight_root:
         for name in os.listdir(path):
-            if name.endswith(".pth"): SoVITS_names.append("%s/%s" % (path, name))
+            if name.endswith(".pth") or name.endswith(".safetensors"): SoVITS_names.append("%s/%s" % (path, name))
     GPT_names = [i for i in pretrained_gpt_name]
     for path in GPT_weight_root:
         for name in os.listdir(path):
-            if name.endswith(".ckpt"): GPT_names.append("%s/%s" % (path, name))
+            if name.endswith(".ckpt") or name.endswith(".safetensors"): GPT_names.append("%s/%s" % (path, name))
     return SoVITS_names, GPT_names
 
 
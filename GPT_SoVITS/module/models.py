@@ -252,12 +252,24 @@ class TextEncoder(nn.Module):
         y = self.mrte(y, y_mask, text, text_mask, ge)
         y = self.encoder2(y * y_mask, y_mask)
         if(speed!=1):
-            y = F.interpolate(y, size=int(y.shape[-1] / speed)+1, mode="linear")
-            y_mask = F.interpolate(y_mask, size=y.shape[-1], mode="nearest")
+            y, y_mask = self.change_speed(y, y_lengths, speed)
         stats = self.proj(y) * y_mask
         m, logs = torch.split(stats, self.out_channels, dim=1)
         return y, m, logs, y_mask
 
+    def change_speed(self, y, y_lengths, speed):
+        # stretch every item to its own length, the padding of a batch must not be interpolated into it
+        new_lengths = [int(length / speed) + 1 for length in y_lengths.tolist()]
+        max_length = max(new_lengths)
+        ys = []
+        for i, (length, new_length) in enumerate(zip(y_lengths.tolist(), new_lengths)):
+            y_item = F.interpolate(y[i:i + 1, :, :length], size=new_length, mode="linear")
+            ys.append(F.pad(y_item, (0, max_length - new_length)))
+        y = torch.cat(ys, dim=0)
+        y_lengths = torch.LongTensor(new_lengths).to(y.device)
+        y_mask = torch.unsqueeze(commons.sequence_mask(y_lengths, max_length), 1).to(y.dtype)
+        return y, y_mask
+
     def extract_latent(self, x):
         x = self.ssl_proj(x)
         quantized, codes, commit_loss, quantized_list = self.quantizer(x)
@@ -424,6 +436,7 @@ class Generator(torch.nn.Module):
         super(Generator, self).__init__()
         self.num_kernels = len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_rates)
+        self.upsample_rates = upsample_rates
         self.conv_pre = Conv1d(
             initial_channel, upsample_initial_channel, 7, 1, padding=3
         )
@@ -457,20 +470,25 @@ class Generator(torch.nn.Module):
         if gin_channels != 0:
             self.cond = nn.Conv1d(gin_channels, upsample_initial_channel, 1)
 
-    def forward(self, x, g=None):
+    def forward(self, x, g=None, x_mask=None):
+        # with x_mask [B, 1, T], the padded frames are zeroed before every convolution, so each item
+        # of a padded batch is decoded as if it was alone
         x = self.conv_pre(x)
         if g is not None:
             x = x + self.cond(g)
 
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, modules.LRELU_SLOPE)
+            if x_mask is not None:
+                x = x * x_mask
+                x_mask = x_mask.repeat_interleave(self.upsample_rates[i], dim=2)
             x = self.ups[i](x)
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
+                    xs = self.resblocks[i * self.num_kernels + j](x, x_mask)
                 else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
+                    xs += self.resblocks[i * self.num_kernels + j](x, x_mask)
             x = xs / self.num_kernels
         x = F.leaky_relu(x)
         x = self.conv_post(x)
@@ -1023,6 +1041,80 @@ class SynthesizerTrn(nn.Module):
         o = self.dec((z * y_mask)[:, :, :], g=ge)
         return o
 
+    @torch.no_grad()
+    def decode_streaming(self, codes, text, ge, noise_scale=0.5, speed=1, chunk_size=25, overlap=4):
+        """
+        Same as `decode`, but yields the waveform in chunks of `chunk_size` latent frames as soon as
+        each one is vocoded. enc_p and flow run once over the whole segment, only `dec` runs per chunk.
+        Every chunk is vocoded with `overlap` extra latent frames of context on both sides, which are
+        cut off again, and the first overlap // 2 frames of a chunk are crossfaded with the right
+        context of the previous chunk. The concatenated chunks have the length of `decode`.
+        Yields:
+            Tensor [T_chunk], waveform chunks.
+        """
+        y_lengths = torch.LongTensor([codes.size(2) * 2]).to(codes.device)
+        text_lengths = torch.LongTensor([text.size(-1)]).to(text.device)
+
+        quantized = self.quantizer.decode(codes)
+        if self.semantic_frame_rate == "25hz":
+            quantized = F.interpolate(
+                quantized, size=int(quantized.shape[-1] * 2), mode="nearest"
+            )
+        x, m_p, logs_p, y_mask = self.enc_p(
+            quantized, y_lengths, text, text_lengths, ge, speed
+        )
+        z_p = m_p + torch.randn_like(m_p) * torch.exp(logs_p) * noise_scale
+        z = self.flow(z_p, y_mask, g=ge, reverse=True) * y_mask
+
+        upsample_rate = math.prod(self.upsample_rates)
+        num_frames = z.shape[-1]
+        fade_len = (overlap // 2) * upsample_rate
+        fade_in = torch.linspace(0, 1, fade_len, dtype=z.dtype, device=z.device)
+        fade_out = 1 - fade_in
+        tail = None
+        for start in range(0, num_frames, chunk_size):
+            end = min(start + chunk_size, num_frames)
+            window_start = max(0, start - overlap)
+            window_end = min(num_frames, end + overlap)
+            o = self.dec(z[:, :, window_start:window_end], g=ge)[0, 0]
+
+            chunk = o[(start - window_start) * upsample_rate:(end - window_start) * upsample_rate]
+            if tail is not None:
+                n = min(tail.shape[0], chunk.shape[0])
+                chunk[:n] = tail[:n] * fade_out[:n] + chunk[:n] * fade_in[:n]
+            tail = o[(end - window_start) * upsample_rate:(end - window_start) * upsample_rate + fade_len]
+            yield chunk
+
+    @torch.no_grad()
+    def batched_decode(self, codes, code_lengths, text, text_lengths, ge, noise_scale=0.5, speed=1):
+        """
+        Decode a padded batch of segments, with the same result per item as `decode` on that item alone.
+        Args:
+            codes: LongTensor [1, B, T_codes], right-padded semantic tokens.
+            code_lengths: LongTensor [B].
+            text: LongTensor [B, T_text], right-padded phone ids.
+            text_lengths: LongTensor [B].
+            ge: Tensor [1 or B, gin_channels, 1], see get_ge.
+        Returns:
+            list of B waveforms [T_audio_i].
+        """
+        y_lengths = code_lengths * 2 if self.semantic_frame_rate == "25hz" else code_lengths
+        quantized = self.quantizer.decode(codes)
+        if self.semantic_frame_rate == "25hz":
+            quantized = F.interpolate(
+                quantized, size=int(quantized.shape[-1] * 2), mode="nearest"
+            )
+        x, m_p, logs_p, y_mask = self.enc_p(
+            quantized, y_lengths, text, text_lengths, ge, speed
+        )
+        z_p = m_p + torch.randn_like(m_p) * torch.exp(logs_p) * noise_scale
+
+        z = self.flow(z_p, y_mask, g=ge, reverse=True)
+
+        o = self.dec(z * y_mask, g=ge, x_mask=y_mask)
+        audio_lengths = y_mask.sum(dim=(1, 2)).long() * math.prod(self.upsample_rates)
+        return [o[i, 0, :audio_lengths[i]] for i in range(o.shape[0])]
+
     def extract_latent(self, x):
         ssl = self.ssl_proj(x)
         quantized, codes, commit_loss, quantized_list = self.quantizer(ssl)
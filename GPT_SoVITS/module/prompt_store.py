@@ -0,0 +1,159 @@
+"""
+Persistent store of the prompt semantic tokens of reference audio.
+
+The prompt semantic of a reference clip (librosa at 16 kHz -> CNHuBERT -> `SynthesizerTrn.extract_latent`)
+only depends on the audio, the HuBERT weights and the `ssl_proj` + quantizer weights of the SoVITS model.
+The quantizer is frozen when fine-tuning SoVITS, so the tokens of a clip are shared by all models trained
+from the same pretrained weights.
+
+`PromptSemanticStore` keeps them in memory and, with `root`, in a directory of safetensors files (one per
+entry) with an `index.json` describing the entries. Several processes may share the directory: entries
+written by another process are found by their file name even if the index has not been reloaded.
+"""
+import hashlib
+import json
+import os
+import threading
+import weakref
+from typing import Callable, Optional, Tuple
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from .ref_cache import hash_file
+
+_quantizer_ids = weakref.WeakKeyDictionary()
+
+
+def quantizer_id(vits_model) -> str:
+    '''
+        sha1 of the weights extract_latent depends on (ssl_proj and the quantizer codebooks).
+    '''
+    dtype = next(vits_model.ssl_proj.parameters()).dtype
+    cached = _quantizer_ids.get(vits_model)
+    if cached is not None and cached[0] == dtype:
+        return cached[1]
+    sha1 = hashlib.sha1(str(dtype).encode("utf-8"))
+    for module in [vits_model.ssl_proj, vits_model.quantizer]:
+        for name, tensor in sorted(module.state_dict().items()):
+            sha1.update(name.encode("utf-8"))
+            sha1.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    _quantizer_ids[vits_model] = (dtype, sha1.hexdigest())
+    return sha1.hexdigest()
+
+
+class PromptEntry:
+    def __init__(self, prompt_semantic: torch.LongTensor, num_samples: int):
+        self.prompt_semantic = prompt_semantic  # [T], semantic tokens of the clip (+ 0.3 s of silence)
+        self.num_samples = num_samples          # length of the clip in samples at 16 kHz
+
+
+class PromptSemanticStore:
+    def __init__(self, root: Optional[str] = None):
+        self.root = root
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._index = {}
+        self._lock = threading.Lock()
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+            self._index = self._read_index()
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.root, "index.json")
+
+    def _read_index(self) -> dict:
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, name: str, info: dict):
+        # merge with what other processes may have written since it was loaded
+        index = self._read_index()
+        index.update(self._index)
+        index[name] = info
+        self._index = index
+        tmp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def make_key(audio_hash: str, hubert_id: str, quantizer_id: str) -> str:
+        return hashlib.sha1(f"{audio_hash}|{hubert_id}|{quantizer_id}".encode("utf-8")).hexdigest()
+
+    def _load(self, name: str) -> Optional[PromptEntry]:
+        if self.root is None:
+            return None
+        path = os.path.join(self.root, f"{name}.safetensors")
+        if not os.path.exists(path):
+            return None
+        with safe_open(path, framework="pt") as f:
+            prompt_semantic = f.get_tensor("prompt_semantic")
+            num_samples = int(f.metadata()["num_samples"])
+        return PromptEntry(prompt_semantic, num_samples)
+
+    def _save(self, name: str, entry: PromptEntry, info: dict):
+        if self.root is None:
+            return
+        path = os.path.join(self.root, f"{name}.safetensors")
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        save_file({"prompt_semantic": entry.prompt_semantic.contiguous()}, tmp_path,
+                  metadata={"num_samples": str(entry.num_samples)})
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._write_index(name, info)
+
+    @torch.no_grad()
+    def get_entry(
+        self,
+        ref_audio_path: str,
+        hubert_id: str,
+        vits_model,
+        compute: Callable[[str], Tuple[torch.LongTensor, int]],
+    ) -> PromptEntry:
+        '''
+            Return the prompt semantic of a reference clip, running `compute` only if it is not stored yet.
+            Args:
+                ref_audio_path: str, path of the reference audio.
+                hubert_id: str, identifies the CNHuBERT weights (e.g. cnhubert_base_path).
+                vits_model: SynthesizerTrn whose ssl_proj/quantizer produce the tokens.
+                compute: returns (prompt_semantic [T], number of samples at 16 kHz) of the audio file.
+            Returns:
+                PromptEntry, prompt_semantic is a LongTensor on the cpu.
+        '''
+        audio_hash = hash_file(ref_audio_path)
+        name = self.make_key(audio_hash, hubert_id, quantizer_id(vits_model))
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self.hits += 1
+                return entry
+
+        entry = self._load(name)
+        if entry is not None:
+            with self._lock:
+                self.disk_hits += 1
+        else:
+            with self._lock:
+                self.misses += 1
+            prompt_semantic, num_samples = compute(ref_audio_path)
+            entry = PromptEntry(prompt_semantic.detach().long().cpu(), int(num_samples))
+            self._save(name, entry, {
+                "audio_hash": audio_hash,
+                "hubert_id": hubert_id,
+                "quantizer_id": quantizer_id(vits_model),
+                "source": os.path.basename(ref_audio_path),
+                "length": entry.prompt_semantic.shape[0],
+            })
+        with self._lock:
+            self._entries[name] = entry
+        return entry
@@ -0,0 +1,170 @@
+"""
+Cache of the reference audio features of SynthesizerTrn.
+
+Every request loads its reference clips with ffmpeg, computes their linear spectrograms and runs
+`ref_enc` on them (`SynthesizerTrn.get_ge`). `RefCache` keeps the spectrogram and the `ge` of every
+clip, keyed on the content of the `ref_enc` weights and of the file, in an in-memory LRU and optionally
+in a directory of safetensors files that survives restarts. The weights are identified by their content
+rather than their path, so that weights overwritten in place do not hit stale entries of the disk tier.
+
+`get_ge` of several clips (reference + aux references) is the mean of the per-clip `ge`, so entries
+are stored per clip and every combination of aux references is served from them.
+"""
+import hashlib
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Optional
+
+import torch
+from safetensors.torch import load_file, save_file
+
+_ref_encoder_ids = weakref.WeakKeyDictionary()
+
+
+class RefEntry:
+    def __init__(self, spec: torch.Tensor, ge: torch.Tensor):
+        self.spec = spec  # [1, freq_bins, T], refer spec (the first 704 bins for v2, see SynthesizerTrn.get_ge)
+        self.ge = ge      # [1, gin_channels, 1]
+
+    @property
+    def nbytes(self) -> int:
+        return self.spec.numel() * self.spec.element_size() + self.ge.numel() * self.ge.element_size()
+
+
+@lru_cache(maxsize=4096)
+def _hash_file(path: str, size: int, mtime_ns: int) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def hash_file(path: str) -> str:
+    '''
+        sha1 of the file content. The file is only read again when its size or mtime changed.
+    '''
+    stat = os.stat(path)
+    return _hash_file(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def ref_encoder_id(vits_model) -> str:
+    '''
+        sha1 of what the cached spec and ge depend on: the version (spec bins fed to ref_enc), the dtype and
+        the ref_enc weights.
+    '''
+    dtype = next(vits_model.ref_enc.parameters()).dtype
+    cached = _ref_encoder_ids.get(vits_model)
+    if cached is not None and cached[0] == dtype:
+        return cached[1]
+    sha1 = hashlib.sha1(f"{vits_model.version}|{dtype}".encode("utf-8"))
+    for name, tensor in sorted(vits_model.ref_enc.state_dict().items()):
+        sha1.update(name.encode("utf-8"))
+        sha1.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    _ref_encoder_ids[vits_model] = (dtype, sha1.hexdigest())
+    return sha1.hexdigest()
+
+
+class RefCache:
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024, disk_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(encoder_id: str, ref_audio_path: str) -> tuple:
+        return (encoder_id, hash_file(ref_audio_path))
+
+    def get(self, key: tuple) -> Optional[RefEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: tuple, entry: RefEntry):
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key).nbytes
+            if entry.nbytes > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self.nbytes += entry.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def _disk_path(self, key: tuple) -> str:
+        encoder_id, file_hash = key
+        return os.path.join(self.disk_dir, f"{encoder_id[:16]}_{file_hash}.safetensors")
+
+    def _load_from_disk(self, key: tuple, dtype: torch.dtype, device) -> Optional[RefEntry]:
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        tensors = load_file(path, device=str(device))
+        return RefEntry(tensors["spec"].to(dtype), tensors["ge"].to(dtype))
+
+    def _save_to_disk(self, key: tuple, entry: RefEntry):
+        if self.disk_dir is None:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        save_file({"spec": entry.spec.contiguous().cpu(), "ge": entry.ge.contiguous().cpu()}, tmp_path)
+        os.replace(tmp_path, path)
+
+    @torch.no_grad()
+    def get_entry(
+        self,
+        vits_model,
+        ref_audio_path: str,
+        load_spec: Callable[[str], torch.Tensor],
+    ) -> RefEntry:
+        '''
+            Return the cached spec and ge of a reference clip, computing them with `vits_model` on a miss.
+            Args:
+                vits_model: SynthesizerTrn, identified by ref_encoder_id.
+                ref_audio_path: str, path of the reference audio.
+                load_spec: loads the audio file and returns its spectrogram [1, freq_bins, T].
+            Returns:
+                RefEntry with spec and ge in the dtype and on the device of `vits_model`.
+        '''
+        key = self.make_key(ref_encoder_id(vits_model), ref_audio_path)
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+
+        param = next(vits_model.ref_enc.parameters())
+        entry = self._load_from_disk(key, param.dtype, param.device)
+        if entry is not None:
+            with self._lock:
+                self.disk_hits += 1
+        else:
+            with self._lock:
+                self.misses += 1
+            spec = load_spec(ref_audio_path).to(dtype=param.dtype, device=param.device)
+            if vits_model.version != "v1":
+                spec = spec[:, :704]
+            entry = RefEntry(spec, vits_model.get_ge(spec))
+            self._save_to_disk(key, entry)
+        self.put(key, entry)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
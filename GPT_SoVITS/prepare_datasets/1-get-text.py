@@ -11,11 +11,13 @@ if "_CUDA_VISIBLE_DEVICES" in os.environ:
      os.environ["CUDA_VISIBLE_DEVICES"] = os.environ["_CUDA_VISIBLE_DEVICES"]
 opt_dir = os.environ.get("opt_dir")
 bert_pretrained_dir = os.environ.get("bert_pretrained_dir")
+bert_batch_size = int(os.environ.get("bert_batch_size", 32))
 import torch
 is_half = eval(os.environ.get("is_half", "True")) and torch.cuda.is_available()
 version = os.environ.get('version', None)
 import traceback
 import os.path
+from ..text.bert_feature import get_bert_features
 from ..text.cleaner import clean_text
 from transformers import AutoModelForMaskedLM, AutoTokenizer
 from GPT_SoVITS.tools.my_utils import clean_path
@@ -62,25 +64,27 @@ if os.path.exists(txt_path) == False:
     else:
         bert_model = bert_model.to(device)
 
-    def get_bert_feature(text, word2ph):
-        with torch.no_grad():
-            inputs = tokenizer(text, return_tensors="pt")
-            for i in inputs:
-                inputs[i] = inputs[i].to(device)
-            res = bert_model(**inputs, output_hidden_states=True)
-            res = torch.cat(res["hidden_states"][-3:-2], -1)[0].cpu()[1:-1]
-
-        assert len(word2ph) == len(text)
-        phone_level_feature = []
-        for i in range(len(word2ph)):
-            repeat_feature = res[i].repeat(word2ph[i], 1)
-            phone_level_feature.append(repeat_feature)
-
-        phone_level_feature = torch.cat(phone_level_feature, dim=0)
-
-        return phone_level_feature.T
+    def save_bert_features(pending):
+        # pending: [name, path_bert, phones, word2ph, norm_text], bert_batch_size texts per forward pass
+        try:
+            features = get_bert_features(bert_model, tokenizer, device,
+                                         [item[4] for item in pending], [item[3] for item in pending], bert_batch_size, cache=None)
+        except:
+            # retry one by one, so that a bad text does not lose the features of the whole batch
+            features = [None] * len(pending)
+        for (name, path_bert, phones, word2ph, norm_text), bert_feature in zip(pending, features):
+            try:
+                if bert_feature is None:
+                    bert_feature = get_bert_features(bert_model, tokenizer, device, [norm_text], [word2ph], cache=None)[0]
+                assert bert_feature.shape[-1] == len(phones)
+                # torch.save(bert_feature, path_bert)
+                my_save(bert_feature.cpu(), path_bert)
+            except:
+                print(name, norm_text, traceback.format_exc())
+        pending.clear()
 
     def process(data, res):
+        pending = []
         for name, text, lan in data:
             try:
                 name=clean_path(name)
@@ -91,15 +95,15 @@ if os.path.exists(txt_path) == False:
                 )
                 path_bert = "%s/%s.pt" % (bert_dir, name)
                 if os.path.exists(path_bert) == False and lan == "zh":
-                    bert_feature = get_bert_feature(norm_text, word2ph)
-                    assert bert_feature.shape[-1] == len(phones)
-                    # torch.save(bert_feature, path_bert)
-                    my_save(bert_feature, path_bert)
+                    pending.append([name, path_bert, phones, word2ph, norm_text])
                 phones = " ".join(phones)
                 # res.append([name,phones])
                 res.append([name, phones, word2ph, norm_text])
             except:
                 print(name, text, traceback.format_exc())
+            if len(pending) >= bert_batch_size:
+                save_bert_features(pending)
+        save_bert_features(pending)
 
     todo = []
     res = []
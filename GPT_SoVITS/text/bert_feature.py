@@ -0,0 +1,65 @@
+"""
+Phone level BERT features of Chinese text.
+
+`get_bert_features` runs the texts through the BERT model in padded batches, so a request with many
+sentences (or a whole dataset) costs one forward pass per `batch_size` texts instead of one per text.
+The hidden states of each text are then cut out of the batch and repeated for the phones of each
+character, as given by its word2ph, with one `repeat_interleave` on the model's device.
+
+This is the only copy of the feature extraction: TextPreprocessor, inference_webui.py, api.py and
+prepare_datasets/1-get-text.py all call it. Features already in `bert_feature_cache` are not computed
+again, see bert_feature_cache.py.
+"""
+import os
+from typing import List, Optional
+
+import torch
+
+from .bert_feature_cache import BertFeatureCache, bert_model_id
+
+# bert_feature_cache_mb=0 disables the memory tier, bert_feature_cache_dir adds the disk tier
+bert_feature_cache = BertFeatureCache(
+    max_bytes=int(os.environ.get("bert_feature_cache_mb", 128)) * 1024 * 1024,
+    disk_dir=os.environ.get("bert_feature_cache_dir", None) or None,
+    max_disk_bytes=int(os.environ.get("bert_feature_cache_disk_mb", 1024)) * 1024 * 1024,
+)
+
+
+def get_bert_features(bert_model, tokenizer, device, texts: List[str], word2phs: List[List[int]],
+                      batch_size: int = 32, cache: Optional[BertFeatureCache] = bert_feature_cache) -> List[torch.Tensor]:
+    '''
+        Phone level features (1024 x phones, on `device`) of each of `texts`.
+            The texts are batched by length, so that the shorter ones are not padded to the longest.
+            Only the texts missing from `cache` (None for no cache) go through `bert_model`.
+    '''
+    features = [None] * len(texts)
+    keys = [None] * len(texts)
+    if cache is not None:
+        model_id = bert_model_id(bert_model)
+        for i in range(len(texts)):
+            keys[i] = cache.make_key(model_id, texts[i], word2phs[i])
+            features[i] = cache.get(keys[i], device)
+    order = sorted([i for i in range(len(texts)) if features[i] is None], key=lambda i: len(texts[i]))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        with torch.no_grad():
+            inputs = tokenizer([texts[i] for i in batch], return_tensors="pt", padding=True)
+            for key in inputs:
+                inputs[key] = inputs[key].to(device)
+            res = bert_model(**inputs, output_hidden_states=True)
+            hidden_states = torch.cat(res["hidden_states"][-3:-2], -1)
+            for i, hidden_state in zip(batch, hidden_states):
+                # one token per character between [CLS] and [SEP], followed by the padding
+                features[i] = expand_to_phones(hidden_state[1:len(texts[i]) + 1], word2phs[i], texts[i])
+                if cache is not None:
+                    cache.put(keys[i], features[i])
+    return features
+
+
+def expand_to_phones(res: torch.Tensor, word2ph: List[int], text: str) -> torch.Tensor:
+    '''
+        Repeat the feature of each character (rows of `res`) word2ph times: characters x 1024 -> 1024 x phones.
+    '''
+    assert len(word2ph) == len(text)
+    repeats = torch.tensor(word2ph, dtype=torch.long, device=res.device)
+    return res[:len(word2ph)].repeat_interleave(repeats, dim=0).T
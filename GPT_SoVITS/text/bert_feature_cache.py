@@ -0,0 +1,172 @@
+"""
+Content addressed cache of phone level BERT features.
+
+The features of a text only depend on its normalized text, its word2ph and the BERT weights (and their
+dtype), yet reference prompt texts, which never change for a voice, and repeated sentences went through
+roberta-large on every request. `BertFeatureCache` keeps them in an in-memory LRU of at most `max_bytes`
+(on the device they were computed on, like RefCache) and optionally in a directory of safetensors files
+of at most `max_disk_bytes`, the least recently used files being deleted first. Files that can not be
+read (e.g. truncated by a crash) are deleted and count as misses.
+
+The cache keeps its own copies: `put` stores a copy and `get` returns one, so callers may modify the
+features they get, e.g. in place on the GPU, without changing the cached ones.
+
+`get_bert_features` in bert_feature.py looks every text up here before batching the others, so
+TextPreprocessor, api.py and the webui share the cache.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import torch
+from safetensors.torch import load_file, save_file
+
+
+def bert_model_id(bert_model) -> str:
+    '''
+        Identifies the BERT weights and their dtype: the path they were loaded from, or the model object.
+    '''
+    name = getattr(getattr(bert_model, "config", None), "_name_or_path", None)
+    if not name:
+        name = f"{type(bert_model).__name__}@{id(bert_model)}"
+    param = next(bert_model.parameters(), None)
+    return f"{name}|{None if param is None else param.dtype}"
+
+
+def _nbytes(tensor: torch.Tensor) -> int:
+    return tensor.numel() * tensor.element_size()
+
+
+class BertFeatureCache:
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024, disk_dir: Optional[str] = None,
+                 max_disk_bytes: int = 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.nbytes = 0
+        self.disk_nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.disk_nbytes = sum(os.path.getsize(path) for path in self._disk_files())
+
+    @staticmethod
+    def make_key(model_id: str, norm_text: str, word2ph: List[int]) -> str:
+        return hashlib.sha1(f"{model_id}|{norm_text}|{list(word2ph)}".encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.safetensors")
+
+    def _disk_files(self) -> List[str]:
+        return [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir) if name.endswith(".safetensors")]
+
+    def _put(self, key: str, feature: torch.Tensor):
+        if key in self._entries:
+            self.nbytes -= _nbytes(self._entries.pop(key))
+        if _nbytes(feature) > self.max_bytes:
+            return
+        self._entries[key] = feature
+        self.nbytes += _nbytes(feature)
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _nbytes(evicted)
+
+    def _load_from_disk(self, key: str, device) -> Optional[torch.Tensor]:
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            feature = load_file(path, device=str(device))["feature"]
+            os.utime(path)  # the mtime orders the files for eviction
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # a corrupt file (SafetensorError, missing tensor, ...) is computed again
+            print(f"bert feature cache: removing unreadable {path}: {e}")
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                return None
+            with self._lock:
+                self.disk_nbytes -= size
+            return None
+        return feature
+
+    def _save_to_disk(self, key: str, feature: torch.Tensor):
+        if self.disk_dir is None:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        save_file({"feature": feature.contiguous().cpu()}, tmp_path)
+        with self._lock:
+            self.disk_nbytes += os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+            if self.disk_nbytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        # other processes may share the directory, so the sizes are read again
+        files = []
+        for path in self._disk_files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime_ns, stat.st_size, path))
+        files.sort()
+        self.disk_nbytes = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if self.disk_nbytes <= self.max_disk_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.disk_nbytes -= size
+
+    def get(self, key: str, device) -> Optional[torch.Tensor]:
+        '''
+            The cached feature (1024 x phones) on `device`, or None.
+        '''
+        with self._lock:
+            feature = self._entries.get(key)
+            if feature is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return feature.to(device, copy=True)
+        feature = self._load_from_disk(key, device)
+        with self._lock:
+            if feature is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._put(key, feature.clone())
+        return feature
+
+    def put(self, key: str, feature: torch.Tensor):
+        with self._lock:
+            self._put(key, feature.clone())
+        self._save_to_disk(key, feature)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "disk_bytes": self.disk_nbytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,216 @@
+"""
+Cache of `clean_text` results (phones, word2ph, norm_text) keyed on (text, language, version).
+
+Text normalization and g2p are the slowest part of the text front end on the cpu: jieba + the g2pW onnx
+model for zh, pyopenjtalk for ja, POS tagging + CMU lookup + the neural g2p_en predictor for en, g2pk2
+for ko. Reference texts and common sentences repeat across requests, so `CleanTextCache` keeps the
+results in an in-memory LRU of `max_entries` and, with `db_path`, in an SQLite database that survives
+restarts and is shared by the processes using the same file.
+
+The g2p output also depends on the dictionaries english.py and g2pw.py load when they are imported:
+the pickled dictionary if it exists, the .rep files it is built from otherwise, and the hot words of
+engdict-hot.rep. The content hash of those files is part of every key, so entries made with an older
+version of a dictionary are not used after it is edited and the process restarted (stale rows are
+deleted from the database). cleaner.py calls `refresh` whenever it imports a language module, which
+also covers the dictionaries built on that first import.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+current_file_path = os.path.dirname(__file__)
+
+CleanTextResult = Tuple[List[str], Optional[List[int]], str]
+
+
+def _loaded_dictionary(cache_path: str, source_paths: List[str]) -> List[str]:
+    # get_dict in english.py and g2pw.py reads the pickle if it exists and builds it from the sources otherwise
+    return [cache_path] if os.path.exists(cache_path) else source_paths
+
+
+def dictionary_paths() -> List[str]:
+    '''
+        The dictionary files the g2p of english.py, g2pw/g2pw.py and japanese.py reads. The japanese user
+        dictionary is optional: japanese.py compiles ja_userdic/userdict.csv into user.dict and loads it
+        when the user adds one.
+    '''
+    g2pw_path = os.path.join(current_file_path, "g2pw")
+    ja_userdic_path = os.path.join(current_file_path, "ja_userdic")
+    return (
+        _loaded_dictionary(
+            os.path.join(current_file_path, "engdict_cache.pickle"),
+            [os.path.join(current_file_path, "cmudict.rep"), os.path.join(current_file_path, "cmudict-fast.rep")],
+        )
+        + [os.path.join(current_file_path, "engdict-hot.rep"), os.path.join(current_file_path, "namedict_cache.pickle")]
+        + _loaded_dictionary(
+            os.path.join(g2pw_path, "polyphonic.pickle"),
+            [os.path.join(g2pw_path, "polyphonic.rep"), os.path.join(g2pw_path, "polyphonic-fix.rep")],
+        )
+        + [os.path.join(ja_userdic_path, "userdict.csv"), os.path.join(ja_userdic_path, "user.dict")]
+    )
+
+
+def dictionaries_fingerprint(paths: List[str]) -> str:
+    '''
+        sha1 of the content of the dictionaries (missing files included as such).
+    '''
+    sha1 = hashlib.sha1()
+    for path in paths:
+        sha1.update(os.path.basename(path).encode("utf-8"))
+        if not os.path.exists(path):
+            sha1.update(b"-")
+            continue
+        with open(path, "rb") as f:
+            sha1.update(hashlib.sha1(f.read()).digest())
+    return sha1.hexdigest()
+
+
+def _copy(result: CleanTextResult) -> CleanTextResult:
+    # callers may modify the lists they get
+    phones, word2ph, norm_text = result
+    return list(phones), None if word2ph is None else list(word2ph), norm_text
+
+
+class CleanTextCache:
+    def __init__(self, max_entries: int = 10000, db_path: Optional[str] = None,
+                 dictionary_paths: Optional[List[str]] = None):
+        '''
+            Args:
+                dictionary_paths: the files the g2p output depends on, None for `dictionary_paths()`.
+        '''
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.dictionary_paths = dictionary_paths
+        self.dictionaries = self._fingerprint()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_pid: Optional[int] = None
+
+    def _fingerprint(self) -> str:
+        return dictionaries_fingerprint(dictionary_paths() if self.dictionary_paths is None else self.dictionary_paths)
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        # one connection per process, a connection must not be used after fork (see forked_workers.py)
+        if self.db_path is None:
+            return None
+        if self._db is None or self._db_pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            db = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS clean_text (text TEXT, language TEXT, version TEXT, dictionaries TEXT, "
+                "phones TEXT, word2ph TEXT, norm_text TEXT, PRIMARY KEY (text, language, version, dictionaries))"
+            )
+            db.execute("DELETE FROM clean_text WHERE dictionaries != ?", (self.dictionaries,))
+            db.commit()
+            self._db = db
+            self._db_pid = os.getpid()
+        return self._db
+
+    def _load(self, key: tuple) -> Optional[CleanTextResult]:
+        try:
+            db = self._connect()
+            if db is None:
+                return None
+            row = db.execute(
+                "SELECT phones, word2ph, norm_text FROM clean_text "
+                "WHERE text = ? AND language = ? AND version = ? AND dictionaries = ?", key
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"clean_text cache: could not read {self.db_path}: {e}")
+            return None
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1]), row[2]
+
+    def _save(self, key: tuple, result: CleanTextResult):
+        try:
+            db = self._connect()
+            if db is None:
+                return
+            phones, word2ph, norm_text = result
+            db.execute(
+                "INSERT OR REPLACE INTO clean_text VALUES (?, ?, ?, ?, ?, ?, ?)",
+                key + (json.dumps(phones, ensure_ascii=False), json.dumps(word2ph), norm_text),
+            )
+            db.commit()
+        except sqlite3.Error as e:
+            print(f"clean_text cache: could not write {self.db_path}: {e}")
+
+    def _put(self, key: tuple, result: CleanTextResult):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, text: str, language: str, version: str,
+            compute: Callable[[str, str, str], CleanTextResult]) -> CleanTextResult:
+        '''
+            (phones, word2ph, norm_text) of `text`, calling `compute(text, language, version)` only if it is
+            neither in memory nor in the database. The lists returned are copies.
+        '''
+        if self.max_entries <= 0 and self.db_path is None:
+            return compute(text, language, version)
+        key = (text, language, version, self.dictionaries)
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return _copy(result)
+            result = self._load(key)
+            if result is not None:
+                self.db_hits += 1
+                self._put(key, result)
+                return _copy(result)
+            self.misses += 1
+
+        result = _copy(compute(text, language, version))
+        with self._lock:
+            # compute may have loaded the dictionaries and refreshed the fingerprint
+            key = (text, language, version, self.dictionaries)
+            self._put(key, result)
+            self._save(key, result)
+        return _copy(result)
+
+    def refresh(self) -> bool:
+        '''
+            Invalidate the cache if the dictionaries changed since their fingerprint was taken.
+            Returns whether they changed.
+        '''
+        if self._fingerprint() == self.dictionaries:
+            return False
+        self.invalidate()
+        return True
+
+    def invalidate(self):
+        '''
+            Drop the memory entries and use a new key for the current dictionaries.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.dictionaries = self._fingerprint()
+            if self._db is not None and self._db_pid == os.getpid():
+                self._db.close()
+            # reconnecting deletes the rows of the old dictionaries
+            self._db = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.db_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "dictionaries": self.dictionaries,
+                "hits": self.hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.db_hits) / lookups if lookups > 0 else 0.0,
+            }
@@ -1,6 +1,8 @@
 import os
+import sys
 
 from . import cleaned_text_to_sequence
+from .clean_text_cache import CleanTextCache
 from . import symbols as symbols_v1
 from . import symbols2 as symbols_v2
 
@@ -11,6 +13,12 @@ from . import symbols2 as symbols_v2
 #     from text import chinese2 as chinese
 #     from text.symbols2 import symbols
 
+# clean_text_cache_size=0 disables the cache, clean_text_cache_db keeps the results in an SQLite file
+clean_text_cache = CleanTextCache(
+    max_entries=int(os.environ.get("clean_text_cache_size", 10000)),
+    db_path=os.environ.get("clean_text_cache_db", None) or None,
+)
+
 special = [
     # ("%", "zh", "SP"),
     ("￥", "zh", "SP2"),
@@ -21,6 +29,20 @@ special = [
 
 def clean_text(text, language, version=None):
     if version is None:version=os.environ.get('version', 'v2')
+    return clean_text_cache.get(text, language, version, _clean_text)
+
+
+def _import_language_module(name):
+    module_name = "text." + name
+    loaded = module_name in sys.modules
+    language_module = __import__(module_name, fromlist=[name])
+    if not loaded:
+        # the language modules load their dictionaries when imported
+        clean_text_cache.refresh()
+    return language_module
+
+
+def _clean_text(text, language, version):
     if version == "v1":
         symbols = symbols_v1.symbols
         language_module_map = {"zh": "chinese", "ja": "japanese", "en": "english"}
@@ -34,7 +56,7 @@ def clean_text(text, language, version=None):
     for special_s, special_l, target_symbol in special:
         if special_s in text and language == special_l:
             return clean_special(text, language, special_s, target_symbol, version)
-    language_module = __import__("text."+language_module_map[language],fromlist=[language_module_map[language]])
+    language_module = _import_language_module(language_module_map[language])
     if hasattr(language_module,"text_normalize"):
         norm_text = language_module.text_normalize(text)
     else:
@@ -68,7 +90,7 @@ def clean_special(text, language, special_s, target_symbol, version=None):
     特殊静音段sp符号处理
     """
     text = text.replace(special_s, ",")
-    language_module = __import__("text."+language_module_map[language],fromlist=[language_module_map[language]])
+    language_module = _import_language_module(language_module_map[language])
     norm_text = language_module.text_normalize(text)
     phones = language_module.g2p(norm_text)
     new_ph = []
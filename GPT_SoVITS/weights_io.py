@@ -0,0 +1,66 @@
+"""
+Loading of GPT (.ckpt) and SoVITS (.pth) weights, from the original pickles or from safetensors.
+
+`torch.load` unpickles the whole checkpoint before any tensor can be used, and the SoVITS pickles reference
+`utils.HParams`, which only resolves with GPT_SoVITS on sys.path. `convert_weights.py` rewrites a checkpoint
+into a .safetensors file with the config (and info) stored as JSON in its metadata. `load_weights` opens
+those with `safe_open`, which memory-maps the file, so only the header is parsed and each tensor is read
+from the page cache straight into the state dict.
+
+Both formats load into the same dict: {"weight": state dict, "config": dict, "info": str or None}.
+"""
+import json
+import os
+from typing import Any, Optional
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+
+def is_safetensors(path: str) -> bool:
+    return path.endswith(".safetensors")
+
+
+def config_to_dict(config: Any) -> Any:
+    '''
+        Turn a config (dict or utils.HParams, possibly nested) into plain JSON types.
+    '''
+    if hasattr(config, "items"):
+        return {k: config_to_dict(v) for k, v in config.items()}
+    if isinstance(config, (list, tuple)):
+        return [config_to_dict(v) for v in config]
+    return config
+
+
+def load_weights(path: str, map_location="cpu") -> dict:
+    if not is_safetensors(path):
+        checkpoint = torch.load(path, map_location=map_location)
+        return {"weight": checkpoint["weight"], "config": checkpoint["config"], "info": checkpoint.get("info")}
+    with safe_open(path, framework="pt", device=str(map_location)) as f:
+        metadata = f.metadata() or {}
+        if "config" not in metadata:
+            raise ValueError(f"{path} has no config in its metadata, convert it with GPT_SoVITS/convert_weights.py")
+        weight = {key: f.get_tensor(key) for key in f.keys()}
+    return {"weight": weight, "config": json.loads(metadata["config"]), "info": metadata.get("info")}
+
+
+def save_weights(checkpoint: dict, path: str):
+    metadata = {"config": json.dumps(config_to_dict(checkpoint["config"]), ensure_ascii=False)}
+    if checkpoint.get("info") is not None:
+        metadata["info"] = str(checkpoint["info"])
+    # safetensors refuses tensors that share memory or are not contiguous
+    weight = {key: tensor.detach().contiguous().clone() for key, tensor in checkpoint["weight"].items()}
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save_file(weight, tmp_path, metadata=metadata)
+    os.replace(tmp_path, path)
+
+
+def convert_weights(path: str, output_path: Optional[str] = None) -> str:
+    '''
+        Rewrite a .ckpt/.pth checkpoint as .safetensors, next to it unless `output_path` is given.
+    '''
+    if output_path is None:
+        output_path = os.path.splitext(path)[0] + ".safetensors"
+    save_weights(load_weights(path), output_path)
+    return output_path
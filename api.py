@@ -25,6 +25,13 @@
 
 `-hb` - `cnhubert路径`
 `-b` - `bert路径`
+`-rcd` - `参考音频特征(spec/ge)磁盘缓存目录, 默认仅缓存在内存`
+`-psd` - `参考音频语义token持久化存储目录, 默认仅缓存在内存`
+`-mq` - `等待推理的最大请求数, 默认16; 队列已满时返回 429 及 Retry-After`
+`-to` - `请求超时秒数, 默认0(不超时); 超时返回 504`
+`-rct` - `相同请求结果的缓存秒数, 默认0 (不缓存, 只合并同时进行的相同请求)`
+`-rcm` - `相同请求结果缓存的最大MB数, 默认64`
+`-w` - `推理进程数, 默认1; 大于1时模型只在父进程加载一次, fork 出的各进程共享同一份权重内存, 请求由各进程分担 (仅限cpu推理, 不支持Windows)`
 
 ## 调用:
 
@@ -72,6 +79,12 @@ POST:
 RESP:
 成功: 直接返回 wav 音频流， http code 200
 失败: 返回包含错误信息的 json, http code 400
+队列已满: 返回包含错误信息的 json 及 Retry-After 头, http code 429
+超时: 返回包含错误信息的 json, http code 504
+
+推理在独立的线程中逐个进行, 不会阻塞其他接口。客户端断开连接或超时时, 推理在当前句子结束后取消。
+
+相同的请求 (参考音频内容, 文本, 参数及模型都相同) 只推理一次: 同时进行的请求共享同一次推理的音频流。本接口没有 seed, 重复请求默认重新推理以得到不同的结果; 指定 -rct 后, 之后 -rct 秒内的重复请求直接返回缓存的 (相同的) 音频。
 
 手动指定当次推理所使用的参考音频，并提供参数:
 GET:
@@ -97,6 +110,16 @@ RESP:
 失败: 返回包含错误信息的 json, http code 400
 
 
+### 推理队列
+
+endpoint: `/queue`
+
+GET:
+    `http://127.0.0.1:9880/queue`
+
+RESP: 等待/进行中的请求数, 相同请求合并/缓存命中数, clean_text 缓存命中率等统计信息的 json, http code 200
+
+
 ### 更换默认参考音频
 
 endpoint: `/change_refer`
@@ -142,12 +165,16 @@ RESP: 无
 
 
 import argparse
+import asyncio
+import hashlib
+import json
 import logging
 import os
 import re
 import signal
 import subprocess
 import sys
+import threading
 from io import BytesIO
 from time import time as ttime
 
@@ -166,9 +193,16 @@ from GPT_SoVITS.AR.models.t2s_lightning_module import Text2SemanticLightningModu
 from GPT_SoVITS.feature_extractor import cnhubert
 from GPT_SoVITS.module.mel_processing import spectrogram_torch
 from GPT_SoVITS.module.models import SynthesizerTrn
+from GPT_SoVITS.module.prompt_store import PromptSemanticStore
+from GPT_SoVITS.module.ref_cache import RefCache, hash_file
 from GPT_SoVITS.text import chinese
 from GPT_SoVITS.text import cleaned_text_to_sequence
-from GPT_SoVITS.text.cleaner import clean_text
+from GPT_SoVITS.text.bert_feature import get_bert_features
+from GPT_SoVITS.text.cleaner import clean_text, clean_text_cache
+from GPT_SoVITS.TTS_infer_pack.forked_workers import serve_forked, share_modules, worker_index
+from GPT_SoVITS.TTS_infer_pack.inference_executor import ExecutorClosed, InferenceExecutor, JobTimeout, QueueFull
+from GPT_SoVITS.TTS_infer_pack.request_coalescer import RequestCoalescer
+from GPT_SoVITS.weights_io import load_weights
 
 
 class DefaultRefer:
@@ -208,12 +242,13 @@ speaker_list = {}
 
 
 class Sovits:
-    def __init__(self, vq_model, hps):
+    def __init__(self, vq_model, hps, sovits_path):
         self.vq_model = vq_model
         self.hps = hps
+        self.sovits_path = sovits_path
 
 def get_sovits_weights(sovits_path):
-    dict_s2 = torch.load(sovits_path, map_location="cpu")
+    dict_s2 = load_weights(sovits_path)
     hps = dict_s2["config"]
     hps = DictToAttrRecursive(hps)
     hps.model.semantic_frame_rate = "25hz"
@@ -238,18 +273,19 @@ def get_sovits_weights(sovits_path):
     vq_model.eval()
     vq_model.load_state_dict(dict_s2["weight"], strict=False)
 
-    sovits = Sovits(vq_model, hps)
+    sovits = Sovits(vq_model, hps, sovits_path)
     return sovits
 
 class Gpt:
-    def __init__(self, max_sec, t2s_model):
+    def __init__(self, max_sec, t2s_model, gpt_path):
         self.max_sec = max_sec
         self.t2s_model = t2s_model
+        self.gpt_path = gpt_path
 
 global hz
 hz = 50
 def get_gpt_weights(gpt_path):
-    dict_s1 = torch.load(gpt_path, map_location="cpu")
+    dict_s1 = load_weights(gpt_path)
     config = dict_s1["config"]
     max_sec = config["data"]["max_sec"]
     t2s_model = Text2SemanticLightningModule(config, "****", is_train=False)
@@ -261,10 +297,12 @@ def get_gpt_weights(gpt_path):
     total = sum([param.nelement() for param in t2s_model.parameters()])
     logger.info("Number of parameter: %.2fM" % (total / 1e6))
 
-    gpt = Gpt(max_sec, t2s_model)
+    gpt = Gpt(max_sec, t2s_model, gpt_path)
     return gpt
 
 def change_gpt_sovits_weights(gpt_path,sovits_path):
+    if worker_index() is not None:
+        return JSONResponse({"code": 400, "message": "多进程模式下不支持更换模型, 请通过启动参数指定"}, status_code=400)
     try:
         gpt = get_gpt_weights(gpt_path)
         sovits = get_sovits_weights(sovits_path)
@@ -276,20 +314,7 @@ def change_gpt_sovits_weights(gpt_path,sovits_path):
 
 
 def get_bert_feature(text, word2ph):
-    with torch.no_grad():
-        inputs = tokenizer(text, return_tensors="pt")
-        for i in inputs:
-            inputs[i] = inputs[i].to(device)  #####输入是long不用管精度问题，精度随bert_model
-        res = bert_model(**inputs, output_hidden_states=True)
-        res = torch.cat(res["hidden_states"][-3:-2], -1)[0].cpu()[1:-1]
-    assert len(word2ph) == len(text)
-    phone_level_feature = []
-    for i in range(len(word2ph)):
-        repeat_feature = res[i].repeat(word2ph[i], 1)
-        phone_level_feature.append(repeat_feature)
-    phone_level_feature = torch.cat(phone_level_feature, dim=0)
-    # if(is_half==True):phone_level_feature=phone_level_feature.half()
-    return phone_level_feature.T
+    return get_bert_features(bert_model, tokenizer, device, [text], [word2ph])[0]
 
 
 def clean_text_inf(text, language, version):
@@ -423,6 +448,36 @@ def get_spepc(hps, filename):
     return spec
 
 
+def compute_prompt_semantic(sovits, filename):
+    zero_wav = np.zeros(int(sovits.hps.data.sampling_rate * 0.3), dtype=np.float16 if is_half == True else np.float32)
+    with torch.no_grad():
+        wav16k, sr = librosa.load(filename, sr=16000)
+        num_samples = wav16k.shape[0]
+        wav16k = torch.from_numpy(wav16k)
+        zero_wav_torch = torch.from_numpy(zero_wav)
+        if (is_half == True):
+            wav16k = wav16k.half().to(device)
+            zero_wav_torch = zero_wav_torch.half().to(device)
+        else:
+            wav16k = wav16k.to(device)
+            zero_wav_torch = zero_wav_torch.to(device)
+        wav16k = torch.cat([wav16k, zero_wav_torch])
+        ssl_content = ssl_model.model(wav16k.unsqueeze(0))["last_hidden_state"].transpose(1, 2)  # .float()
+        codes = sovits.vq_model.extract_latent(ssl_content)
+    return codes[0, 0], num_samples
+
+
+def get_prompt(sovits, filename):
+    # prompt semantic tokens of a reference clip, persisted by file content
+    return prompt_store.get_entry(filename, cnhubert_base_path, sovits.vq_model,
+                                  lambda path: compute_prompt_semantic(sovits, path)).prompt_semantic
+
+
+def get_ref(sovits, filename):
+    # spec and ge of a reference clip, cached by file content
+    return ref_cache.get_entry(sovits.vq_model, filename, lambda path: get_spepc(sovits.hps, path))
+
+
 def pack_audio(audio_bytes, data, rate):
     if media_type == "ogg":
         audio_bytes = pack_ogg(audio_bytes, data, rate)
@@ -554,7 +609,7 @@ def only_punc(text):
 
 
 splits = {"，", "。", "？", "！", ",", ".", "?", "!", "~", ":", "：", "—", "…", }
-def get_tts_wav(ref_wav_path, prompt_text, prompt_language, text, text_language, top_k= 15, top_p = 0.6, temperature = 0.6, speed = 1, inp_refs = None, spk = "default"):
+def get_tts_wav(ref_wav_path, prompt_text, prompt_language, text, text_language, top_k= 15, top_p = 0.6, temperature = 0.6, speed = 1, inp_refs = None, spk = "default", should_stop = None):
     infer_sovits = speaker_list[spk].sovits
     vq_model = infer_sovits.vq_model
     hps = infer_sovits.hps
@@ -567,34 +622,20 @@ def get_tts_wav(ref_wav_path, prompt_text, prompt_language, text, text_language,
     prompt_text = prompt_text.strip("\n")
     if (prompt_text[-1] not in splits): prompt_text += "。" if prompt_language != "en" else "."
     prompt_language, text = prompt_language, text.strip("\n")
-    dtype = torch.float16 if is_half == True else torch.float32
     zero_wav = np.zeros(int(hps.data.sampling_rate * 0.3), dtype=np.float16 if is_half == True else np.float32)
     with torch.no_grad():
-        wav16k, sr = librosa.load(ref_wav_path, sr=16000)
-        wav16k = torch.from_numpy(wav16k)
-        zero_wav_torch = torch.from_numpy(zero_wav)
-        if (is_half == True):
-            wav16k = wav16k.half().to(device)
-            zero_wav_torch = zero_wav_torch.half().to(device)
-        else:
-            wav16k = wav16k.to(device)
-            zero_wav_torch = zero_wav_torch.to(device)
-        wav16k = torch.cat([wav16k, zero_wav_torch])
-        ssl_content = ssl_model.model(wav16k.unsqueeze(0))["last_hidden_state"].transpose(1, 2)  # .float()
-        codes = vq_model.extract_latent(ssl_content)
-        prompt_semantic = codes[0, 0]
-        prompt = prompt_semantic.unsqueeze(0).to(device)
+        prompt = get_prompt(infer_sovits, ref_wav_path).unsqueeze(0).to(device)
 
-        refers=[]
+        ges=[]
         if(inp_refs):
             for path in inp_refs:
                 try:
-                    refer = get_spepc(hps, path).to(dtype).to(device)
-                    refers.append(refer)
+                    ges.append(get_ref(infer_sovits, path).ge)
                 except Exception as e:
                     logger.error(e)
-        if(len(refers)==0):
-            refers = [get_spepc(hps, ref_wav_path).to(dtype).to(device)]
+        if(len(ges)==0):
+            ges = [get_ref(infer_sovits, ref_wav_path).ge]
+        ge = torch.stack(ges, 0).mean(0)  # same as vq_model.get_ge(refers)
 
     t1 = ttime()
     version = vq_model.version
@@ -606,6 +647,9 @@ def get_tts_wav(ref_wav_path, prompt_text, prompt_language, text, text_language,
     audio_bytes = BytesIO()
 
     for text in texts:
+        # 请求已取消 (客户端断开或超时)
+        if should_stop is not None and should_stop():
+            break
         # 简单防止纯符号引发参考音频泄露
         if only_punc(text):
             continue
@@ -634,7 +678,7 @@ def get_tts_wav(ref_wav_path, prompt_text, prompt_language, text, text_language,
         t3 = ttime()
         audio = \
             vq_model.decode(pred_semantic, torch.LongTensor(phones2).to(device).unsqueeze(0),
-                            refers,speed=speed).detach().cpu().numpy()[
+                            ge,speed=speed).detach().cpu().numpy()[
                 0, 0]  ###试试重建不带上prompt部分
         max_audio=np.abs(audio).max()
         if max_audio>1:
@@ -659,6 +703,13 @@ def get_tts_wav(ref_wav_path, prompt_text, prompt_language, text, text_language,
 
 
 def handle_control(command):
+    if worker_index() is not None:
+        # 由父进程结束/重启全部推理进程
+        if command == "restart":
+            os.kill(os.getppid(), signal.SIGHUP)
+        elif command == "exit":
+            os.kill(os.getppid(), signal.SIGTERM)
+        return
     if command == "restart":
         os.execl(g_config.python_exec, g_config.python_exec, *sys.argv)
     elif command == "exit":
@@ -667,6 +718,8 @@ def handle_control(command):
 
 
 def handle_change(path, text, language):
+    if worker_index() is not None:
+        return JSONResponse({"code": 400, "message": "多进程模式下不支持更换默认参考音频, 请通过启动参数指定"}, status_code=400)
     if is_empty(path, text, language):
         return JSONResponse({"code": 400, "message": '缺少任意一项以下参数: "path", "text", "language"'}, status_code=400)
 
@@ -686,7 +739,24 @@ def handle_change(path, text, language):
     return JSONResponse({"code": 0, "message": "Success"}, status_code=200)
 
 
-def handle(refer_wav_path, prompt_text, prompt_language, text, text_language, cut_punc, top_k, top_p, temperature, speed, inp_refs):
+def request_key(refer_wav_path, prompt_text, prompt_language, text, text_language, top_k, top_p, temperature, speed, inp_refs):
+    # 由决定输出的所有内容生成, 参考音频按内容计算
+    inp_refs = list(inp_refs or [])
+    try:
+        refer_hash = hash_file(refer_wav_path)
+        inp_ref_hashes = sorted(hash_file(path) for path in inp_refs)
+    except OSError:  # 文件不存在或无法读取, 交给推理报错
+        return None
+    speaker = speaker_list["default"]
+    normalized = [
+        refer_hash, prompt_text.strip("\n"), prompt_language.lower(), text, text_language.lower(),
+        top_k, top_p, temperature, speed, inp_ref_hashes,
+        speaker.gpt.gpt_path, speaker.sovits.sovits_path, stream_mode, media_type,
+    ]
+    return hashlib.sha1(json.dumps(normalized, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+async def handle(refer_wav_path, prompt_text, prompt_language, text, text_language, cut_punc, top_k, top_p, temperature, speed, inp_refs):
     if (
             refer_wav_path == "" or refer_wav_path is None
             or prompt_text == "" or prompt_text is None
@@ -705,7 +775,44 @@ def handle(refer_wav_path, prompt_text, prompt_language, text, text_language, cu
     else:
         text = cut_text(text,cut_punc)
 
-    return StreamingResponse(get_tts_wav(refer_wav_path, prompt_text, prompt_language, text, text_language, top_k, top_p, temperature, speed, inp_refs), media_type="audio/"+media_type)
+    # 在推理线程中进行, 不阻塞事件循环
+    stop_event = threading.Event()
+    # 计算参考音频的哈希需要读文件, 不在事件循环中进行
+    key = await asyncio.get_running_loop().run_in_executor(
+        None, request_key, refer_wav_path, prompt_text, prompt_language, text, text_language, top_k, top_p, temperature, speed, inp_refs)
+    try:
+        # 相同的请求共享同一次推理
+        subscription = coalescer.subscribe(key, lambda: executor.submit(
+            lambda: get_tts_wav(refer_wav_path, prompt_text, prompt_language, text, text_language, top_k, top_p, temperature, speed, inp_refs, should_stop=stop_event.is_set),
+            timeout=args.timeout,
+            on_cancel=stop_event.set,
+        ))
+    except QueueFull as e:
+        return JSONResponse({"code": 429, "message": "推理队列已满", "queue": executor.stats()}, status_code=429, headers={"Retry-After": str(e.retry_after)})
+    except ExecutorClosed:
+        return JSONResponse({"code": 503, "message": "服务正在关闭"}, status_code=503, headers={"Retry-After": str(executor.retry_after())})
+
+    try:
+        first_chunk = await subscription.next()
+    except JobTimeout:
+        subscription.close()
+        return JSONResponse({"code": 504, "message": f"推理超时 ({args.timeout}s)"}, status_code=504)
+    except Exception as e:
+        subscription.close()
+        return JSONResponse({"code": 400, "message": str(e)}, status_code=400)
+
+    async def streaming_generator():
+        try:
+            yield first_chunk
+            async for chunk in subscription:
+                yield chunk
+        except JobTimeout:
+            logger.warning(f"推理超时 ({args.timeout}s)")
+        finally:
+            # 客户端断开连接时, 若没有其他相同的请求在等待则取消推理
+            subscription.close()
+
+    return StreamingResponse(streaming_generator(), media_type="audio/"+media_type)
 
 
 
@@ -767,6 +874,13 @@ parser.add_argument("-cp", "--cut_punc", type=str, default="", help="文本切
 # 切割常用分句符为 `python ./api.py -cp ".?!。？！"`
 parser.add_argument("-hb", "--hubert_path", type=str, default=g_config.cnhubert_path, help="覆盖config.cnhubert_path")
 parser.add_argument("-b", "--bert_path", type=str, default=g_config.bert_path, help="覆盖config.bert_path")
+parser.add_argument("-rcd", "--ref_cache_dir", type=str, default="", help="参考音频特征(spec/ge)磁盘缓存目录, 默认仅缓存在内存")
+parser.add_argument("-psd", "--prompt_store_dir", type=str, default="", help="参考音频语义token持久化存储目录, 默认仅缓存在内存")
+parser.add_argument("-mq", "--max_queue", type=int, default=16, help="等待推理的最大请求数, 队列已满时返回429")
+parser.add_argument("-to", "--timeout", type=float, default=0, help="请求超时秒数, 0为不超时")
+parser.add_argument("-rct", "--result_cache_ttl", type=float, default=0, help="相同请求结果的缓存秒数, 0为不缓存 (只合并同时进行的相同请求)")
+parser.add_argument("-rcm", "--result_cache_mb", type=int, default=64, help="相同请求结果缓存的最大MB数")
+parser.add_argument("-w", "--workers", type=int, default=1, help="推理进程数, 大于1时各进程共享模型权重, 仅限cpu推理")
 
 args = parser.parse_args()
 sovits_path = args.sovits_path
@@ -777,6 +891,8 @@ host = args.bind_addr
 cnhubert_base_path = args.hubert_path
 bert_path = args.bert_path
 default_cut_punc = args.cut_punc
+ref_cache = RefCache(disk_dir=args.ref_cache_dir or None)
+prompt_store = PromptSemanticStore(args.prompt_store_dir or None)
 
 # 应用参数配置
 default_refer = DefaultRefer(args.default_refer_path, args.default_refer_text, args.default_refer_language)
@@ -832,6 +948,12 @@ else:
     is_int32 = False
     logger.info(f"数据类型: int16")
 
+# 推理进程数
+workers = args.workers
+if workers > 1 and (not hasattr(os, "fork") or device != "cpu"):
+    logger.warn("多进程推理需要 fork 且仅支持cpu推理, 使用单进程")
+    workers = 1
+
 # 初始化模型
 cnhubert.cnhubert_base_path = cnhubert_base_path
 tokenizer = AutoTokenizer.from_pretrained(bert_path)
@@ -851,6 +973,22 @@ change_gpt_sovits_weights(gpt_path = gpt_path, sovits_path = sovits_path)
 # 接口部分
 # --------------------------------
 app = FastAPI()
+executor: InferenceExecutor = None
+coalescer: RequestCoalescer = None
+
+
+@app.on_event("startup")
+async def start_executor():
+    # 在每个推理进程中创建, -w 模式下 fork 之前启动的线程不会被继承
+    global executor, coalescer
+    executor = InferenceExecutor(concurrency=1, max_queue=args.max_queue)
+    coalescer = RequestCoalescer(args.result_cache_ttl, args.result_cache_mb * 1024 * 1024)
+
+
+@app.get("/queue")
+async def queue_stats():
+    return JSONResponse({**executor.stats(), "coalescer": coalescer.stats(), "clean_text_cache": clean_text_cache.stats()}, status_code=200)
+
 
 @app.post("/set_model")
 async def set_model(request: Request):
@@ -902,7 +1040,7 @@ async def change_refer(
 @app.post("/")
 async def tts_endpoint(request: Request):
     json_post_raw = await request.json()
-    return handle(
+    return await handle(
         json_post_raw.get("refer_wav_path"),
         json_post_raw.get("prompt_text"),
         json_post_raw.get("prompt_language"),
@@ -931,8 +1069,15 @@ async def tts_endpoint(
         speed: float = 1.0,
         inp_refs: list = Query(default=[])
 ):
-    return handle(refer_wav_path, prompt_text, prompt_language, text, text_language, cut_punc, top_k, top_p, temperature, speed, inp_refs)
+    return await handle(refer_wav_path, prompt_text, prompt_language, text, text_language, cut_punc, top_k, top_p, temperature, speed, inp_refs)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host=host, port=port, workers=1)
+    if workers > 1:
+        default_speaker = speaker_list["default"]
+        nbytes = share_modules([bert_model, ssl_model, default_speaker.gpt.t2s_model, default_speaker.sovits.vq_model])
+        logger.info(f"{workers}个推理进程共享 {nbytes / 1024 ** 2:.0f} MB 模型权重")
+        serve_forked(app, host, port, workers,
+                     on_restart=lambda: os.execl(g_config.python_exec, g_config.python_exec, *sys.argv))
+    else:
+        uvicorn.run(app, host=host, port=port, workers=1)
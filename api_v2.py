@@ -7,6 +7,12 @@
     `-a` - `绑定地址, 默认"127.0.0.1"`
     `-p` - `绑定端口, 默认9880`
     `-c` - `TTS配置文件路径, 默认"GPT_SoVITS/configs/tts_infer.yaml"`
+    `-cb` - `连续批处理的最大批大小, 默认0(关闭)`
+    `-j` - `同时进行的推理数, 默认1; 大于1时自动开启连续批处理`
+    `-q` - `等待推理的最大请求数, 默认16; 队列已满时返回 429 及 Retry-After`
+    `-t` - `请求的默认超时秒数, 默认0(不超时)`
+    `-rct` - `相同请求结果的缓存秒数, 默认30, 0为不缓存`
+    `-rcm` - `相同请求结果缓存的最大MB数, 默认64`
 
 ## 调用:
 
@@ -38,13 +44,38 @@ POST:
     "streaming_mode": False,      # bool. whether to return a streaming response.
     "seed": -1,                   # int. random seed for reproducibility.
     "parallel_infer": True,       # bool. whether to use parallel inference.
-    "repetition_penalty": 1.35    # float. repetition penalty for T2S model.
+    "repetition_penalty": 1.35,   # float. repetition penalty for T2S model.
+    "speculative_decoding": False,# bool. whether to use speculative decoding.
+    "draft_layers": 0,            # int. number of T2S layers used as draft model, 0 for a quarter of the layers.
+    "num_draft_tokens": 4,        # int. number of tokens proposed by the draft model per step.
+    "static_decode": False,       # bool. whether to use fixed-shape decode steps (compiled with torch.compile on cuda).
+    "streaming_chunk_size": 0,    # int. in streaming mode, vocode in chunks of this many latent frames (50 per second) instead of whole sentences, 0 to disable.
+    "token_streaming_size": 0,    # int. in streaming mode, vocode every this many semantic tokens while T2S is still decoding (lowest latency), 0 to disable.
+    "character": None,            # str.(optional) name of a character configured in `characters` of tts_infer.yaml, uses its GPT/SoVITS weights.
+    "timeout": 0                  # float.(optional) seconds before the request is cancelled, 0 for the -t default.
 }
 ```
 
 RESP:
 成功: 直接返回 wav 音频流， http code 200
 失败: 返回包含错误信息的 json, http code 400
+队列已满: 返回包含错误信息的 json 及 Retry-After 头, http code 429
+超时: 返回包含错误信息的 json, http code 504
+
+推理在独立的线程中进行, 不会阻塞其他接口。客户端断开连接或超时时, 推理会被取消。
+
+指定了 seed (不为-1) 的相同请求 (文本, 参考音频内容, 模型及所有参数都相同) 只推理一次: 同时到达的请求共享同一次推理的音频流, 之后 -rct 秒内的重复请求直接返回缓存的结果。
+
+### 推理队列
+
+endpoint: `/queue`
+
+GET:
+```
+http://127.0.0.1:9880/queue
+```
+
+RESP: 等待/进行中的请求数, 相同请求合并/缓存命中数, clean_text 缓存命中率等统计信息的 json, http code 200
 
 ### 命令控制
 
@@ -93,17 +124,36 @@ http://127.0.0.1:9880/set_sovits_weights?weights_path=GPT_SoVITS/pretrained_mode
 RESP: 
 成功: 返回"success", http code 200
 失败: 返回包含错误信息的 json, http code 400
+
+
+### 预加载角色模型
+
+endpoint: `/prefetch_character`
+
+在后台将角色的GPT/Sovits模型加载进常驻模型池(见 tts_infer.yaml 的 `characters`), 例如在当前角色合成时预加载下一个角色
+
+GET:
+```
+http://127.0.0.1:9880/prefetch_character?character=Twilight
+```
+
+RESP: 
+成功: 返回"success", http code 200
+失败: 返回包含错误信息的 json, http code 400
     
 """
 import argparse
+import asyncio
+import hashlib
+import json
 import os
 import signal
 import subprocess
 import sys
 import traceback
+import uuid
 import wave
 from io import BytesIO
-from typing import Generator
 
 import numpy as np
 import soundfile as sf
@@ -115,6 +165,10 @@ from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from GPT_SoVITS.TTS_infer_pack.TTS import TTS, TTS_Config
+from GPT_SoVITS.TTS_infer_pack.inference_executor import ExecutorClosed, InferenceExecutor, JobTimeout, QueueFull
+from GPT_SoVITS.TTS_infer_pack.request_coalescer import RequestCoalescer
+from GPT_SoVITS.module.ref_cache import hash_file
+from GPT_SoVITS.text.cleaner import clean_text_cache
 from GPT_SoVITS.TTS_infer_pack.text_segmentation_method import get_method_names as get_cut_method_names
 from GPT_SoVITS.tools.i18n.i18n import I18nAuto
 
@@ -125,6 +179,12 @@ parser = argparse.ArgumentParser(description="GPT-SoVITS api")
 parser.add_argument("-c", "--tts_config", type=str, default="GPT_SoVITS/configs/tts_infer.yaml", help="tts_infer路径")
 parser.add_argument("-a", "--bind_addr", type=str, default="127.0.0.1", help="default: 127.0.0.1")
 parser.add_argument("-p", "--port", type=int, default="9880", help="default: 9880")
+parser.add_argument("-cb", "--continuous_batching", type=int, default=0, help="连续批处理的最大批大小, 0为关闭. default: 0")
+parser.add_argument("-j", "--concurrency", type=int, default=1, help="同时进行的推理数. default: 1")
+parser.add_argument("-q", "--max_queue", type=int, default=16, help="等待推理的最大请求数. default: 16")
+parser.add_argument("-t", "--timeout", type=float, default=0, help="请求的默认超时秒数, 0为不超时. default: 0")
+parser.add_argument("-rct", "--result_cache_ttl", type=float, default=30, help="相同请求结果的缓存秒数, 0为不缓存. default: 30")
+parser.add_argument("-rcm", "--result_cache_mb", type=int, default=64, help="相同请求结果缓存的最大MB数. default: 64")
 args = parser.parse_args()
 config_path = args.tts_config
 # device = args.device
@@ -138,6 +198,13 @@ if config_path in [None, ""]:
 tts_config = TTS_Config(config_path)
 print(tts_config)
 tts_pipeline = TTS(tts_config)
+if args.continuous_batching > 0:
+    tts_pipeline.enable_continuous_batching(True, args.continuous_batching)
+elif args.concurrency > 1:
+    # concurrent runs share the T2S model, the scheduler decodes their segments in one batch
+    tts_pipeline.enable_continuous_batching(True, max(16, args.concurrency))
+executor = InferenceExecutor(args.concurrency, args.max_queue)
+coalescer = RequestCoalescer(args.result_cache_ttl, args.result_cache_mb * 1024 * 1024)
 
 APP = FastAPI()
 class TTS_Request(BaseModel):
@@ -161,6 +228,14 @@ class TTS_Request(BaseModel):
     streaming_mode:bool = False
     parallel_infer:bool = True
     repetition_penalty:float = 1.35
+    speculative_decoding:bool = False
+    draft_layers:int = 0
+    num_draft_tokens:int = 4
+    static_decode:bool = False
+    streaming_chunk_size:int = 0
+    token_streaming_size:int = 0
+    character:str = None
+    timeout:float = 0
 
 ### modify from https://github.com/RVC-Boss/GPT-SoVITS/pull/894/files
 def pack_ogg(io_buffer:BytesIO, data:np.ndarray, rate:int):
@@ -242,6 +317,7 @@ def check_params(req:dict):
     media_type:str = req.get("media_type", "wav")
     prompt_lang:str = req.get("prompt_lang", "")
     text_split_method:str = req.get("text_split_method", "cut5")
+    character:str = req.get("character", None)
 
     if ref_audio_path in [None, ""]:
         return JSONResponse(status_code=400, content={"message": "ref_audio_path is required"})
@@ -262,9 +338,55 @@ def check_params(req:dict):
     
     if text_split_method not in cut_method_names:
         return JSONResponse(status_code=400, content={"message": f"text_split_method:{text_split_method} is not supported"})
+    if character not in [None, ""] and character not in tts_config.characters:
+        return JSONResponse(status_code=400, content={"message": f"character: {character} is not configured"})
 
     return None
 
+
+def synthesize(req:dict, media_type:str, streaming_mode:bool):
+    # runs on an executor thread, yields the encoded response body
+    tts_generator = tts_pipeline.run(req)
+    try:
+        if streaming_mode:
+            header = b""
+            if media_type == "wav":
+                header = wave_header_chunk()
+                media_type = "raw"
+            for sr, chunk in tts_generator:
+                yield header + pack_audio(BytesIO(), chunk, sr, media_type).getvalue()
+                header = b""
+        else:
+            sr, audio_data = next(tts_generator)
+            yield pack_audio(BytesIO(), audio_data, sr, media_type).getvalue()
+    finally:
+        tts_generator.close()
+
+
+def request_key(req:dict):
+    # only requests with a fixed seed give the same audio, others are sampled independently
+    if req.get("seed", -1) in [-1, None, ""]:
+        return None
+    ref_audio_path = req.get("ref_audio_path", "")
+    aux_ref_audio_paths = req.get("aux_ref_audio_paths", None) or []
+    normalized = {key: value for key, value in req.items() if key not in ["request_id", "timeout"]}
+    normalized["text"] = (req.get("text", "") or "").strip()
+    normalized["prompt_text"] = (req.get("prompt_text", "") or "").strip()
+    try:
+        normalized["ref_audio_path"] = hash_file(ref_audio_path)
+        normalized["aux_ref_audio_paths"] = sorted(hash_file(path) for path in aux_ref_audio_paths)
+    except OSError:  # missing or unreadable, the job reports the error itself
+        return None
+    if req.get("character", None) in [None, ""]:
+        normalized["weights"] = [tts_pipeline.configs.t2s_weights_path, tts_pipeline.configs.vits_weights_path]
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def busy_response(status_code:int, message:str, retry_after:int):
+    return JSONResponse(status_code=status_code, content={"message": message, "queue": executor.stats()},
+                        headers={"Retry-After": str(retry_after)})
+
+
 async def tts_handle(req:dict):
     """
     Text to speech handler.
@@ -291,7 +413,15 @@ async def tts_handle(req:dict):
                 "media_type": "wav",          # str. media type of the output audio, support "wav", "raw", "ogg", "aac".
                 "streaming_mode": False,      # bool. whether to return a streaming response.
                 "parallel_infer": True,       # bool.(optional) whether to use parallel inference.
-                "repetition_penalty": 1.35    # float.(optional) repetition penalty for T2S model.          
+                "repetition_penalty": 1.35,   # float.(optional) repetition penalty for T2S model.
+                "speculative_decoding": False,# bool.(optional) whether to use speculative decoding.
+                "draft_layers": 0,            # int.(optional) number of T2S layers used as draft model.
+                "num_draft_tokens": 4,        # int.(optional) number of tokens proposed by the draft model per step.
+                "static_decode": False,       # bool.(optional) whether to use fixed-shape decode steps.
+                "streaming_chunk_size": 0,    # int.(optional) in streaming mode, vocode in chunks of this many latent frames, 0 to disable.
+                "token_streaming_size": 0,    # int.(optional) in streaming mode, vocode every this many semantic tokens while T2S is still decoding, 0 to disable.
+                "character": None,            # str.(optional) name of a configured character, uses its GPT/SoVITS weights.
+                "timeout": 0                  # float.(optional) seconds before the request is cancelled, 0 for the -t default.
             }
     returns:
         StreamingResponse: audio stream response.
@@ -307,26 +437,49 @@ async def tts_handle(req:dict):
 
     if streaming_mode or return_fragment:
         req["return_fragment"] = True
-    
+
+    request_id = uuid.uuid4().hex
+    req["request_id"] = request_id
+    timeout = req.get("timeout", 0) or args.timeout
+    # hash_file reads the reference audio, keep it off the event loop
+    key = await asyncio.get_running_loop().run_in_executor(None, request_key, req)
     try:
-        tts_generator=tts_pipeline.run(req)
-        
-        if streaming_mode:
-            def streaming_generator(tts_generator:Generator, media_type:str):
-                if media_type == "wav":
-                    yield wave_header_chunk()
-                    media_type = "raw"
-                for sr, chunk in tts_generator:
-                    yield pack_audio(BytesIO(), chunk, sr, media_type).getvalue()
-            # _media_type = f"audio/{media_type}" if not (streaming_mode and media_type in ["wav", "raw"]) else f"audio/x-{media_type}"
-            return StreamingResponse(streaming_generator(tts_generator, media_type, ), media_type=f"audio/{media_type}")
-    
-        else:
-            sr, audio_data = next(tts_generator)
-            audio_data = pack_audio(BytesIO(), audio_data, sr, media_type).getvalue()
-            return Response(audio_data, media_type=f"audio/{media_type}")
+        # identical requests share one job, see request_coalescer.py
+        subscription = coalescer.subscribe(key, lambda: executor.submit(
+            lambda: synthesize(req, media_type, streaming_mode),
+            timeout=timeout,
+            on_cancel=lambda: tts_pipeline.stop(request_id),
+        ))
+    except QueueFull as e:
+        return busy_response(429, "too many requests, the inference queue is full", e.retry_after)
+    except ExecutorClosed:
+        return busy_response(503, "the server is shutting down", executor.retry_after())
+
+    try:
+        first_chunk = await subscription.next()
+    except JobTimeout:
+        subscription.close()
+        return JSONResponse(status_code=504, content={"message": f"tts timed out after {timeout}s"})
     except Exception as e:
+        subscription.close()
         return JSONResponse(status_code=400, content={"message": f"tts failed", "Exception": str(e)})
+
+    if streaming_mode:
+        async def streaming_generator():
+            try:
+                yield first_chunk
+                async for chunk in subscription:
+                    yield chunk
+            except JobTimeout:
+                print(f"streaming request {request_id} timed out after {timeout}s")
+            finally:
+                # the client disconnected or the stream ended, the job is cancelled if nobody else listens
+                subscription.close()
+        # _media_type = f"audio/{media_type}" if not (streaming_mode and media_type in ["wav", "raw"]) else f"audio/x-{media_type}"
+        return StreamingResponse(streaming_generator(), media_type=f"audio/{media_type}")
+    else:
+        subscription.close()
+        return Response(first_chunk, media_type=f"audio/{media_type}")
     
 
 
@@ -340,6 +493,11 @@ async def control(command: str = None):
     handle_control(command)
 
 
+@APP.get("/queue")
+async def queue_stats():
+    return JSONResponse(status_code=200, content={**executor.stats(), "coalescer": coalescer.stats(), "clean_text_cache": clean_text_cache.stats()})
+
+
 
 @APP.get("/tts")
 async def tts_get_endpoint(
@@ -362,7 +520,15 @@ async def tts_get_endpoint(
                         media_type:str = "wav",
                         streaming_mode:bool = False,
                         parallel_infer:bool = True,
-                        repetition_penalty:float = 1.35
+                        repetition_penalty:float = 1.35,
+                        speculative_decoding:bool = False,
+                        draft_layers:int = 0,
+                        num_draft_tokens:int = 4,
+                        static_decode:bool = False,
+                        streaming_chunk_size:int = 0,
+                        token_streaming_size:int = 0,
+                        character:str = None,
+                        timeout:float = 0
                         ):
     req = {
         "text": text,
@@ -384,7 +550,15 @@ async def tts_get_endpoint(
         "media_type":media_type,
         "streaming_mode":streaming_mode,
         "parallel_infer":parallel_infer,
-        "repetition_penalty":float(repetition_penalty)
+        "repetition_penalty":float(repetition_penalty),
+        "speculative_decoding":speculative_decoding,
+        "draft_layers":int(draft_layers),
+        "num_draft_tokens":int(num_draft_tokens),
+        "static_decode":static_decode,
+        "streaming_chunk_size":int(streaming_chunk_size),
+        "token_streaming_size":int(token_streaming_size),
+        "character":character,
+        "timeout":float(timeout)
     }
     return await tts_handle(req)
                 
@@ -445,6 +619,17 @@ async def set_sovits_weights(weights_path: str = None):
     return JSONResponse(status_code=200, content={"message": "success"})
 
 
+@APP.get("/prefetch_character")
+async def prefetch_character(character: str = None):
+    try:
+        if character in ["", None]:
+            return JSONResponse(status_code=400, content={"message": "character is required"})
+        tts_pipeline.prefetch_character(character)
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"message": f"prefetch character failed", "Exception": str(e)})
+    return JSONResponse(status_code=200, content={"message": "success"})
+
+
 
 if __name__ == "__main__":
     try:
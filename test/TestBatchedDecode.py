@@ -0,0 +1,56 @@
+import json
+import unittest
+
+import torch
+
+from GPT_SoVITS.module.models import SynthesizerTrn
+
+
+class TestBatchedDecode(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        torch.manual_seed(0)
+        with open("GPT_SoVITS/configs/s2.json", "r") as f:
+            config = json.load(f)
+        data = config["data"]
+        cls.model = SynthesizerTrn(
+            data["filter_length"] // 2 + 1,
+            config["train"]["segment_size"] // data["hop_length"],
+            n_speakers=data["n_speakers"],
+            **config["model"]
+        ).eval()
+
+    def make_batch(self, code_lens, text_lens):
+        codes = [torch.randint(0, 1024, (length,)) for length in code_lens]
+        texts = [torch.randint(1, 100, (length,)) for length in text_lens]
+        padded_codes = torch.zeros(1, len(codes), max(code_lens), dtype=torch.long)
+        padded_texts = torch.zeros(len(texts), max(text_lens), dtype=torch.long)
+        for i, (code, text) in enumerate(zip(codes, texts)):
+            padded_codes[0, i, :code.shape[0]] = code
+            padded_texts[i, :text.shape[0]] = text
+        return codes, texts, padded_codes, padded_texts
+
+    def check(self, code_lens, text_lens, speed):
+        codes, texts, padded_codes, padded_texts = self.make_batch(code_lens, text_lens)
+        ge = torch.randn(1, self.model.gin_channels, 1)
+
+        batched = self.model.batched_decode(
+            padded_codes, torch.LongTensor(code_lens), padded_texts, torch.LongTensor(text_lens),
+            ge, noise_scale=0, speed=speed,
+        )
+        self.assertEqual(len(batched), len(code_lens))
+        for code, text, audio in zip(codes, texts, batched):
+            expected = self.model.decode(code.view(1, 1, -1), text.unsqueeze(0), ge, noise_scale=0, speed=speed)[0, 0]
+            self.assertEqual(audio.shape, expected.shape)
+            self.assertTrue(torch.allclose(audio, expected, atol=1e-4), (audio - expected).abs().max())
+
+    def test_matches_decode_per_item(self):
+        self.check([12, 7, 3], [20, 9, 15], 1)
+
+    def test_matches_decode_per_item_with_speed(self):
+        self.check([12, 7], [20, 9], 1.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+import torch
+
+from GPT_SoVITS.text.bert_feature import expand_to_phones, get_bert_features
+from fake_bert import CharTokenizer, PerTokenModel
+
+
+class TestBertFeature(unittest.TestCase):
+
+    def test_batch_matches_single_texts(self):
+        model = PerTokenModel()
+        texts = ["你好。", "先帝创业未半而中道崩殂，", "好"]
+        word2phs = [[2, 2, 1], [2] * 11 + [1], [2]]
+        batched = get_bert_features(model, CharTokenizer(), "cpu", texts, word2phs, cache=None)
+        self.assertEqual(model.calls, 1)
+        for text, word2ph, feature in zip(texts, word2phs, batched):
+            single = get_bert_features(model, CharTokenizer(), "cpu", [text], [word2ph], cache=None)[0]
+            self.assertEqual(feature.shape, (1024, sum(word2ph)))
+            self.assertTrue(torch.equal(feature, single))
+        # the hidden states of the third to last layer, repeated for the phones of each character
+        self.assertTrue(torch.equal(batched[0][:, 0], batched[0][:, 1]))
+        self.assertEqual(batched[0][0, 0].item(), ord("你"))
+
+    def test_batch_size(self):
+        model = PerTokenModel()
+        texts = ["一二三"[:i % 3 + 1] for i in range(5)]
+        features = get_bert_features(model, CharTokenizer(), "cpu", texts, [[1] * len(text) for text in texts], batch_size=2, cache=None)
+        self.assertEqual(model.calls, 3)
+        self.assertEqual([feature.shape[1] for feature in features], [len(text) for text in texts])
+
+    def test_expand_to_phones(self):
+        res = torch.randn(4, 1024)
+        word2ph = [2, 1, 3, 0]
+        expected = torch.cat([res[i].repeat(word2ph[i], 1) for i in range(len(word2ph))], dim=0).T
+        self.assertTrue(torch.equal(expand_to_phones(res, word2ph, "你好吗，"), expected))
+        with self.assertRaises(AssertionError):
+            expand_to_phones(res, word2ph, "你好")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+import torch
+
+from GPT_SoVITS.text.bert_feature import get_bert_features
+from GPT_SoVITS.text.bert_feature_cache import BertFeatureCache
+from fake_bert import CharTokenizer, PerTokenModel
+
+
+class TestBertFeatureCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_only_missing_texts_are_computed(self):
+        model = PerTokenModel()
+        cache = BertFeatureCache()
+        expected = get_bert_features(model, CharTokenizer(), "cpu", ["你好。"], [[2, 2, 1]], cache=cache)[0]
+        features = get_bert_features(model, CharTokenizer(), "cpu", ["你好。", "再见。"], [[2, 2, 1], [2, 2, 1]], cache=cache)
+        self.assertTrue(torch.equal(features[0], expected))
+        self.assertEqual(features[1][0, 0].item(), ord("再"))
+        self.assertEqual(model.calls, 2)
+        self.assertEqual((cache.stats()["hits"], cache.stats()["misses"]), (1, 2))
+
+        # the word2ph and the model are part of the key
+        get_bert_features(model, CharTokenizer(), "cpu", ["你好。"], [[2, 1, 1]], cache=cache)
+        get_bert_features(PerTokenModel(), CharTokenizer(), "cpu", ["你好。"], [[2, 2, 1]], cache=cache)
+        self.assertEqual(cache.stats()["misses"], 4)
+
+    def test_memory_eviction(self):
+        feature = torch.zeros(1024, 10)
+        cache = BertFeatureCache(max_bytes=2 * feature.numel() * feature.element_size())
+        for key in ["a", "b", "c"]:
+            cache.put(key, feature)
+        self.assertIsNone(cache.get("a", "cpu"))
+        self.assertIsNotNone(cache.get("c", "cpu"))
+        self.assertEqual(cache.stats()["bytes"], 2 * 1024 * 10 * 4)
+
+    def test_disk(self):
+        feature = torch.randn(1024, 10).half()
+        cache = BertFeatureCache(disk_dir=self.tmp_dir.name)
+        cache.put("a", feature)
+        restarted = BertFeatureCache(disk_dir=self.tmp_dir.name)
+        loaded = restarted.get("a", "cpu")
+        self.assertTrue(torch.equal(loaded, feature))
+        self.assertEqual(restarted.stats()["disk_hits"], 1)
+        self.assertGreater(restarted.stats()["disk_bytes"], 0)
+
+    def test_corrupt_file_is_a_miss(self):
+        cache = BertFeatureCache(disk_dir=self.tmp_dir.name)
+        cache.put("a", torch.zeros(1024, 10))
+        path = os.path.join(self.tmp_dir.name, "a.safetensors")
+        with open(path, "r+b") as f:
+            f.truncate(16)
+        cache.clear()
+        self.assertIsNone(cache.get("a", "cpu"))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_copies(self):
+        feature = torch.zeros(1024, 10)
+        cache = BertFeatureCache()
+        cache.put("a", feature)
+        feature += 1
+        cache.get("a", "cpu").add_(1)
+        self.assertTrue(torch.equal(cache.get("a", "cpu"), torch.zeros(1024, 10)))
+
+    def test_disk_eviction(self):
+        feature = torch.zeros(1024, 10)
+        cache = BertFeatureCache(disk_dir=self.tmp_dir.name, max_disk_bytes=3 * feature.numel() * feature.element_size())
+        for i, key in enumerate(["a", "b", "c", "d"]):
+            cache.put(key, feature)
+            os.utime(os.path.join(self.tmp_dir.name, f"{key}.safetensors"), ns=(i * 10 ** 9, i * 10 ** 9))
+        cache.clear()
+        self.assertIsNone(cache.get("a", "cpu"))
+        self.assertIsNotNone(cache.get("d", "cpu"))
+        self.assertLessEqual(cache.stats()["disk_bytes"], cache.max_disk_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
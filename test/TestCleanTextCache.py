@@ -0,0 +1,99 @@
+import os
+import tempfile
+import unittest
+
+from GPT_SoVITS.text.clean_text_cache import CleanTextCache
+
+
+class FakeG2P:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, text, language, version):
+        self.calls += 1
+        return list(text), [1] * len(text), text.upper()
+
+
+class TestCleanTextCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dictionary = os.path.join(self.tmp_dir.name, "engdict-hot.rep")
+        with open(self.dictionary, "w") as f:
+            f.write("CHATGPT CH AE1 T JH IY1 P IY1 T IY1\n")
+        self.db_path = os.path.join(self.tmp_dir.name, "clean_text.db")
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_memory_lru(self):
+        g2p = FakeG2P()
+        cache = CleanTextCache(max_entries=2, dictionary_paths=[self.dictionary])
+        self.assertEqual(cache.get("ab", "en", "v2", g2p), (["a", "b"], [1, 1], "AB"))
+        phones, _, _ = cache.get("ab", "en", "v2", g2p)
+        phones.append("modified")  # callers get copies
+        self.assertEqual(cache.get("ab", "en", "v2", g2p)[0], ["a", "b"])
+        self.assertEqual(g2p.calls, 1)
+        cache.get("ab", "zh", "v2", g2p)
+        cache.get("ab", "en", "v1", g2p)
+        cache.get("cd", "en", "v2", g2p)  # evicts ("ab", "en", "v2")
+        cache.get("ab", "en", "v2", g2p)
+        self.assertEqual(g2p.calls, 5)
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertAlmostEqual(cache.stats()["hit_rate"], 2 / 7)
+
+    def test_database(self):
+        g2p = FakeG2P()
+        CleanTextCache(db_path=self.db_path, dictionary_paths=[self.dictionary]).get("ab", "en", "v2", g2p)
+        cache = CleanTextCache(db_path=self.db_path, dictionary_paths=[self.dictionary])
+        self.assertEqual(cache.get("ab", "en", "v2", g2p), (["a", "b"], [1, 1], "AB"))
+        self.assertEqual((g2p.calls, cache.stats()["db_hits"]), (1, 1))
+
+    def test_dictionary_change_invalidates(self):
+        g2p = FakeG2P()
+        cache = CleanTextCache(db_path=self.db_path, dictionary_paths=[self.dictionary])
+        cache.get("ab", "en", "v2", g2p)
+        with open(self.dictionary, "a") as f:
+            f.write("GPT JH IY1 P IY1 T IY1\n")
+        cache.invalidate()
+        cache.get("ab", "en", "v2", g2p)
+        self.assertEqual(g2p.calls, 2)
+        CleanTextCache(db_path=self.db_path, dictionary_paths=[self.dictionary]).get("ab", "en", "v2", g2p)
+        self.assertEqual(g2p.calls, 2)
+
+        with open(self.dictionary, "w") as f:
+            f.write("")
+        # a restart with an edited dictionary does not use the old rows
+        CleanTextCache(db_path=self.db_path, dictionary_paths=[self.dictionary]).get("ab", "en", "v2", g2p)
+        self.assertEqual(g2p.calls, 3)
+
+    def test_refresh(self):
+        g2p = FakeG2P()
+        cache = CleanTextCache(db_path=self.db_path, dictionary_paths=[self.dictionary])
+        cache.get("ab", "en", "v2", g2p)
+        self.assertFalse(cache.refresh())
+        cache.get("ab", "en", "v2", g2p)
+        self.assertEqual(g2p.calls, 1)
+
+        def edit_and_g2p(text, language, version):
+            # like the first import of a language module, which loads (or builds) its dictionaries
+            with open(self.dictionary, "a") as f:
+                f.write("GPT JH IY1 P IY1 T IY1\n")
+            self.assertTrue(cache.refresh())
+            return g2p(text, language, version)
+
+        cache.get("cd", "en", "v2", edit_and_g2p)
+        cache.get("cd", "en", "v2", g2p)
+        cache.get("ab", "en", "v2", g2p)
+        self.assertEqual(g2p.calls, 3)
+
+    def test_disabled(self):
+        g2p = FakeG2P()
+        cache = CleanTextCache(max_entries=0, dictionary_paths=[self.dictionary])
+        cache.get("ab", "en", "v2", g2p)
+        cache.get("ab", "en", "v2", g2p)
+        self.assertEqual(g2p.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import os
+import unittest
+
+import torch
+
+from GPT_SoVITS.TTS_infer_pack.forked_workers import share_modules, worker_index
+
+
+class TestForkedWorkers(unittest.TestCase):
+
+    def test_share_modules(self):
+        model = torch.nn.Sequential(torch.nn.Linear(10, 10), torch.nn.BatchNorm1d(10))
+        nbytes = share_modules([model, None])
+        self.assertEqual(nbytes, (110 + 40) * 4 + 8)  # num_batches_tracked is an int64
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            self.assertTrue(tensor.is_shared())
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_forked_process_sees_shared_writes(self):
+        model = torch.nn.Linear(4, 4)
+        share_modules([model])
+        self.assertIsNone(worker_index())
+        pid = os.fork()
+        if pid == 0:
+            with torch.no_grad():
+                model.weight.fill_(1)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        # the child wrote to the same memory instead of a copy-on-write page
+        self.assertTrue(torch.equal(model.weight, torch.ones(4, 4)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from GPT_SoVITS.TTS_infer_pack.inference_executor import InferenceExecutor, JobTimeout, QueueFull
+
+
+def blocking(event, items=("done",)):
+    def fn():
+        event.wait(5)
+        yield from items
+    return fn
+
+
+class TestInferenceExecutor(unittest.TestCase):
+
+    def test_items_and_errors(self):
+        async def main():
+            executor = InferenceExecutor()
+            job = executor.submit(lambda: iter([1, 2, 3]))
+            self.assertEqual([item async for item in job], [1, 2, 3])
+
+            def fail():
+                raise ValueError("bad input")
+                yield
+            with self.assertRaises(ValueError):
+                await executor.submit(fail).next()
+            self.assertEqual((executor.stats()["completed"], executor.stats()["failed"]), (1, 1))
+        asyncio.run(main())
+
+    def test_event_loop_is_not_blocked(self):
+        async def main():
+            executor = InferenceExecutor()
+            release = threading.Event()
+            job = executor.submit(blocking(release))
+            t0 = time.monotonic()
+            await asyncio.sleep(0.05)  # would not return before `release` if the job ran on the loop
+            self.assertLess(time.monotonic() - t0, 1)
+            release.set()
+            self.assertEqual(await job.next(), "done")
+        asyncio.run(main())
+
+    def test_queue_full(self):
+        async def main():
+            executor = InferenceExecutor(concurrency=1, max_queue=1)
+            release = threading.Event()
+            executor.submit(blocking(release))
+            while executor.stats()["running"] == 0:
+                await asyncio.sleep(0.01)
+            executor.submit(blocking(release))
+            with self.assertRaises(QueueFull) as cm:
+                executor.submit(blocking(release))
+            self.assertGreaterEqual(cm.exception.retry_after, 1)
+            self.assertEqual(executor.stats()["rejected"], 1)
+            release.set()
+        asyncio.run(main())
+
+    def test_cancel(self):
+        async def main():
+            executor = InferenceExecutor(concurrency=1)
+            release = threading.Event()
+            running = executor.submit(blocking(release), on_cancel=release.set)
+            queued = executor.submit(blocking(release))
+            while executor.stats()["running"] == 0:
+                await asyncio.sleep(0.01)
+            queued.cancel()
+            self.assertEqual(executor.stats()["queued"], 0)
+            running.cancel()  # on_cancel releases the running job
+            self.assertTrue(release.is_set())
+            self.assertEqual(executor.stats()["cancelled"], 2)
+        asyncio.run(main())
+
+    def test_timeout(self):
+        async def main():
+            executor = InferenceExecutor(concurrency=1)
+            release = threading.Event()
+            job = executor.submit(blocking(release), timeout=0.05, on_cancel=release.set)
+            with self.assertRaises(JobTimeout):
+                await job.next()
+            self.assertTrue(release.is_set())
+            self.assertEqual(executor.stats()["timed_out"], 1)
+        asyncio.run(main())
+
+    def test_jobs_run_concurrently(self):
+        async def main():
+            executor = InferenceExecutor(concurrency=2)
+            release = threading.Event()
+            jobs = [executor.submit(blocking(release)) for _ in range(3)]
+            await asyncio.sleep(0.1)
+            self.assertEqual((executor.stats()["running"], executor.stats()["queued"]), (2, 1))
+            release.set()
+            for job in jobs:
+                self.assertEqual(await job.next(), "done")
+        asyncio.run(main())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import threading
+import unittest
+
+import torch
+
+from GPT_SoVITS.TTS_infer_pack.model_pool import ModelPool, model_nbytes
+
+
+class TestModelPool(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.loaded = []
+
+    def load(self, key):
+        self.loaded.append(key)
+        return torch.nn.Linear(10, 10)  # 440 bytes
+
+    def test_nbytes(self):
+        model = torch.nn.Linear(10, 10)
+        self.assertEqual(model_nbytes(model), 440)
+        self.assertEqual(model_nbytes({"a": model, "b": [model, "config"]}), 880)
+
+    def test_lru_eviction(self):
+        pool = ModelPool(self.load, max_models=2)
+        a = pool.get("a")
+        pool.get("b")
+        self.assertIs(pool.get("a"), a)
+        pool.get("c")
+        self.assertEqual(pool.keys(), ["a", "c"])
+        self.assertEqual(self.loaded, ["a", "b", "c"])
+        self.assertEqual((pool.hits, pool.misses), (1, 3))
+
+    def test_max_bytes(self):
+        pool = ModelPool(self.load, max_models=10, max_bytes=1000)
+        for key in "abc":
+            pool.get(key)
+        self.assertEqual(pool.keys(), ["b", "c"])
+        self.assertEqual(pool.resident_bytes, 880)
+
+    def test_pinned_keys_are_not_evicted(self):
+        pool = ModelPool(self.load, max_models=1)
+        pool.pin("a")
+        pool.get("a")
+        pool.get("b")
+        self.assertEqual(pool.keys(), ["a", "b"])
+        pool.get("c")
+        self.assertEqual(pool.keys(), ["a", "c"])
+        pool.unpin("a")
+        self.assertEqual(pool.keys(), ["c"])
+
+    def test_prefetch(self):
+        started, release = threading.Event(), threading.Event()
+
+        def load(key):
+            started.set()
+            release.wait()
+            return self.load(key)
+
+        pool = ModelPool(load)
+        future = pool.prefetch("a")
+        started.wait()
+        self.assertNotIn("a", pool)
+        release.set()
+        # get waits for the prefetch instead of loading the weights a second time
+        self.assertIs(pool.get("a"), future.result())
+        self.assertEqual(self.loaded, ["a"])
+        pool.close()
+
+    def test_failed_load_is_not_cached(self):
+        def load(key):
+            raise FileNotFoundError(key)
+
+        pool = ModelPool(load)
+        with self.assertRaises(FileNotFoundError):
+            pool.get("a")
+        pool.load = self.load
+        pool.get("a")
+        self.assertIn("a", pool)
+
+
+if __name__ == '__main__':
+    unittest.main()
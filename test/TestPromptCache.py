@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+
+import torch
+
+from GPT_SoVITS.TTS_infer_pack.prompt_cache import PromptCache, PromptEntry
+
+
+class TestPromptCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for i in range(4):
+            path = os.path.join(self.tmp_dir.name, f"{i}.wav")
+            with open(path, "wb") as f:
+                f.write(bytes([i]))
+            self.paths.append(path)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def make_entry(self, path, device="cpu"):
+        # 1000 + 512 + 4000 bytes on `device`
+        return PromptEntry(
+            path, [],
+            torch.zeros(125, dtype=torch.long, device=device),
+            torch.zeros(1, 128, 1, device=device),
+            "text", "zh", [1] * 10,
+            torch.zeros(100, 10, device=device),
+            "text",
+        )
+
+    def test_hits_and_misses(self):
+        cache = PromptCache()
+        key = cache.make_key("weights", self.paths[0], [], "text", "zh")
+        self.assertIsNone(cache.get(key))
+        entry = self.make_entry(self.paths[0])
+        cache.put(key, entry)
+        self.assertIs(cache.get(key), entry)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_key(self):
+        make_key = PromptCache.make_key
+        key = make_key("weights", self.paths[0], [self.paths[1], self.paths[2]], "text", "zh")
+        self.assertEqual(key, make_key("weights", self.paths[0], [self.paths[2], self.paths[1]], "text", "zh"))
+        self.assertNotEqual(key, make_key("weights", self.paths[0], [self.paths[1]], "text", "zh"))
+        self.assertNotEqual(key, make_key("weights", self.paths[0], [self.paths[1], self.paths[2]], "text", "en"))
+        self.assertNotEqual(key, make_key("weights", self.paths[3], [self.paths[1], self.paths[2]], "text", "zh"))
+        self.assertEqual(make_key("weights", self.paths[0], [], None, "zh"), make_key("weights", self.paths[0], [], None, "en"))
+
+    def test_cpu_budget(self):
+        cache = PromptCache(max_cpu_bytes=2 * 5512)
+        keys = [cache.make_key("weights", path, [], "text", "zh") for path in self.paths[:3]]
+        for key, path in zip(keys, self.paths):
+            cache.put(key, self.make_entry(path))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.gpu_bytes, cache.cpu_bytes), (0, 2 * 5512))
+        self.assertIsNone(cache.get(keys[0]))
+
+    def test_gpu_and_cpu_budgets_are_separate(self):
+        # tensors that are not on the cpu count against the gpu budget
+        cache = PromptCache(max_gpu_bytes=5512, max_cpu_bytes=5512)
+        gpu_key = cache.make_key("weights", self.paths[0], [], "text", "zh")
+        cpu_key = cache.make_key("weights", self.paths[1], [], "text", "zh")
+        cache.put(gpu_key, self.make_entry(self.paths[0], device="meta"))
+        cache.put(cpu_key, self.make_entry(self.paths[1]))
+        self.assertEqual((cache.gpu_bytes, cache.cpu_bytes), (5512, 5512))
+        self.assertIsNotNone(cache.get(cpu_key))
+        self.assertIsNotNone(cache.get(gpu_key))
+
+        # cpu_key is the least recently used entry but does not free gpu memory
+        cache.put(cache.make_key("weights", self.paths[2], [], "text", "zh"), self.make_entry(self.paths[2], device="meta"))
+        self.assertIsNone(cache.get(gpu_key))
+        self.assertIsNotNone(cache.get(cpu_key))
+
+    def test_max_entries(self):
+        cache = PromptCache(max_entries=2)
+        keys = [cache.make_key("weights", path, [], "text", "zh") for path in self.paths[:3]]
+        for key, path in zip(keys, self.paths):
+            cache.put(key, self.make_entry(path))
+            cache.get(keys[0])
+        self.assertEqual(len(cache), 2)
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
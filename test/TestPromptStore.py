@@ -0,0 +1,81 @@
+import json
+import os
+import tempfile
+import unittest
+from copy import deepcopy
+
+import torch
+
+from GPT_SoVITS.module.models import SynthesizerTrn
+from GPT_SoVITS.module.prompt_store import PromptSemanticStore, quantizer_id
+
+
+class TestPromptStore(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        torch.manual_seed(0)
+        with open("GPT_SoVITS/configs/s2.json", "r") as f:
+            config = json.load(f)
+        data = config["data"]
+        cls.model = SynthesizerTrn(
+            data["filter_length"] // 2 + 1,
+            config["train"]["segment_size"] // data["hop_length"],
+            n_speakers=data["n_speakers"],
+            **config["model"]
+        ).eval()
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp_dir.name, "prompts")
+        self.ref = os.path.join(self.tmp_dir.name, "ref.wav")
+        with open(self.ref, "wb") as f:
+            f.write(b"ref")
+        self.computed = []
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def compute(self, path):
+        # stands in for librosa + CNHuBERT + extract_latent
+        self.computed.append(path)
+        return torch.arange(10), 64000
+
+    def test_persists_across_instances(self):
+        entry = PromptSemanticStore(self.root).get_entry(self.ref, "hubert", self.model, self.compute)
+
+        store = PromptSemanticStore(self.root)
+        loaded = store.get_entry(self.ref, "hubert", self.model, self.compute)
+        self.assertEqual(len(self.computed), 1)
+        self.assertEqual((store.disk_hits, store.misses), (1, 0))
+        self.assertTrue(torch.equal(loaded.prompt_semantic, entry.prompt_semantic))
+        self.assertEqual(loaded.num_samples, 64000)
+
+        store.get_entry(self.ref, "hubert", self.model, self.compute)
+        self.assertEqual(store.hits, 1)
+
+    def test_index(self):
+        PromptSemanticStore(self.root).get_entry(self.ref, "hubert", self.model, self.compute)
+        with open(os.path.join(self.root, "index.json"), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.assertEqual(len(index), 1)
+        info = next(iter(index.values()))
+        self.assertEqual(info["hubert_id"], "hubert")
+        self.assertEqual(info["quantizer_id"], quantizer_id(self.model))
+        self.assertEqual(info["length"], 10)
+
+    def test_keyed_on_hubert_and_quantizer(self):
+        store = PromptSemanticStore(self.root)
+        store.get_entry(self.ref, "hubert", self.model, self.compute)
+        store.get_entry(self.ref, "other_hubert", self.model, self.compute)
+        self.assertEqual(len(self.computed), 2)
+
+        finetuned = deepcopy(self.model)
+        self.assertEqual(quantizer_id(finetuned), quantizer_id(self.model))
+        finetuned = deepcopy(self.model)
+        finetuned.quantizer.vq.layers[0]._codebook.embed[0, 0] += 1
+        self.assertNotEqual(quantizer_id(finetuned), quantizer_id(self.model))
+
+
+if __name__ == '__main__':
+    unittest.main()
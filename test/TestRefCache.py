@@ -0,0 +1,105 @@
+import json
+import os
+import tempfile
+import unittest
+from copy import deepcopy
+
+import torch
+
+from GPT_SoVITS.module.models import SynthesizerTrn
+from GPT_SoVITS.module.ref_cache import RefCache, ref_encoder_id
+
+
+class TestRefCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        torch.manual_seed(0)
+        with open("GPT_SoVITS/configs/s2.json", "r") as f:
+            config = json.load(f)
+        data = config["data"]
+        cls.model = SynthesizerTrn(
+            data["filter_length"] // 2 + 1,
+            config["train"]["segment_size"] // data["hop_length"],
+            n_speakers=data["n_speakers"],
+            **config["model"]
+        ).eval()
+        cls.freq_bins = data["filter_length"] // 2 + 1
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.loads = []
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def write_audio(self, name, content):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def load_spec(self, path):
+        # stands in for load_audio + spectrogram_torch: a spec that only depends on the file content
+        self.loads.append(path)
+        with open(path, "rb") as f:
+            seed = sum(f.read())
+        generator = torch.Generator().manual_seed(seed)
+        return torch.rand(1, self.freq_bins, 40, generator=generator)
+
+    def test_matches_get_ge(self):
+        cache = RefCache()
+        ref = self.write_audio("ref.wav", b"ref")
+        aux = self.write_audio("aux.wav", b"aux")
+        ges = [cache.get_entry(self.model, path, self.load_spec).ge for path in [ref, aux]]
+        with torch.no_grad():
+            expected = self.model.get_ge([self.load_spec(ref), self.load_spec(aux)])
+        self.assertTrue(torch.allclose(torch.stack(ges, 0).mean(0), expected, atol=1e-6))
+
+    def test_keyed_on_content_and_weights(self):
+        cache = RefCache()
+        ref = self.write_audio("ref.wav", b"ref")
+        copy = self.write_audio("copy.wav", b"ref")
+        entry = cache.get_entry(self.model, ref, self.load_spec)
+        self.assertIs(cache.get_entry(self.model, copy, self.load_spec), entry)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # a copy of the weights hits the same entries, other ref_enc weights do not
+        self.assertIs(cache.get_entry(deepcopy(self.model), ref, self.load_spec), entry)
+        other_model = deepcopy(self.model)
+        with torch.no_grad():
+            next(other_model.ref_enc.parameters()).add_(1)
+        cache.get_entry(other_model, ref, self.load_spec)
+        self.assertEqual(cache.misses, 2)
+
+        with open(ref, "wb") as f:
+            f.write(b"changed")
+        os.utime(ref, ns=(0, 0))
+        cache.get_entry(self.model, ref, self.load_spec)
+        self.assertEqual(cache.misses, 3)
+
+    def test_disk_tier(self):
+        disk_dir = os.path.join(self.tmp_dir.name, "cache")
+        ref = self.write_audio("ref.wav", b"ref")
+        entry = RefCache(disk_dir=disk_dir).get_entry(self.model, ref, self.load_spec)
+
+        cache = RefCache(disk_dir=disk_dir)
+        loaded = cache.get_entry(self.model, ref, self.load_spec)
+        self.assertEqual((cache.disk_hits, cache.misses), (1, 0))
+        self.assertEqual(len(self.loads), 1)
+        self.assertTrue(torch.equal(loaded.spec, entry.spec))
+        self.assertTrue(torch.equal(loaded.ge, entry.ge))
+
+    def test_evicts_least_recently_used(self):
+        paths = [self.write_audio(f"{i}.wav", bytes([i])) for i in range(3)]
+        entry = RefCache().get_entry(self.model, paths[0], self.load_spec)
+        cache = RefCache(max_bytes=2 * entry.nbytes)
+        for path in paths:
+            cache.get_entry(self.model, path, self.load_spec)
+        self.assertLessEqual(cache.nbytes, cache.max_bytes)
+        self.assertIsNone(cache.get(cache.make_key(ref_encoder_id(self.model), paths[0])))
+        self.assertIsNotNone(cache.get(cache.make_key(ref_encoder_id(self.model), paths[2])))
+
+
+if __name__ == '__main__':
+    unittest.main()
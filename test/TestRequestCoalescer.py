@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import unittest
+
+from GPT_SoVITS.TTS_infer_pack.inference_executor import InferenceExecutor
+from GPT_SoVITS.TTS_infer_pack.request_coalescer import RequestCoalescer
+
+
+def chunks(event, calls, items=(b"RIFF", b"data")):
+    def fn():
+        calls.append(1)
+        event.wait(5)
+        yield from items
+    return fn
+
+
+class TestRequestCoalescer(unittest.TestCase):
+
+    def test_concurrent_requests_share_one_job(self):
+        async def main():
+            executor = InferenceExecutor()
+            coalescer = RequestCoalescer()
+            release, calls = threading.Event(), []
+            start = lambda: executor.submit(chunks(release, calls))
+            first = coalescer.subscribe("key", start)
+            second = coalescer.subscribe("key", start)
+            release.set()
+            self.assertEqual([chunk async for chunk in first], [b"RIFF", b"data"])
+            self.assertEqual([chunk async for chunk in second], [b"RIFF", b"data"])
+            self.assertEqual(len(calls), 1)
+            self.assertEqual((coalescer.stats()["misses"], coalescer.stats()["coalesced"]), (1, 1))
+        asyncio.run(main())
+
+    def test_late_subscriber_replays_chunks(self):
+        async def main():
+            executor = InferenceExecutor()
+            coalescer = RequestCoalescer()
+            release, calls = threading.Event(), []
+            first = coalescer.subscribe("key", lambda: executor.submit(chunks(release, calls)))
+            release.set()
+            self.assertEqual(await first.next(), b"RIFF")
+            second = coalescer.subscribe("key", lambda: executor.submit(chunks(release, calls)))
+            self.assertEqual([chunk async for chunk in second], [b"RIFF", b"data"])
+            self.assertEqual(len(calls), 1)
+        asyncio.run(main())
+
+    def test_result_cache(self):
+        async def main():
+            executor = InferenceExecutor()
+            release, calls = threading.Event(), []
+            release.set()
+            coalescer = RequestCoalescer(ttl=30)
+            start = lambda: executor.submit(chunks(release, calls))
+            self.assertEqual([chunk async for chunk in coalescer.subscribe("key", start)], [b"RIFF", b"data"])
+            await asyncio.sleep(0)  # let the pump task store the result
+            self.assertEqual([chunk async for chunk in coalescer.subscribe("key", start)], [b"RIFF", b"data"])
+            self.assertEqual((len(calls), coalescer.stats()["hits"]), (1, 1))
+
+            # a key of None or a disabled cache always starts a new job
+            [chunk async for chunk in coalescer.subscribe(None, start)]
+            [chunk async for chunk in coalescer.subscribe(None, start)]
+            self.assertEqual(len(calls), 3)
+            uncached = RequestCoalescer(ttl=0)
+            [chunk async for chunk in uncached.subscribe("key", start)]
+            await asyncio.sleep(0)
+            [chunk async for chunk in uncached.subscribe("key", start)]
+            self.assertEqual(len(calls), 5)
+        asyncio.run(main())
+
+    def test_job_cancelled_when_last_subscriber_leaves(self):
+        async def main():
+            executor = InferenceExecutor()
+            coalescer = RequestCoalescer()
+            release, calls = threading.Event(), []
+            start = lambda: executor.submit(chunks(release, calls), on_cancel=release.set)
+            first = coalescer.subscribe("key", start)
+            second = coalescer.subscribe("key", start)
+            first.close()
+            self.assertFalse(release.is_set())
+            second.close()
+            await asyncio.sleep(0.1)
+            self.assertEqual(executor.stats()["cancelled"], 1)
+            self.assertEqual(coalescer.stats()["in_flight"], 0)
+            self.assertEqual(coalescer.stats()["cached"], 0)
+        asyncio.run(main())
+
+    def test_errors_reach_every_subscriber(self):
+        async def main():
+            executor = InferenceExecutor()
+            coalescer = RequestCoalescer()
+
+            def fail():
+                raise ValueError("bad input")
+                yield
+            first = coalescer.subscribe("key", lambda: executor.submit(fail))
+            second = coalescer.subscribe("key", lambda: executor.submit(fail))
+            for subscription in [first, second]:
+                with self.assertRaises(ValueError):
+                    await subscription.next()
+            self.assertEqual(coalescer.stats()["cached"], 0)
+        asyncio.run(main())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+import torch
+
+from GPT_SoVITS.AR.models.t2s_model import Text2SemanticDecoder
+
+
+class TestSpeculativeDecode(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        config = {"model": {
+            "hidden_dim": 64, "embedding_dim": 64, "head": 4, "n_layer": 4,
+            "vocab_size": 1025, "phoneme_vocab_size": 732, "dropout": 0, "EOS": 1024,
+        }}
+        self.model = Text2SemanticDecoder(config).eval()
+        self.x = [torch.randint(1, 732, (9,))]
+        self.x_lens = torch.LongTensor([9])
+        self.bert_feature = [torch.randn(1024, 9)]
+        self.prompts = torch.randint(0, 1024, (1, 6))
+
+    def decode(self, **kwargs):
+        with torch.no_grad():
+            return self.model.infer_panel_speculative(self.x, self.x_lens, self.prompts, self.bert_feature,
+                                                      top_k=5, early_stop_num=60, return_acceptance=True, **kwargs)
+
+    def test_returns_acceptance(self):
+        _, _, (accepted, proposed) = self.decode()
+        self.assertGreater(proposed, 0)
+        self.assertLessEqual(accepted, proposed)
+        self.assertFalse(hasattr(self.model, "speculative_acceptance_rate"))
+
+    def test_should_stop(self):
+        # stops before the second draft/verify round
+        calls = []
+        def should_stop():
+            calls.append(None)
+            return len(calls) > 1
+        y_list, _, (_, proposed) = self.decode(should_stop=should_stop)
+        self.assertEqual(len(calls), 2)
+        self.assertLessEqual(proposed, 4)
+        self.assertLessEqual(y_list[0].shape[0], self.prompts.shape[1] + 1 + 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+import torch
+
+from GPT_SoVITS.AR.models.t2s_model import Text2SemanticDecoder
+
+
+class GarbageKVCacheTransformer:
+    # leaves NaN in the unused part of the KV cache buffers, like reused uninitialized memory
+    def __init__(self, transformer):
+        self.transformer = transformer
+
+    def __getattr__(self, name):
+        return getattr(self.transformer, name)
+
+    def process_prompt(self, *args):
+        x, kv_cache = self.transformer.process_prompt(*args)
+        for cache in kv_cache.k_caches + kv_cache.v_caches:
+            cache.narrow(1, kv_cache.kv_len, cache.shape[1] - kv_cache.kv_len).fill_(float("nan"))
+        return x, kv_cache
+
+
+class TestStaticDecode(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        config = {"model": {
+            "hidden_dim": 64, "embedding_dim": 64, "head": 4, "n_layer": 2,
+            "vocab_size": 1025, "phoneme_vocab_size": 732, "dropout": 0, "EOS": 1024,
+        }}
+        self.model = Text2SemanticDecoder(config).eval()
+        x_lens = [9, 14]
+        self.x = [torch.randint(1, 732, (length,)) for length in x_lens]
+        self.x_lens = torch.LongTensor(x_lens)
+        self.bert_feature = [torch.randn(1024, length) for length in x_lens]
+        self.prompts = torch.randint(0, 1024, (len(x_lens), 6))
+
+    def decode(self, infer_panel):
+        # top_k=1 samples the argmax, so both paths must produce the same tokens
+        with torch.no_grad():
+            return infer_panel(self.x, self.x_lens, self.prompts, self.bert_feature,
+                               top_k=1, top_p=1, early_stop_num=30, temperature=1, repetition_penalty=1.35)
+
+    def assertSameDecode(self):
+        y_list, idx_list = self.decode(self.model.infer_panel_batch_infer)
+        static_y_list, static_idx_list = self.decode(self.model.infer_panel_static)
+        self.assertEqual(static_idx_list, idx_list)
+        for y, static_y in zip(y_list, static_y_list):
+            self.assertEqual(static_y.tolist(), y.tolist())
+        return idx_list
+
+    def test_greedy_matches_batch_infer(self):
+        self.assertSameDecode()
+
+    def test_uninitialized_kv_cache(self):
+        self.model.t2s_transformer = GarbageKVCacheTransformer(self.model.t2s_transformer)
+        self.assertSameDecode()
+
+    def test_eos_only_blocked_on_prefill(self):
+        # EOS wins every step: it is removed from the prefill logits only, so both stop on the first decode step
+        predict_layer = torch.nn.Linear(self.model.model_dim, self.model.vocab_size)
+        with torch.no_grad():
+            predict_layer.weight.copy_(self.model.ar_predict_layer.weight)
+            predict_layer.bias.zero_()
+            predict_layer.bias[self.model.EOS] = 100
+        self.model.ar_predict_layer = predict_layer
+        self.assertEqual(self.assertSameDecode(), [0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import json
+import unittest
+
+import torch
+
+from GPT_SoVITS.module.models import SynthesizerTrn
+
+
+class TestStreamingDecode(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        torch.manual_seed(0)
+        with open("GPT_SoVITS/configs/s2.json", "r") as f:
+            config = json.load(f)
+        data = config["data"]
+        cls.model = SynthesizerTrn(
+            data["filter_length"] // 2 + 1,
+            config["train"]["segment_size"] // data["hop_length"],
+            n_speakers=data["n_speakers"],
+            **config["model"]
+        ).eval()
+        cls.codes = torch.randint(0, 1024, (1, 1, 20))
+        cls.text = torch.randint(1, 100, (1, 15))
+        cls.ge = torch.randn(1, cls.model.gin_channels, 1)
+
+    def stream(self, chunk_size, overlap):
+        chunks = list(self.model.decode_streaming(
+            self.codes, self.text, self.ge, noise_scale=0, chunk_size=chunk_size, overlap=overlap
+        ))
+        return chunks, torch.cat(chunks)
+
+    def test_chunks_cover_decode(self):
+        expected = self.model.decode(self.codes, self.text, self.ge, noise_scale=0)[0, 0]
+        chunks, audio = self.stream(chunk_size=8, overlap=4)
+        self.assertEqual(len(chunks), 5)  # 40 latent frames
+        self.assertEqual(audio.shape, expected.shape)
+
+    def test_matches_decode_with_full_context(self):
+        # with an overlap as long as the segment every chunk is cut from a decode of the whole segment
+        expected = self.model.decode(self.codes, self.text, self.ge, noise_scale=0)[0, 0]
+        _, audio = self.stream(chunk_size=8, overlap=40)
+        self.assertTrue(torch.allclose(audio, expected, atol=1e-4), (audio - expected).abs().max())
+
+
+if __name__ == '__main__':
+    unittest.main()
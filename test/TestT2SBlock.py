@@ -0,0 +1,131 @@
+import unittest
+
+import torch
+from torch.nn import functional as F
+
+from GPT_SoVITS.AR.models.t2s_model import T2SBlock, T2SMLP, scaled_dot_product_attention
+
+
+def mask(x, padding_mask):
+    return x.masked_fill(padding_mask, 0)
+
+
+def process_prompt_per_row(block, x, attn_mask, padding_mask):
+    # The padded prefill as it was before it was vectorized: attention over the padded batch, then
+    # residual + layer norm + MLP on the unpadded positions of each row separately.
+    q, k, v = F.linear(mask(x, padding_mask), block.qkv_w, block.qkv_b).chunk(3, dim=-1)
+    batch_size, q_len, kv_len = q.shape[0], q.shape[1], k.shape[1]
+
+    q = mask(q, padding_mask)
+    k_cache = mask(k, padding_mask)
+    v_cache = mask(v, padding_mask)
+    q = q.view(batch_size, q_len, block.num_heads, -1).transpose(1, 2)
+    k = k_cache.view(batch_size, kv_len, block.num_heads, -1).transpose(1, 2)
+    v = v_cache.view(batch_size, kv_len, block.num_heads, -1).transpose(1, 2)
+
+    attn = scaled_dot_product_attention(q, k, v, attn_mask)
+    attn = attn.permute(2, 0, 1, 3).reshape(batch_size * q_len, block.hidden_dim)
+    attn = attn.view(q_len, batch_size, block.hidden_dim).transpose(1, 0)
+    attn = F.linear(mask(attn, padding_mask), block.out_w, block.out_b)
+
+    x = x.clone()
+    for i in range(batch_size):
+        idx = torch.where(padding_mask[i, :, 0] == False)[0]
+        x_item = x[i, idx, :].unsqueeze(0) + attn[i, idx, :].unsqueeze(0)
+        x_item = F.layer_norm(x_item, [block.hidden_dim], block.norm_w1, block.norm_b1, block.norm_eps1)
+        x_item = x_item + block.mlp.forward(x_item)
+        x_item = F.layer_norm(x_item, [block.hidden_dim], block.norm_w2, block.norm_b2, block.norm_eps2)
+        x[i, idx, :] = x_item.squeeze(0)
+    return mask(x, padding_mask), k_cache, v_cache
+
+
+class TestT2SBlock(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.hidden_dim = 64
+        self.num_heads = 4
+        hidden_dim = self.hidden_dim
+        mlp = T2SMLP(
+            torch.randn(hidden_dim * 4, hidden_dim) * 0.1, torch.randn(hidden_dim * 4) * 0.1,
+            torch.randn(hidden_dim, hidden_dim * 4) * 0.1, torch.randn(hidden_dim) * 0.1,
+        )
+        self.block = T2SBlock(
+            self.num_heads, hidden_dim, mlp,
+            torch.randn(hidden_dim * 3, hidden_dim) * 0.1, torch.randn(hidden_dim * 3) * 0.1,
+            torch.randn(hidden_dim, hidden_dim) * 0.1, torch.randn(hidden_dim) * 0.1,
+            torch.rand(hidden_dim) + 0.5, torch.randn(hidden_dim) * 0.1, 1e-5,
+            torch.rand(hidden_dim) + 0.5, torch.randn(hidden_dim) * 0.1, 1e-5,
+        )
+
+    def make_batch(self, x_lens, y_len):
+        # Same layout and masks as Text2SemanticDecoder.infer_panel_batch_infer: right-padded text,
+        # followed by the prompt semantic tokens.
+        bsz = len(x_lens)
+        max_len = max(x_lens)
+        src_len = max_len + y_len
+        x = torch.randn(bsz, src_len, self.hidden_dim)
+
+        x_padding_mask = torch.arange(max_len).unsqueeze(0) >= torch.LongTensor(x_lens).unsqueeze(1)
+        padding_mask = torch.concat([x_padding_mask, torch.zeros(bsz, y_len, dtype=torch.bool)], dim=1)
+
+        x_mask = F.pad(torch.zeros(max_len, max_len, dtype=torch.bool), (0, y_len), value=True)
+        y_mask = F.pad(torch.triu(torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1), (max_len, 0), value=False)
+        xy_mask = torch.concat([x_mask, y_mask], dim=0).view(1, src_len, src_len).repeat(bsz, 1, 1)
+        _padding_mask = padding_mask.view(bsz, 1, src_len).repeat(1, src_len, 1)
+        for i in range(bsz):
+            _padding_mask[i, x_lens[i]:max_len, :] = True
+        attn_mask = xy_mask.logical_or(_padding_mask).unsqueeze(1).expand(-1, self.num_heads, -1, -1)
+
+        padding_mask = padding_mask.view(bsz, src_len, 1).expand(-1, -1, self.hidden_dim)
+        return x, attn_mask, padding_mask
+
+    def test_padded_prefill_matches_per_row_prefill(self):
+        x, attn_mask, padding_mask = self.make_batch([9, 6, 2], 5)
+
+        expected = process_prompt_per_row(self.block, x, attn_mask, padding_mask)
+        actual = self.block.process_prompt(x, attn_mask, padding_mask, False)
+
+        for a, e in zip(actual, expected):
+            self.assertTrue(torch.allclose(a, e, atol=1e-5), (a - e).abs().max())
+
+    def test_padded_prefill_matches_unpadded_prefill(self):
+        x_lens = [9, 6, 2]
+        y_len = 5
+        max_len = max(x_lens)
+        x, attn_mask, padding_mask = self.make_batch(x_lens, y_len)
+        padded, _, _ = self.block.process_prompt(x, attn_mask, padding_mask, False)
+
+        for i, x_len in enumerate(x_lens):
+            idx = torch.concat([torch.arange(x_len), torch.arange(max_len, max_len + y_len)])
+            x_item = x[i:i + 1, idx]
+            x_attn_mask = F.pad(torch.zeros(x_len, x_len, dtype=torch.bool), (0, y_len), value=True)
+            y_attn_mask = F.pad(torch.triu(torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1), (x_len, 0), value=False)
+            attn_mask_item = torch.concat([x_attn_mask, y_attn_mask], dim=0).view(1, 1, x_len + y_len, x_len + y_len)
+
+            unpadded, _, _ = self.block.process_prompt(x_item, attn_mask_item.expand(-1, self.num_heads, -1, -1), None, False)
+            self.assertTrue(torch.allclose(padded[i:i + 1, idx], unpadded, atol=1e-5))
+
+    def test_key_padding_mask_matches_dense_mask(self):
+        # Text2SemanticDecoder.make_batch_infer_input only masks padded keys, broadcast over heads and queries
+        x_lens = [9, 6, 2]
+        x, attn_mask, padding_mask = self.make_batch(x_lens, 5)
+        src_len = x.shape[1]
+        xy_mask = attn_mask[0, 0]  # the longest row has no padding
+        key_padding_mask = padding_mask[:, :, 0]
+        compact_mask = xy_mask.view(1, 1, src_len, src_len).logical_or(key_padding_mask.view(-1, 1, 1, src_len))
+
+        dense = self.block.process_prompt(x, attn_mask, padding_mask, False)
+        compact = self.block.process_prompt(x, compact_mask, padding_mask, False)
+        for a, e in zip(compact, dense):
+            self.assertTrue(torch.allclose(a, e, atol=1e-5))
+
+    def test_padded_prefill_does_not_modify_input(self):
+        x, attn_mask, padding_mask = self.make_batch([4, 3], 2)
+        x_copy = x.clone()
+        self.block.process_prompt(x, attn_mask, padding_mask, False)
+        self.assertTrue(torch.equal(x, x_copy))
+
+
+if __name__ == '__main__':
+    unittest.main()
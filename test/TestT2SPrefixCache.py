@@ -0,0 +1,48 @@
+import unittest
+
+import torch
+
+from GPT_SoVITS.AR.models.t2s_prefix_cache import T2SPrefix, T2SPrefixCache
+
+
+class EmbeddingModel:
+    # stands in for Text2SemanticDecoder.embed_prompt_prefix
+    def __init__(self):
+        self.calls = 0
+
+    def embed_prompt_prefix(self, phones, bert_feature, prompt):
+        self.calls += 1
+        return T2SPrefix(phones.shape[0], torch.zeros(1, phones.shape[0], 8), None)
+
+
+class TestT2SPrefixCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.phones = torch.arange(5)
+        self.bert_feature = torch.zeros(1024, 5)
+        self.prompt = torch.zeros(1, 3, dtype=torch.long)
+
+    def get_prefix(self, cache, model, weights_id, reference_id):
+        return cache.get_prefix(model, weights_id, reference_id, self.phones, self.bert_feature, self.prompt)
+
+    def test_keyed_on_weights_and_reference(self):
+        cache = T2SPrefixCache()
+        model = EmbeddingModel()
+        prefix = self.get_prefix(cache, model, "gpt.ckpt", ("ref", "text"))
+        self.assertIs(self.get_prefix(cache, model, "gpt.ckpt", ("ref", "text")), prefix)
+        self.get_prefix(cache, model, "gpt.ckpt", ("other ref", "text"))
+        self.get_prefix(cache, model, "other.ckpt", ("ref", "text"))
+        self.assertEqual(model.calls, 3)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_no_reference_id_is_not_cached(self):
+        cache = T2SPrefixCache()
+        model = EmbeddingModel()
+        self.get_prefix(cache, model, "gpt.ckpt", None)
+        self.get_prefix(cache, model, "gpt.ckpt", None)
+        self.assertEqual(model.calls, 2)
+        self.assertEqual(cache.nbytes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+import torch
+
+from GPT_SoVITS.AR.models.t2s_sampler import T2SSampler
+from GPT_SoVITS.AR.models.utils import sample
+
+
+class TestT2SSampler(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.vocab_size = 48
+        self.num_samples = 40000
+        self.logits = torch.randn(1, self.vocab_size) * 2
+        self.previous_tokens = torch.randint(0, self.vocab_size, (1, 12))
+
+    def histogram(self, samples):
+        return torch.bincount(samples.view(-1).long(), minlength=self.vocab_size).float() / samples.numel()
+
+    def reference_histogram(self, top_k, top_p, temperature, repetition_penalty):
+        logits = self.logits.repeat(self.num_samples, 1)
+        previous_tokens = self.previous_tokens.repeat(self.num_samples, 1)
+        samples = sample(logits, previous_tokens, top_k=top_k, top_p=top_p,
+                         temperature=temperature, repetition_penalty=repetition_penalty)[0]
+        return self.histogram(samples)
+
+    def sampler_histogram(self, top_k, top_p, temperature, repetition_penalty):
+        sampler = T2SSampler(self.num_samples, self.vocab_size, torch.device("cpu"),
+                             top_k, top_p, temperature, repetition_penalty)
+        sampler.update(self.previous_tokens.repeat(self.num_samples, 1))
+        samples, _ = sampler.sample(self.logits.repeat(self.num_samples, 1))
+        return self.histogram(samples)
+
+    def assertSameDistribution(self, expected, actual):
+        total_variation = (expected - actual).abs().sum() / 2
+        self.assertLess(total_variation.item(), 0.02)
+
+    def test_matches_sample(self):
+        for params in [
+            (15, 1.0, 1.0, 1.35),    # TTS defaults
+            (5, 1.0, 0.6, 1.0),      # top_k only
+            (20, 0.7, 1.0, 1.35),    # top_k + top_p
+            (48, 0.9, 1.3, 1.5),     # top_p only
+        ]:
+            with self.subTest(params=params):
+                self.assertSameDistribution(self.reference_histogram(*params), self.sampler_histogram(*params))
+
+    def test_per_row_params(self):
+        params_a = (5, 1.0, 1.0, 1.35)
+        params_b = (30, 0.8, 0.8, 1.0)
+        half = self.num_samples // 2
+        sampler = T2SSampler(self.num_samples, self.vocab_size, torch.device("cpu"),
+                             *[[a] * half + [b] * half for a, b in zip(params_a, params_b)])
+        sampler.update(self.previous_tokens.repeat(self.num_samples, 1))
+        samples, _ = sampler.sample(self.logits.repeat(self.num_samples, 1))
+
+        self.num_samples = half
+        self.assertSameDistribution(self.reference_histogram(*params_a), self.histogram(samples[:half]))
+        self.assertSameDistribution(self.reference_histogram(*params_b), self.histogram(samples[half:]))
+
+    def test_argmax_of_penalized_logits(self):
+        sampler_logits = self.logits.clone()
+        sampler = T2SSampler(1, self.vocab_size, torch.device("cpu"), 15, 1.0, 1.0, 1.35)
+        sampler.update(self.previous_tokens)
+        _, tokens = sampler.sample(sampler_logits)
+
+        # both apply the repetition penalty to the logits they are given in place
+        reference_logits = self.logits.clone()
+        sample(reference_logits, self.previous_tokens, top_k=15, top_p=1.0, temperature=1.0, repetition_penalty=1.35)
+        self.assertFalse(torch.equal(reference_logits, self.logits))
+        self.assertTrue(torch.allclose(sampler_logits, reference_logits))
+        self.assertEqual(tokens.item(), torch.argmax(reference_logits, dim=-1).item())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import threading
+import unittest
+
+import torch
+
+from GPT_SoVITS.AR.models.t2s_model import Text2SemanticDecoder
+from GPT_SoVITS.AR.models.t2s_scheduler import T2SScheduler
+
+
+class BlockingModel:
+    # stands in for Text2SemanticDecoder: the prefill of the first sequence blocks until released
+    def __init__(self):
+        self.release = threading.Event()
+        self.entered = threading.Event()
+
+    def embed_text(self, x, bert_feature, prompt_prefix):
+        self.entered.set()
+        self.release.wait(5)
+        raise RuntimeError("released")
+
+
+class TestT2SScheduler(unittest.TestCase):
+
+    def test_close_fails_outstanding_futures(self):
+        model = BlockingModel()
+        scheduler = T2SScheduler(model)
+        x, bert_feature = torch.zeros(4, dtype=torch.long), torch.zeros(1024, 4)
+        running = scheduler.submit(x, None, bert_feature)
+        self.assertTrue(model.entered.wait(5))
+        queued = scheduler.submit(x, None, bert_feature)
+
+        closer = threading.Thread(target=scheduler.close)
+        closer.start()
+        with self.assertRaisesRegex(RuntimeError, "closed"):
+            queued.result(timeout=5)
+        model.release.set()
+        closer.join(5)
+        self.assertFalse(closer.is_alive())
+        with self.assertRaises(RuntimeError):
+            running.result(timeout=5)
+        with self.assertRaises(RuntimeError):
+            scheduler.submit(x, None, bert_feature)
+
+
+class TestT2SSchedulerDecode(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        config = {"model": {
+            "hidden_dim": 64, "embedding_dim": 64, "head": 4, "n_layer": 2,
+            "vocab_size": 1025, "phoneme_vocab_size": 732, "dropout": 0, "EOS": 1024,
+        }}
+        self.model = Text2SemanticDecoder(config).eval()
+        self.scheduler = T2SScheduler(self.model)
+        x_lens = [9, 14]
+        self.x = [torch.randint(1, 732, (length,)) for length in x_lens]
+        self.x_lens = torch.LongTensor(x_lens)
+        self.bert_feature = [torch.randn(1024, length) for length in x_lens]
+
+    def tearDown(self) -> None:
+        self.scheduler.close()
+
+    def decode(self, infer_panel, prompts):
+        # top_k=1 samples the argmax, so both paths must produce the same tokens
+        with torch.no_grad():
+            return infer_panel(self.x, self.x_lens, prompts, self.bert_feature,
+                               top_k=1, top_p=1, early_stop_num=30, temperature=1, repetition_penalty=1.35)
+
+    def assertSameDecode(self, prompts):
+        y_list, idx_list = self.decode(self.model.infer_panel_batch_infer, prompts)
+        scheduler_y_list, scheduler_idx_list = self.decode(self.scheduler.infer_panel, prompts)
+        self.assertEqual(scheduler_idx_list, idx_list)
+        for y, scheduler_y in zip(y_list, scheduler_y_list):
+            self.assertEqual(scheduler_y.tolist(), y.tolist())
+        return idx_list
+
+    def test_greedy_matches_batch_infer(self):
+        self.assertSameDecode(torch.randint(0, 1024, (len(self.x), 6)))
+
+    def test_greedy_matches_batch_infer_ref_free(self):
+        self.assertEqual(self.assertSameDecode(None), [0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
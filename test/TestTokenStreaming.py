@@ -0,0 +1,47 @@
+import unittest
+
+import torch
+
+from GPT_SoVITS.TTS_infer_pack.token_streaming import stream_tokens, vocode_token_stream
+
+
+class RepeatVocoder:
+    # stands in for SynthesizerTrn.decode: every token becomes 1280 samples of its value
+    def __init__(self):
+        self.calls = []
+
+    def decode(self, codes, text, ge, speed=1):
+        self.calls.append(codes.shape[-1])
+        return codes.float().repeat_interleave(1280, dim=-1)
+
+
+def infer(num_tokens, on_token=None):
+    for i in range(num_tokens):
+        on_token(torch.tensor([[i]]))
+
+
+class TestTokenStreaming(unittest.TestCase):
+
+    def test_stream_tokens(self):
+        tokens = [t.item() for t in stream_tokens(infer, 7)]
+        self.assertEqual(tokens, list(range(7)))
+
+    def test_stream_tokens_close_stops_decoder(self):
+        tokens = stream_tokens(infer, 10000)
+        self.assertEqual(next(tokens).item(), 0)
+        tokens.close()
+
+    def test_chunks_match_full_decode(self):
+        num_tokens = 53
+        vocoder = RepeatVocoder()
+        tokens = [torch.tensor([[i]]) for i in range(num_tokens)]
+        chunks = list(vocode_token_stream(vocoder, tokens, None, None, block_size=10, lookback=4, fade_len=640))
+
+        expected = torch.arange(num_tokens).float().repeat_interleave(1280)
+        self.assertTrue(torch.allclose(torch.cat(chunks), expected))
+        # 5 full blocks + the rest, each decoded with up to 4 tokens of left context
+        self.assertEqual(vocoder.calls, [10, 14, 14, 14, 14, 7])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+
+import torch
+from safetensors.torch import save_file
+
+from GPT_SoVITS.utils import HParams
+from GPT_SoVITS.weights_io import convert_weights, load_weights
+
+
+class TestWeightsIO(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.weight = {
+            "enc_p.text_embedding.weight": torch.randn(732, 4).half(),
+            "dec.conv_pre.weight": torch.randn(3, 5).t().half(),  # not contiguous
+        }
+        self.weight["tied.weight"] = self.weight["enc_p.text_embedding.weight"]  # shares memory
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        path = os.path.join(self.tmp_dir.name, "model.pth")
+        config = HParams(data={"sampling_rate": 32000}, model={"upsample_rates": [10, 8, 2, 2, 2]})
+        torch.save({"weight": self.weight, "config": config, "info": "96epoch"}, path)
+
+        output_path = convert_weights(path)
+        self.assertEqual(output_path, os.path.join(self.tmp_dir.name, "model.safetensors"))
+        checkpoint = load_weights(output_path)
+        self.assertEqual(checkpoint["config"], {"data": {"sampling_rate": 32000}, "model": {"upsample_rates": [10, 8, 2, 2, 2]}})
+        self.assertEqual(checkpoint["info"], "96epoch")
+        self.assertEqual(checkpoint["weight"].keys(), self.weight.keys())
+        for key, tensor in self.weight.items():
+            self.assertEqual(checkpoint["weight"][key].dtype, torch.float16)
+            self.assertTrue(torch.equal(checkpoint["weight"][key], tensor))
+
+    def test_requires_config(self):
+        path = os.path.join(self.tmp_dir.name, "model.safetensors")
+        save_file({"weight": torch.zeros(1)}, path)
+        with self.assertRaises(ValueError):
+            load_weights(path)
+
+
+if __name__ == '__main__':
+    unittest.main()